@@ -15,6 +15,7 @@ from torch_geometric.data import Data
 from torch_geometric.nn import GlobalAttention
 from torch_geometric.nn import SAGEConv,LayerNorm,PNAConv
 from mae_utils import get_sinusoid_encoding_table,Block
+from sparse_adj import dense_to_adj_t, num_edges, to_edge_index
 from timm.models.layers import trunc_normal_ as __call_trunc_normal_
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 
@@ -425,25 +426,37 @@ class merge_attention(nn.Module):
         self.merge_factor = merge_factor
         self.embed_dim = dim
 
-    def forward(self, x):
+    def sort_rows(self, x, weight=None):
+        # weight: multiplicity of every row when duplicate patches were collapsed (patch_dedup.py)
         q = self.q_linear(x)
         k = self.k_linear(x)
         # 注意力计算
         attn = torch.matmul(q,k.transpose(-2,-1))
         scale_factor = self.embed_dim ** 0.5
         attn = attn / scale_factor
+        if weight is not None:
+            # a row standing for w patches counts w times as a key
+            attn = attn + torch.log(weight).unsqueeze(0)
         attn = F.softmax(attn,dim=-1)
         # attn = F.softmax(attn,dim=1)
         # 特征值排序
         attn_scores = torch.max(attn, dim=-1).values
         #attn_scores = torch.sum(attn, dim=-1)
-        sorted_attn, sorted_indices = torch.sort(attn_scores, descending=True)
+        sorted_attn, sorted_indices = torch.sort(attn_scores, descending=True, stable=True)
         #sorted_attn = F.softmax(sorted_attn, dim=1)
         #print(sorted_attn)
         sorted_attn = attn[sorted_indices]
         sorted_x = x[sorted_indices]
+        sorted_w = None
+        if weight is not None:
+            sorted_w = weight[sorted_indices].unsqueeze(-1)
+            sorted_attn = sorted_attn * sorted_w
         #print(sorted_attn.shape, sorted_x.shape)
         sorted_x = sorted_attn.transpose(0,1) @ sorted_x + sorted_x
+        return sorted_x, sorted_indices, sorted_w
+
+    def forward(self, x, weight=None, return_order=False):
+        sorted_x, sorted_indices, sorted_w = self.sort_rows(x, weight)
         # 将有序特征值切分成前一半（偶数条）和后一半奇数条
         size = x.shape[0]
         high_size = (size // self.merge_factor) // 2
@@ -452,6 +465,9 @@ class merge_attention(nn.Module):
         low_x = sorted_x[high_size:,:]
         
         high_x = self.high_reduce_dim(high_x)
+        if sorted_w is not None:
+            high_x = high_x * sorted_w[:high_size]
+            low_x = low_x * sorted_w[high_size:]
         high_x = high_x.reshape([-1,self.merge_factor,self.embed_dim//8])
         high_x = torch.sum(high_x,dim=1)
         high_x = self.high_linear(high_x)
@@ -467,13 +483,73 @@ class merge_attention(nn.Module):
         out =self.out_linear(out) + out
         out = self.norm(out)
         
+        if return_order:
+            # rows merged into token t: sorted_indices[t*merge_factor:(t+1)*merge_factor], the rest in the last one
+            return out, sorted_indices
         return out
 
+    def forward_batch(self, xs, weights=None, return_order=False):
+        # forward of many bags at once: xs and weights are lists with one [N_b, dim] / [N_b]
+        # tensor per patient; returns the list of per-bag outputs (and orders). The attention,
+        # sort and attention product run per bag with the ops of forward (sort_rows), so every
+        # bag gets exactly its order, high/low split and merge_factor groups; the reductions and
+        # output layers run on the padded [B, L, dim] batch.
+        sizes = [x.shape[0] for x in xs]
+        B, m = len(xs), self.merge_factor
+        L = ((max(sizes) + m - 1) // m) * m
+        sorted_x = xs[0].new_zeros((B, L, self.embed_dim))
+        sorted_w = xs[0].new_ones((B, L, 1))
+        orders = []
+        for b, n in enumerate(sizes):
+            rows, order, w = self.sort_rows(xs[b], weights[b] if weights is not None else None)
+            sorted_x[b, :n] = rows
+            if w is not None:
+                sorted_w[b, :n] = w
+            orders.append(order)
+
+        size = torch.tensor(sizes, device=sorted_x.device)
+        high_size = (size // m) // 2 * m
+        pos = torch.arange(L, device=sorted_x.device).unsqueeze(0)
+        is_high = (pos < high_size.unsqueeze(1)).unsqueeze(-1)
+        is_low = ((pos >= high_size.unsqueeze(1)) & (pos < size.unsqueeze(1))).unsqueeze(-1)
+        high_x = self.high_reduce_dim(sorted_x) * sorted_w
+        low_x = sorted_x * sorted_w
+        high_x = (high_x * is_high).reshape([B, L // m, m, self.embed_dim // 8]).sum(dim=2)
+        low_x = (low_x * is_low).sum(dim=1)
+
+        groups = (high_size // m).tolist()
+        out = torch.cat([torch.cat((self.high_linear(high_x[b, :g]), low_x[b:b + 1]), dim=0) for b, g in enumerate(groups)], dim=0)
+        out = self.out_linear(out) + out
+        # self.norm (graph mode LayerNorm) separately for every bag
+        batch = torch.repeat_interleave(torch.arange(B, device=sorted_x.device), torch.tensor([g + 1 for g in groups], device=sorted_x.device))
+        count = torch.bincount(batch, minlength=B).unsqueeze(-1) * self.embed_dim
+        mean = torch.zeros((B, 1), device=sorted_x.device, dtype=out.dtype).index_add_(0, batch, out.sum(dim=-1, keepdim=True)) / count
+        out = out - mean[batch]
+        var = torch.zeros((B, 1), device=sorted_x.device, dtype=out.dtype).index_add_(0, batch, (out * out).sum(dim=-1, keepdim=True)) / count
+        out = out / (var.sqrt() + self.norm.eps)[batch]
+        if self.norm.weight is not None:
+            out = out * self.norm.weight + self.norm.bias
+        outs = list(torch.split(out, [g + 1 for g in groups], dim=0))
+        if return_order:
+            return outs, orders
+        return outs
+
 class dynamic_graph(nn.Module):
-    def __init__(self,dim,is_filted = True,std_factor=.2,k_weight=.3,filter_factor=0.4):
+    def __init__(self,dim,is_filted = True,std_factor=.2,k_weight=.3,filter_factor=0.4,shared_q=False,shared_k=False):
         super(dynamic_graph, self).__init__()
-        self.q_linear = nn.Sequential(nn.Linear(dim, dim//2), nn.ReLU(), nn.Linear(dim//2, dim//4))
-        self.k_linear = nn.Sequential(nn.Linear(dim, dim//2), nn.ReLU(), nn.Linear(dim//2, dim//4))
+        # shared_q / shared_k: that side gets the output of the shared image trunk
+        # (fusion_model_mae_2.img_trunk) and only keeps the last layer as its head
+        if shared_q:
+            self.q_linear = nn.Sequential(nn.Linear(dim//2, dim//4))
+        else:
+            self.q_linear = nn.Sequential(nn.Linear(dim, dim//2), nn.ReLU(), nn.Linear(dim//2, dim//4))
+        if shared_k and not is_filted:
+            # the keys of an unfiltered graph are never projected, see forward
+            self.k_linear = None
+        elif shared_k:
+            self.k_linear = nn.Sequential(nn.Linear(dim//2, dim//4))
+        else:
+            self.k_linear = nn.Sequential(nn.Linear(dim, dim//2), nn.ReLU(), nn.Linear(dim//2, dim//4))
 
         self.q_linear2 = nn.Sequential(nn.Linear(dim//4, dim//8), nn.ReLU(), nn.Linear(dim//8, dim//8))
         self.k_linear2 = nn.Sequential(nn.Linear(dim//4, dim//8), nn.ReLU(), nn.Linear(dim//8, dim//8))
@@ -489,12 +565,65 @@ class dynamic_graph(nn.Module):
         self.dim = dim
         self.dropout = nn.Dropout(p=.4)
 
-    def forward(self,q,k):
+        # density telemetry of the last built graph, see graph_stats.py
+        self.collect_stats = False
+        self.stats = None
+        # edges of earlier epochs reused in training, see topology_cache.py
+        self.topology = None
+        # emit a sorted CSR adj_t instead of edge_index, see sparse_adj.py
+        self.emit_csr = False
+
+    def graph_stats(self,adj_matrix,edge,thresold):
+        # detached tensors only, converted to python numbers once per patient by the monitor
+        with torch.no_grad():
+            num_nodes = adj_matrix.shape[0]
+            deg = adj_matrix.sum(dim=0).float()
+            return {'nodes': deg.new_tensor(float(num_nodes)),
+                    'edges': deg.new_tensor(float(num_edges(edge))),
+                    'density': deg.new_tensor(num_edges(edge) / float(max(num_nodes * num_nodes, 1))),
+                    'deg_mean': deg.mean(),
+                    'deg_std': deg.std(unbiased=False),
+                    'deg_min': deg.min(),
+                    'deg_max': deg.max(),
+                    'isolated': (deg == 0).sum().float(),
+                    'threshold': thresold.detach().reshape(-1)[0].float()}
+
+    def forward_cached(self,q,k,cached,topology_only=False):
+        # the node update over the cached edges only, attention softmax per target as in attn2
+        if topology_only:
+            edge = cached['edge']
+            return None,edge,torch.ones((edge.shape[1],1), dtype=q.dtype, device=q.device)
+        q = self.q_linear(q)
+        if self.is_filted:
+            k = self.k_linear(k[cached['index']])
+            node = torch.cat((q,self.k_weight * k),dim=0)
+        else:
+            node = q
+        edge = cached['edge']
+        q2=self.q_linear2(node)
+        k2=self.k_linear2(node)
+        attn2 = (q2[edge[0]] * k2[edge[1]]).sum(dim=-1)/(self.dim**.5)
+        attn2 = softmax(attn2, edge[1], num_nodes=node.shape[0])
+        node = scatter_add(attn2.unsqueeze(-1) * node[edge[1]], edge[0], dim=0, dim_size=node.shape[0]) + node
+        node = self.out_linear(node)
+        node = self.norm(node)
+        edge_weights = torch.ones((edge.shape[1],1), dtype=node.dtype, device=node.device)
+        return node,edge,edge_weights
+
+    def forward(self,q,k,key=None,topology_only=False):
+        # topology_only: the node features are not needed, only the edges are built
+        num_q, num_k = q.shape[0], k.shape[0]
+        if self.topology is not None and key is not None and self.training:
+            cached = self.topology.get(key,num_q,num_k)
+            if cached is not None:
+                return self.forward_cached(q,k,cached,topology_only)
         q = self.q_linear(q)
-        k = self.k_linear(k)
+        index = None
 
         # 适配性筛选
         if self.is_filted:
+            # the keys only enter the filtered graphs
+            k = self.k_linear(k)
             attn = torch.matmul(q,k.transpose(-2,-1))
             attn = attn/(self.dim**.5)
             attn = attn.softmax(dim=-1)
@@ -518,18 +647,29 @@ class dynamic_graph(nn.Module):
         attn2 = torch.matmul(q2,k2.transpose(-2,-1))
         attn2 = attn2/(self.dim**.5)
         attn2 = attn2.softmax(dim=0)
-        node = torch.matmul(attn2,node) + node
-        node = self.out_linear(node)
-        node = self.norm(node)
+        if topology_only:
+            node = None
+        else:
+            node = torch.matmul(attn2,node) + node
+            node = self.out_linear(node)
+            node = self.norm(node)
         
         
         thresold = attn2.mean() + self.std_factor * attn2.std()
         adj_matrix = torch.where(attn2 > thresold, 1, 0)
         
         # adj_matrix = attn2[1 if attn2>thresold else 0]
-        (edge,edge_weights) = dense_to_sparse(adj_matrix)
-        edge = edge.long()
-        edge_weights = edge_weights.unsqueeze(-1)
+        if self.emit_csr:
+            edge = dense_to_adj_t(adj_matrix)
+            edge_weights = None
+        else:
+            (edge,edge_weights) = dense_to_sparse(adj_matrix)
+            edge = edge.long()
+            edge_weights = edge_weights.unsqueeze(-1)
+        if self.collect_stats:
+            self.stats = self.graph_stats(adj_matrix,edge,thresold)
+        if self.topology is not None and key is not None and self.training:
+            self.topology.put(key,to_edge_index(edge),index,num_q,num_k)
         return node,edge,edge_weights
 
 
@@ -541,10 +681,18 @@ class fusion_model_mae_2(nn.Module):
                  img_std_factor=.2,
                  rna_std_factor=.2,
                  cli_std_factor=.2,
-                 dropout=0.3,train_type_num=5,):
+                 dropout=0.3,train_type_num=5,
+                 merge_factor=4,filter_factor=0.4,shared_img_trunk=False,in_proj_dim=None):
         super(fusion_model_mae_2,self).__init__() 
 
-        self.merge_attention = merge_attention(in_feats,merge_factor=4)
+        # learned per-modality reduction of the input features, everything after it runs at
+        # in_proj_dim (see input_reduction.py for the offline alternative)
+        self.in_proj = None
+        if in_proj_dim is not None:
+            self.in_proj = nn.ModuleDict({t: nn.Linear(in_feats, in_proj_dim) for t in ['img','rna','cli']})
+            in_feats = in_proj_dim
+
+        self.merge_attention = merge_attention(in_feats,merge_factor=merge_factor)
         self.merge_linear = nn.Linear(in_feats,in_feats)
         self.merge_loss_linear = nn.Linear(in_feats,out_classes)
 
@@ -553,9 +701,12 @@ class fusion_model_mae_2(nn.Module):
         self.img_std_factor = nn.Parameter(torch.Tensor([img_std_factor,]))
         self.rna_std_factor = nn.Parameter(torch.Tensor([rna_std_factor,]))
         self.cli_std_factor = nn.Parameter(torch.Tensor([cli_std_factor,]))
-        self.img_dynamic_graph = dynamic_graph(in_feats,is_filted=False,std_factor=self.img_std_factor)
-        self.cli_dynamic_graph = dynamic_graph(in_feats,is_filted=True,std_factor=self.cli_std_factor,k_weight=self.k_weight_cli)
-        self.rna_dynamic_graph = dynamic_graph(in_feats,is_filted=True,std_factor=self.rna_std_factor,k_weight=self.k_weight_rna)
+        # first layer of the image side q/k projections computed once for the three graphs,
+        # see convert_shared_trunk.py for existing checkpoints
+        self.img_trunk = nn.Sequential(nn.Linear(in_feats, in_feats//2), nn.ReLU()) if shared_img_trunk else None
+        self.img_dynamic_graph = dynamic_graph(in_feats,is_filted=False,std_factor=self.img_std_factor,shared_q=shared_img_trunk,shared_k=shared_img_trunk)
+        self.cli_dynamic_graph = dynamic_graph(in_feats,is_filted=True,std_factor=self.cli_std_factor,k_weight=self.k_weight_cli,filter_factor=filter_factor,shared_k=shared_img_trunk)
+        self.rna_dynamic_graph = dynamic_graph(in_feats,is_filted=True,std_factor=self.rna_std_factor,k_weight=self.k_weight_rna,filter_factor=filter_factor,shared_k=shared_img_trunk)
         
         # graph conv(GraphSAGE conv)
         self.img_gnn_2 = SAGEConv(in_channels=in_feats,out_channels=out_classes)
@@ -649,6 +800,77 @@ class fusion_model_mae_2(nn.Module):
         #self.rna_rate = nn.Parameter(torch.Tensor([1.0,]))
         #self.cli_rate = nn.Parameter(torch.Tensor([1.0,]))
 
+        # decodes x_img_codes (product quantised patches, see pq_features.py)
+        self.feature_decoder = None
+        # per patient outputs of forward_front once it is frozen, see front_cache.py
+        self.front_cache = None
+        # coarse-to-fine selection of the image patches, see coarse_to_fine.py
+        self.coarse_to_fine = None
+        # runs the image branch partition by partition in eval mode, see partitioned_gnn.py
+        self.partitioned = None
+
+    def set_feature_decoder(self,decoder):
+        # not registered as a submodule so the checkpoints stay interchangeable
+        self.__dict__['feature_decoder'] = decoder.to(device) if decoder is not None else None
+
+    def set_front_cache(self,cache):
+        self.__dict__['front_cache'] = cache
+
+    def set_topology_cache(self,cache):
+        for graph in self.dynamic_graphs().values():
+            graph.__dict__['topology'] = cache
+
+    def merge_bags(self,graphs):
+        # merge_attention of many patients in one padded call; the results can be handed to
+        # forward as x_img_merged
+        xs = [self.feature_decoder.decode(g.x_img_codes) if getattr(g,'x_img_codes',None) is not None else g.x_img for g in graphs]
+        xs = [self.project('img',x) for x in xs]
+        weights = [getattr(g,'x_img_weight',None) for g in graphs]
+        if all(w is None for w in weights):
+            weights = None
+        return self.merge_attention.forward_batch(xs,weights)
+
+    def set_sparse_adj(self,flag=True):
+        for graph in self.dynamic_graphs().values():
+            graph.emit_csr = flag
+
+    def set_coarse_to_fine(self,selector):
+        self.__dict__['coarse_to_fine'] = selector
+
+    def set_partitioned(self,runner):
+        self.__dict__['partitioned'] = runner
+
+    def front_modules(self):
+        # the modules run by forward_front
+        names = ['merge_attention','merge_linear','img_dynamic_graph','cli_dynamic_graph','rna_dynamic_graph',
+                 'img_gnn_2','img_relu_2','imgb_gnn_2_linear','imgb_gnn_2','imgb_relu_2','imgc_gnn_2_linear','imgc_gnn_2','imgc_relu_2',
+                 'rna_gnn_2','rna_relu_2','cli_gnn_2','cli_relu_2','mpool_img','mpool_img_b','mpool_img_c','mpool_rna','mpool_cli']
+        if self.img_trunk is not None:
+            names.append('img_trunk')
+        if self.in_proj is not None:
+            names.append('in_proj')
+        return {name: getattr(self,name) for name in names}
+
+    def project(self,t,x):
+        # input features of modality t at the width of the model
+        return self.in_proj[t](x) if self.in_proj is not None else x
+
+    def img_keys(self,x_img):
+        # input of the image side projections of the dynamic graphs
+        return self.img_trunk(x_img) if self.img_trunk is not None else x_img
+
+    def freeze_front(self,flag=True):
+        for module in self.front_modules().values():
+            for p in module.parameters():
+                p.requires_grad = not flag
+
+    def dynamic_graphs(self):
+        return {'img': self.img_dynamic_graph, 'cli': self.cli_dynamic_graph, 'rna': self.rna_dynamic_graph}
+
+    def collect_graph_stats(self,flag=True):
+        for graph in self.dynamic_graphs().values():
+            graph.collect_stats = flag
+            graph.stats = None
 
 
     def forward(self,all_thing,train_use_type=None,use_type=None,in_mask=[],mix=False):
@@ -665,18 +887,40 @@ class fusion_model_mae_2(nn.Module):
             if 'img' in use_type:
                 mask = np.append((in_mask[0][0][0],in_mask[0][0][0],in_mask[0][0][0]),in_mask[0][0][1:]).reshape([1,1,5])
 
+        # with a front cache the bags are refined once, when their entry is computed
+        if self.front_cache is None and self.coarse_to_fine is not None and 'img' in data_type and getattr(all_thing,'pos_img',None) is not None:
+            all_thing = self.coarse_to_fine(self,all_thing)
+
+        if self.front_cache is not None:
+            front = self.front_cache.fetch(self,all_thing,data_type)
+        else:
+            front = self.forward_front(all_thing,data_type)
+        return self.forward_back(front,train_use_type,use_type,mask,mix)
+
+    def forward_front(self,all_thing,data_type):
+        # merge attention, dynamic graphs, graph convs and the first pooling of every branch
         # the input data features
         x_img = all_thing.x_img
-        x_rna = all_thing.x_rna
-        x_cli = all_thing.x_cli
+        # merge_attention output computed for many patients at once, see merge_bags
+        merged = getattr(all_thing, 'x_img_merged', None)
+        if merged is None and getattr(all_thing, 'x_img_codes', None) is not None:
+            x_img = self.feature_decoder.decode(all_thing.x_img_codes)
+        if merged is None and 'img' in data_type:
+            x_img = self.project('img',x_img)
+        x_rna = self.project('rna',all_thing.x_rna)
+        x_cli = self.project('cli',all_thing.x_cli)
 
         data_id=all_thing.data_id
         edge_index_img=all_thing.edge_index_image
         edge_index_rna=all_thing.edge_index_rna
         edge_index_cli=all_thing.edge_index_cli
+        # precomputed sorted CSR adjacencies of the static graphs, see sparse_adj.add_adj_t
+        if getattr(all_thing,'adj_t_rna',None) is not None:
+            edge_index_rna=all_thing.adj_t_rna
+        if getattr(all_thing,'adj_t_cli',None) is not None:
+            edge_index_cli=all_thing.adj_t_cli
 
-        save_fea = {}
-        fea_dict = {}
+        front = {'nodes': {}, 'pools': {}, 'atts': {}}
         # num_img = len(x_img)
         # num_rna = len(x_rna)
         # num_cli = len(x_cli)
@@ -684,49 +928,46 @@ class fusion_model_mae_2(nn.Module):
         x_img_cli = None
         # merge and dynamic graph net once
         if 'img' in data_type:
-            x_img = self.merge_attention(x_img)
+            if merged is not None:
+                x_img = merged
+            else:
+                x_img = self.merge_attention(x_img,getattr(all_thing,'x_img_weight',None))
             x_img = self.merge_linear(x_img)
             # for merge loss
             if x_img.shape[0] >= 10:
-                loss_img = x_img[:10,:]
+                front['merge_x'] = x_img[:10,:]
             else:
-                loss_img = x_img
-            #loss_img = torch.sum(loss_img, dim=1)
-            loss_img = self.merge_loss_linear(loss_img)
-            loss_img = self.lin1_img(loss_img)
-            loss_img = self.relu(loss_img)
-            loss_img = self.norm_img(loss_img)
-            loss_img = self.dropout(loss_img)
-
-            loss_img = self.lin2_img(loss_img)
-            fea_dict['loss_img'] = loss_img
+                front['merge_x'] = x_img
 
-            _, edge_index_img, edge_weights_img = self.img_dynamic_graph(x_img,x_img)
+            k_img = self.img_keys(x_img)
+            # the coarse-to-fine selection is part of the key of the stored topologies
+            bag = getattr(all_thing,'c2f_key',None)
+            _, edge_index_img, edge_weights_img = self.img_dynamic_graph(k_img,k_img,key=(data_id,'img',bag),topology_only=True)
             if 'cli' in data_type:
-                x_img_cli,edge_index_img_cli, edge_weights_img_cli = self.cli_dynamic_graph(x_cli,x_img)
+                x_img_cli,edge_index_img_cli, edge_weights_img_cli = self.cli_dynamic_graph(x_cli,k_img,key=(data_id,'cli',bag))
 
             if 'rna' in data_type:
-                x_img_rna,edge_index_img_rna, edge_weights_img_rna = self.rna_dynamic_graph(x_rna,x_img)
-        att_2 = []
+                x_img_rna,edge_index_img_rna, edge_weights_img_rna = self.rna_dynamic_graph(x_rna,k_img,key=(data_id,'rna',bag))
         # graph net
         # make per model features cat to pool_x final shap is (3,512)
         # the pool_x is a temporary container to save the feature of every model in this calculator block
-        pool_x = torch.empty((0)).to(device)
         o_x_img = x_img
-        o_x_rna = x_rna
-        o_x_cli = x_cli
-
 
-        if 'img' in data_type:
+        if 'img' in data_type and self.partitioned is not None and self.partitioned.applies(self,x_img):
+            # the nodes stay in a node_store, forward_back pools them partition by partition too
+            nodes,front['pools']['img'],front['atts']['img'] = self.partitioned.branch(self.img_gnn_2,self.img_relu_2,self.mpool_img,x_img,to_edge_index(edge_index_img))
+            front['nodes']['img'] = nodes
+            if 'imgb' in data_type and x_img_rna is None or 'imgc' in data_type and x_img_cli is None:
+                x_img = nodes.tensor().to(o_x_img.device)
+        elif 'img' in data_type:
             #print(x_img.shape)
             x_img = self.img_gnn_2(x_img,edge_index_img)
             x_img = self.img_relu_2(x_img)
-            
+
             #print(x_img.shape)
             batch = torch.zeros(len(x_img),dtype=torch.long).to(device)
-            pool_x_img,att_img_2 = self.mpool_img(x_img,batch)
-            att_2.append(att_img_2)
-            pool_x = torch.cat((pool_x,pool_x_img),0)
+            front['pools']['img'],front['atts']['img'] = self.mpool_img(x_img,batch)
+            front['nodes']['img'] = x_img
         if 'imgb' in data_type:
             if not x_img_rna==None:
                 x_imgb = self.imgb_gnn_2(x_img_rna,edge_index_img_rna)
@@ -735,14 +976,13 @@ class fusion_model_mae_2(nn.Module):
                 # print(edge_index_img)
                 x_imgb = self.imgb_gnn_2_linear(x_img)
                 x_imgb = x_imgb + o_x_img
-            
+
                 x_imgb = self.imgb_gnn_2(x_imgb,edge_index_img)
                 x_imgb = self.imgb_relu_2(x_imgb)
-            
+
             batch = torch.zeros(len(x_imgb),dtype=torch.long).to(device)
-            pool_x_img_b,att_img_2b = self.mpool_img_b(x_imgb,batch)
-            att_2.append(att_img_2b)
-            pool_x = torch.cat((pool_x,pool_x_img_b),0)
+            front['pools']['imgb'],front['atts']['imgb'] = self.mpool_img_b(x_imgb,batch)
+            front['nodes']['imgb'] = x_imgb
         if 'imgc' in data_type:
             if not x_img_cli==None:
                 x_imgc = self.imgc_gnn_2(x_img_cli, edge_index_img_cli)
@@ -751,31 +991,48 @@ class fusion_model_mae_2(nn.Module):
                 # print(edge_index_img)
                 x_imgc = self.imgc_gnn_2_linear(x_img)
                 x_imgc = x_imgc + o_x_img
-            
+
                 x_imgc = self.imgc_gnn_2(x_imgc,edge_index_img)
                 x_imgc = self.imgc_relu_2(x_imgc)
-            
+
             batch = torch.zeros(len(x_imgc),dtype=torch.long).to(device)
-            pool_x_img_c,att_img_2c = self.mpool_img_c(x_imgc,batch)
-            att_2.append(att_img_2c)
-            pool_x = torch.cat((pool_x,pool_x_img_c),0)
+            front['pools']['imgc'],front['atts']['imgc'] = self.mpool_img_c(x_imgc,batch)
+            front['nodes']['imgc'] = x_imgc
         if 'rna' in data_type:
             x_rna = self.rna_gnn_2(x_rna,edge_index_rna)
             x_rna = self.rna_relu_2(x_rna)
             batch = torch.zeros(len(x_rna),dtype=torch.long).to(device)
-            pool_x_rna,att_rna_2 = self.mpool_rna(x_rna,batch)
-            att_2.append(att_rna_2)
-            pool_x = torch.cat((pool_x,pool_x_rna),0)
+            front['pools']['rna'],front['atts']['rna'] = self.mpool_rna(x_rna,batch)
+            front['nodes']['rna'] = x_rna
         if 'cli' in data_type:
             x_cli = self.cli_gnn_2(x_cli,edge_index_cli)
             x_cli = self.cli_relu_2(x_cli)
             batch = torch.zeros(len(x_cli),dtype=torch.long).to(device)
             # self.mpool_cli = my_GlobalAttention(att_net_cli)
-            pool_x_cli,att_cli_2 = self.mpool_cli(x_cli,batch)
-            att_2.append(att_cli_2)
-            pool_x = torch.cat((pool_x,pool_x_cli),0)
+            front['pools']['cli'],front['atts']['cli'] = self.mpool_cli(x_cli,batch)
+            front['nodes']['cli'] = x_cli
+
+        return front
 
+    def forward_back(self,front,train_use_type,use_type,mask,mix):
+        # everything after the first pooling: mae, mix, second pooling and readout
+        data_type = use_type
+        save_fea = {}
+        fea_dict = {}
+        if 'merge_x' in front:
+            loss_img = self.merge_loss_linear(front['merge_x'])
+            loss_img = self.lin1_img(loss_img)
+            loss_img = self.relu(loss_img)
+            loss_img = self.norm_img(loss_img)
+            loss_img = self.dropout(loss_img)
 
+            loss_img = self.lin2_img(loss_img)
+            fea_dict['loss_img'] = loss_img
+        x_img, x_imgb, x_imgc, x_rna, x_cli = [front['nodes'].get(t) for t in ['img','imgb','imgc','rna','cli']]
+        img_shift = None
+        types = [t for t in ['img','imgb','imgc','rna','cli'] if t in data_type]
+        pool_x = torch.cat([front['pools'][t] for t in types],0) if len(types) > 0 else torch.empty((0)).to(device)
+        att_2 = [front['atts'][t] for t in types]
 
         # save the features after graph net as 'mae_labels'
         fea_dict['mae_labels'] = pool_x
@@ -812,11 +1069,10 @@ class fusion_model_mae_2(nn.Module):
             # 残差运算：mix后的特征+原特征
             k=0
             
-            o_x_img = all_thing.x_img
-            o_x_rna = all_thing.x_rna
-            o_x_cli = all_thing.x_cli
-            
-            if 'img' in data_type:
+            if 'img' in data_type and not torch.is_tensor(x_img):
+                img_shift = mae_x[train_use_type.index('img')]
+                k+=1
+            elif 'img' in data_type:
                 #o_x_imga = self.img_res_linear(o_x_img)
                 #x_img = o_x_imga + mae_x[train_use_type.index('img')]
                 #x_img = self.img_res_linear(x_img)
@@ -851,7 +1107,12 @@ class fusion_model_mae_2(nn.Module):
         att_3 = []
         pool_x = torch.empty((0)).to(device)
         
-        if 'img' in data_type:
+        if 'img' in data_type and not torch.is_tensor(x_img):
+            # partitioned image nodes, see forward_front
+            pool_x_img,att_img_3 = self.partitioned.pool(self.mpool_img_2,x_img,shift=img_shift)
+            att_3.append(att_img_3)
+            pool_x = torch.cat((pool_x,pool_x_img),0)
+        elif 'img' in data_type:
             batch = torch.zeros(len(x_img),dtype=torch.long).to(device)
             pool_x_img,att_img_3 = self.mpool_img_2(x_img,batch)
             att_3.append(att_img_3)
@@ -0,0 +1,113 @@
+import math
+import argparse
+import joblib
+import numpy as np
+from memory_tuner import num_patches
+
+'''
+Cox batches of patients of similar size, every batch with at least one event.
+
+    python train_a_dynamic_graph_HGCNplus_mergge_loss.py --bucket_batches [--num_buckets 4]
+    python bucket_sampler.py --all_data lihc_data.pkl --sur_and_time lihc_sur_and_time.pkl --batch_size 16
+
+The patients are sorted by their number of nodes (patches + rna + cli rows) and cut into
+num_buckets buckets of neighbouring sizes. Every epoch each bucket is shuffled and dealt into
+batches: the patients with an event first, one per batch, then the censored ones. A bucket
+never opens more batches than it has events, and a bucket without events is joined to its
+neighbour, so no batch hits the np.max(status_all) == 0 skip of train_a_epoch after paying
+for its forward passes. The order of the batches is shuffled as well.
+
+report() compares the batches with the fixed order of train_data: padding waste (share of
+a padded batch, max size x batch length, that is padding), the slowest patient per batch
+relative to the mean, and the batches that would be discarded.
+'''
+
+
+def node_count(data):
+    return num_patches(data) + data.x_rna.shape[0] + data.x_cli.shape[0]
+
+
+class bucket_sampler(object):
+    def __init__(self, ids, sizes, status, batch_size, num_buckets=4, seed=0):
+        self.ids = list(ids)
+        self.sizes = sizes
+        self.status = status
+        self.batch_size = batch_size
+        self.seed = seed
+        order = sorted(self.ids, key=lambda id: sizes[id])
+        n = max(1, min(num_buckets, len(order)))
+        buckets = [list(b) for b in np.array_split(np.array(order, dtype=object), n)]
+        # every bucket needs an event
+        merged = []
+        for bucket in buckets:
+            if len(merged) > 0 and not any(status[id] for id in merged[-1]):
+                merged[-1] += bucket
+            else:
+                merged.append(bucket)
+        if len(merged) > 1 and not any(status[id] for id in merged[-1]):
+            merged[-2] += merged.pop()
+        self.buckets = merged
+
+    def batches(self, epoch=0):
+        rng = np.random.RandomState(self.seed + epoch)
+        batches = []
+        for bucket in self.buckets:
+            events = [id for id in bucket if self.status[id]]
+            censored = [id for id in bucket if not self.status[id]]
+            rng.shuffle(events)
+            rng.shuffle(censored)
+            count = max(1, min(int(math.ceil(len(bucket) / float(self.batch_size))), len(events)))
+            parts = [[] for _ in range(count)]
+            for i, id in enumerate(events + censored):
+                parts[i % count].append(id)
+            batches += parts
+        rng.shuffle(batches)
+        return batches
+
+    def report(self, batches, baseline=None):
+        out = {'sampler': batch_stats(batches, self.sizes, self.status)}
+        if baseline is not None:
+            out['fixed order'] = batch_stats(baseline, self.sizes, self.status)
+        return out
+
+
+def fixed_batches(train_data, batch_size):
+    return [list(train_data[start:start + batch_size]) for start in range(0, len(train_data), batch_size)]
+
+
+def batch_stats(batches, sizes, status):
+    padded = sum(max(sizes[id] for id in b) * len(b) for b in batches)
+    used = sum(sizes[id] for b in batches for id in b)
+    gating = np.mean([max(sizes[id] for id in b) / max(np.mean([sizes[id] for id in b]), 1e-12) for b in batches])
+    return {'batches': len(batches),
+            'padding_waste': 1 - used / float(max(padded, 1)),
+            'max_over_mean': float(gating),
+            'discarded': sum(1 for b in batches if not any(status[id] for id in b))}
+
+
+def format_report(report):
+    return '\n'.join('{:12s} batches {:4d}  padding waste {:.1%}  slowest/mean {:.2f}  discarded {}'.format(
+        name, r['batches'], r['padding_waste'], r['max_over_mean'], r['discarded']) for name, r in report.items())
+
+
+def get_params():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--all_data", type=str, required=True, help="joblib all_data")
+    parser.add_argument("--sur_and_time", type=str, required=True, help="the <cancer>_sur_and_time.pkl of the training script")
+    parser.add_argument("--batch_size", type=int, default=16)
+    parser.add_argument("--num_buckets", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    args, _ = parser.parse_known_args()
+    return args
+
+
+if __name__ == '__main__':
+    from util import get_patients_information
+    args = get_params()
+    all_data = joblib.load(args.all_data)
+    sur_and_time = joblib.load(args.sur_and_time)
+    ids = [id for id in all_data.keys() if id in sur_and_time]
+    status, _, _ = get_patients_information(ids, sur_and_time)
+    sizes = {id: node_count(all_data[id]) for id in ids}
+    sampler = bucket_sampler(ids, sizes, status, args.batch_size, args.num_buckets, args.seed)
+    print(format_report(sampler.report(sampler.batches(), fixed_batches(ids, args.batch_size))))
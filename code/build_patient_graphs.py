@@ -0,0 +1,300 @@
+import os
+import json
+import hashlib
+import argparse
+import joblib
+import torch
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from torch_geometric.data import Data
+from patch_dedup import dedup_graph
+
+'''
+Builds the per-patient Data objects consumed by the training script (all_data).
+
+inputs
+    --img_dir     one file per patient named <patient_id>.<ext>, ext in pt/npz/npy/h5.
+                  pt : dict with 'features' [N, C] and optional 'coords' [N, 2] (or a plain tensor)
+                  npz/h5 : arrays 'features' and optional 'coords'
+                  npy : features only
+    --rna_table, --cli_table
+                  long format tables (csv/tsv/pkl) with a patient id column, one row per node
+                  and the node features in the remaining columns
+    --survival_table (optional) patient id and status columns, stored as data.sur_type
+
+every patient is written to <out_dir>/graphs/<patient_id>.pt together with a fingerprint of
+its inputs and of the build options, so patients whose inputs did not change are skipped
+on the next run. The merged dict is dumped with joblib to --output.
+'''
+
+IMG_EXTS = ['.pt', '.npz', '.npy', '.h5']
+MANIFEST = 'manifest.json'
+
+
+def load_patch_features(path):
+    ext = os.path.splitext(path)[1]
+    coords = None
+    if ext == '.pt':
+        # feature files of the extraction pipeline may hold numpy coords, not only tensors
+        obj = torch.load(path, map_location='cpu', weights_only=False)
+        if isinstance(obj, dict):
+            features = obj['features']
+            coords = obj.get('coords', None)
+        else:
+            features = obj
+    elif ext == '.npz':
+        obj = np.load(path)
+        features = obj['features']
+        coords = obj['coords'] if 'coords' in obj.files else None
+    elif ext == '.h5':
+        import h5py
+        with h5py.File(path, 'r') as f:
+            features = f['features'][:]
+            coords = f['coords'][:] if 'coords' in f else None
+    else:
+        features = np.load(path)
+    features = torch.as_tensor(np.asarray(features), dtype=torch.float)
+    if coords is not None:
+        coords = torch.as_tensor(np.asarray(coords), dtype=torch.float).reshape(-1, 2)
+    return features, coords
+
+
+def to_undirected_edge_index(src, dst, num_nodes):
+    src = np.asarray(src, dtype=np.int64)
+    dst = np.asarray(dst, dtype=np.int64)
+    keep = src != dst
+    src, dst = src[keep], dst[keep]
+    pairs = np.concatenate([src * num_nodes + dst, dst * num_nodes + src])
+    pairs = np.unique(pairs)
+    edge_index = np.stack([pairs // max(num_nodes, 1), pairs % max(num_nodes, 1)])
+    return torch.as_tensor(edge_index, dtype=torch.long)
+
+
+def grid_edge_index(coords, step=None, diagonal=True):
+    # regular patch grid: hash every patch by its cell and look its neighbours up, O(N)
+    coords = np.asarray(coords, dtype=np.float64)
+    n = coords.shape[0]
+    if n < 2:
+        return torch.zeros((2, 0), dtype=torch.long)
+    if step is None:
+        diffs = np.diff(np.unique(coords[:, 0]))
+        diffs = diffs[diffs > 0]
+        step = diffs.min() if len(diffs) > 0 else 1.0
+    cells = np.round(coords / step).astype(np.int64)
+    lookup = {(c[0], c[1]): i for i, c in enumerate(cells)}
+    offsets = [(1, 0), (0, 1)]
+    if diagonal:
+        offsets += [(1, 1), (1, -1)]
+    src, dst = [], []
+    for i, c in enumerate(cells):
+        for dx, dy in offsets:
+            j = lookup.get((c[0] + dx, c[1] + dy))
+            if j is not None:
+                src.append(i)
+                dst.append(j)
+    return to_undirected_edge_index(src, dst, n)
+
+
+def knn_edge_index(points, k=8):
+    # KD-tree kNN, O(N log N) instead of the dense N x N distance matrix
+    from scipy.spatial import cKDTree
+    points = np.asarray(points, dtype=np.float64)
+    n = points.shape[0]
+    if n < 2:
+        return torch.zeros((2, 0), dtype=torch.long)
+    k = min(k, n - 1)
+    _, idx = cKDTree(points).query(points, k=k + 1)
+    src = np.repeat(np.arange(n), k + 1)
+    return to_undirected_edge_index(src, idx.reshape(-1), n)
+
+
+def table_edge_index(x, mode='full', k=4):
+    # rna / clinical graphs are small, a dense cosine similarity is fine here
+    n = x.shape[0]
+    if n < 2:
+        return torch.zeros((2, 0), dtype=torch.long)
+    if mode == 'full':
+        src, dst = np.triu_indices(n, 1)
+        return to_undirected_edge_index(src, dst, n)
+    x = torch.nn.functional.normalize(x, dim=1)
+    sim = x @ x.t()
+    sim.fill_diagonal_(-float('inf'))
+    idx = sim.topk(min(k, n - 1), dim=1).indices.numpy()
+    src = np.repeat(np.arange(n), idx.shape[1])
+    return to_undirected_edge_index(src, idx.reshape(-1), n)
+
+
+def build_patient(task):
+    torch.set_num_threads(1)
+    pid, img_path, x_rna, x_cli, status, opts = task
+    in_feats = opts['in_feats']
+    data_type = []
+
+    if img_path is not None:
+        x_img, coords = load_patch_features(img_path)
+        if coords is not None and opts['img_graph'] == 'grid':
+            edge_index_image = grid_edge_index(coords.numpy(), step=opts['grid_step'])
+        elif coords is not None:
+            edge_index_image = knn_edge_index(coords.numpy(), k=opts['img_k'])
+        else:
+            edge_index_image = knn_edge_index(x_img.numpy(), k=opts['img_k'])
+        data_type.append('img')
+    else:
+        x_img, coords = torch.zeros((0, in_feats)), None
+        edge_index_image = torch.zeros((2, 0), dtype=torch.long)
+
+    if x_rna is not None:
+        x_rna = torch.as_tensor(x_rna, dtype=torch.float)
+        edge_index_rna = table_edge_index(x_rna, opts['tab_graph'], opts['tab_k'])
+        data_type.append('rna')
+    else:
+        x_rna = torch.zeros((0, in_feats))
+        edge_index_rna = torch.zeros((2, 0), dtype=torch.long)
+
+    if x_cli is not None:
+        x_cli = torch.as_tensor(x_cli, dtype=torch.float)
+        edge_index_cli = table_edge_index(x_cli, opts['tab_graph'], opts['tab_k'])
+        data_type.append('cli')
+    else:
+        x_cli = torch.zeros((0, in_feats))
+        edge_index_cli = torch.zeros((2, 0), dtype=torch.long)
+
+    data = Data(x_img=x_img, x_rna=x_rna, x_cli=x_cli,
+                edge_index_image=edge_index_image,
+                edge_index_rna=edge_index_rna,
+                edge_index_cli=edge_index_cli)
+    if coords is not None:
+        data.pos_img = coords
+    if status is not None:
+        data.sur_type = torch.tensor([status])
+    data.data_id = pid
+    data.data_type = data_type
+    if opts['dedup'] is not None and 'img' in data_type:
+        data = dedup_graph(data, opts['dedup'], bits=opts['dedup_bits'], ratio=opts['dedup_ratio'])
+
+    torch.save(data, os.path.join(opts['graph_path'], pid + '.pt'))
+    return pid
+
+
+def load_table(path, id_column):
+    if path is None:
+        return {}
+    if path.endswith('.pkl'):
+        table = pd.read_pickle(path)
+    else:
+        table = pd.read_csv(path, sep='\t' if path.endswith('.tsv') else ',')
+    groups = {}
+    for pid, rows in table.groupby(id_column, sort=False):
+        groups[str(pid)] = rows.drop(columns=[id_column]).to_numpy(dtype=np.float32)
+    return groups
+
+
+def fingerprint(img_path, x_rna, x_cli, status, opts):
+    h = hashlib.sha1()
+    h.update(json.dumps({k: v for k, v in opts.items() if k != 'graph_path'}, sort_keys=True).encode())
+    if img_path is not None:
+        st = os.stat(img_path)
+        h.update('{}:{}:{}'.format(os.path.basename(img_path), st.st_size, st.st_mtime_ns).encode())
+    for x in [x_rna, x_cli]:
+        h.update(b'|' if x is None else np.ascontiguousarray(x).tobytes())
+    h.update(str(status).encode())
+    return h.hexdigest()
+
+
+def find_img_files(img_dir):
+    files = {}
+    if img_dir is None:
+        return files
+    for name in sorted(os.listdir(img_dir)):
+        pid, ext = os.path.splitext(name)
+        if ext in IMG_EXTS:
+            files[pid] = os.path.join(img_dir, name)
+    return files
+
+
+def build_all_data(args):
+    graph_dir = os.path.join(args.out_dir, 'graphs')
+    os.makedirs(graph_dir, exist_ok=True)
+    manifest_path = os.path.join(args.out_dir, MANIFEST)
+    manifest = json.load(open(manifest_path)) if os.path.exists(manifest_path) else {}
+
+    img_files = find_img_files(args.img_dir)
+    rna = load_table(args.rna_table, args.id_column)
+    cli = load_table(args.cli_table, args.id_column)
+    status = {}
+    if args.survival_table is not None:
+        table = pd.read_csv(args.survival_table, sep='\t' if args.survival_table.endswith('.tsv') else ',')
+        status = {str(p): int(s) for p, s in zip(table[args.id_column], table[args.status_column])}
+
+    patients = sorted(set(img_files) | set(rna) | set(cli))
+    if args.patients is not None:
+        keep = set(joblib.load(args.patients))
+        patients = [p for p in patients if p in keep]
+
+    opts = {'in_feats': args.in_feats, 'img_graph': args.img_graph, 'img_k': args.img_k, 'grid_step': args.grid_step,
+            'tab_graph': args.tab_graph, 'tab_k': args.tab_k, 'graph_path': graph_dir,
+            'dedup': args.dedup, 'dedup_bits': args.dedup_bits, 'dedup_ratio': args.dedup_ratio}
+
+    tasks = []
+    new_manifest = {}
+    for pid in patients:
+        task = (pid, img_files.get(pid), rna.get(pid), cli.get(pid), status.get(pid), opts)
+        new_manifest[pid] = fingerprint(*task[1:])
+        if manifest.get(pid) == new_manifest[pid] and os.path.exists(os.path.join(graph_dir, pid + '.pt')) and not args.force:
+            continue
+        tasks.append(task)
+    print('patients: {}, to build: {}, unchanged: {}'.format(len(patients), len(tasks), len(patients) - len(tasks)))
+
+    if args.workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            futures = [pool.submit(build_patient, t) for t in tasks]
+            for n, f in enumerate(as_completed(futures)):
+                pid = f.result()
+                print('\r{}/{} {}'.format(n + 1, len(tasks), pid), end='')
+    else:
+        for n, t in enumerate(tasks):
+            pid = build_patient(t)
+            print('\r{}/{} {}'.format(n + 1, len(tasks), pid), end='')
+    print('')
+
+    with open(manifest_path, 'w') as f:
+        json.dump(new_manifest, f, indent=1)
+
+    all_data = {}
+    for pid in patients:
+        # pickled Data objects written by this script
+        all_data[pid] = torch.load(os.path.join(graph_dir, pid + '.pt'), weights_only=False)
+    if args.output is not None:
+        joblib.dump(all_data, args.output)
+    return all_data
+
+
+def get_params():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--img_dir", type=str, default=None, help="directory with one patch feature file per patient")
+    parser.add_argument("--rna_table", type=str, default=None, help="rna node table, one row per node")
+    parser.add_argument("--cli_table", type=str, default=None, help="clinical node table, one row per node")
+    parser.add_argument("--survival_table", type=str, default=None, help="optional table with the event status per patient")
+    parser.add_argument("--id_column", type=str, default='patient_id', help="patient id column of the tables")
+    parser.add_argument("--status_column", type=str, default='status', help="status column of the survival table")
+    parser.add_argument("--patients", type=str, default=None, help="optional joblib list of patients to build")
+    parser.add_argument("--out_dir", type=str, required=True, help="per-patient graph cache and manifest")
+    parser.add_argument("--output", type=str, default=None, help="joblib file for all_data, e.g. <root>/lihc/lihc_data.pkl")
+    parser.add_argument("--in_feats", type=int, default=1024, help="feature width, used for empty modalities")
+    parser.add_argument("--img_graph", type=str, default='knn', help="image graph: knn (KD-tree) or grid (8-neighbourhood)")
+    parser.add_argument("--img_k", type=int, default=8, help="neighbours of the image knn graph")
+    parser.add_argument("--grid_step", type=float, default=None, help="patch spacing of the grid graph, estimated if not set")
+    parser.add_argument("--tab_graph", type=str, default='full', help="rna/cli graph: full or knn")
+    parser.add_argument("--tab_k", type=int, default=4, help="neighbours of the rna/cli knn graph")
+    parser.add_argument("--dedup", type=str, default=None, help="collapse near-identical patches (patch_dedup.py): simhash or kmeans")
+    parser.add_argument("--dedup_bits", type=int, default=16, help="simhash hyperplanes")
+    parser.add_argument("--dedup_ratio", type=float, default=0.25, help="kmeans clusters per patch")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--force", action='store_true', default=False, help="rebuild unchanged patients too")
+    args, _ = parser.parse_known_args()
+    return args
+
+
+if __name__ == '__main__':
+    build_all_data(get_params())
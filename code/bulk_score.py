@@ -0,0 +1,176 @@
+import os
+import sys
+import csv
+import argparse
+import joblib
+import torch
+from inference_utils import add_model_args, load_model, score_graphs, check_merge_batch
+
+'''
+Streaming bulk scoring of an archive of patient graphs, no labels needed.
+
+    python bulk_score.py --checkpoints fold1.pth ... --graphs out_dir/graphs --output risks.csv
+    python bulk_score.py --checkpoints fold1.pth --graphs lihc_data.pkl --output risks.parquet --embeddings
+
+--graphs is either a directory of per-patient <patient_id>.pt files (as written by
+build_patient_graphs.py) or a joblib all_data file. Graphs are loaded one at a time from a
+directory, scored in groups of --chunk and appended to the output, so memory stays bounded
+by one chunk whatever the size of the archive. Patients already in the output are skipped
+with --resume.
+
+    python bulk_score.py --checkpoints fold1.pth --graphs out_dir/graphs --merge_batch 16 --check_merge_batch
+
+compares the padded merge_attention of --merge_batch with the per-patient one on the archive
+(same order of every bag, largest output difference) and writes nothing.
+'''
+
+
+def iter_graphs(source, skip=()):
+    if os.path.isdir(source):
+        for name in sorted(os.listdir(source)):
+            pid, ext = os.path.splitext(name)
+            if ext != '.pt' or pid in skip:
+                continue
+            # pickled Data objects of build_patient_graphs.py
+            graph = torch.load(os.path.join(source, name), map_location='cpu', weights_only=False)
+            if getattr(graph, 'data_id', None) is None:
+                graph.data_id = pid
+            yield graph
+    else:
+        # a joblib store is loaded whole, items are released once yielded
+        all_data = joblib.load(source)
+        for pid in list(all_data.keys()):
+            graph = all_data.pop(pid)
+            if str(pid) in skip:
+                continue
+            if getattr(graph, 'data_id', None) is None:
+                graph.data_id = pid
+            yield graph
+
+
+def iter_chunks(graphs, size):
+    chunk = []
+    for graph in graphs:
+        chunk.append(graph)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def flatten(res):
+    row = {k: v for k, v in res.items() if k not in ['embedding', 'fused_per_model']}
+    for i, v in enumerate(res['fused_per_model']):
+        row['fused_model_{}'.format(i)] = v
+    if 'embedding' in res:
+        for i, v in enumerate(res['embedding'].reshape(-1)):
+            row['emb_{}'.format(i)] = float(v)
+    return row
+
+
+class csv_sink(object):
+    def __init__(self, path, append=False):
+        self.file = open(path, 'a' if append else 'w', newline='')
+        self.writer = None
+        self.append = append
+
+    def write(self, rows):
+        if self.writer is None:
+            self.writer = csv.DictWriter(self.file, fieldnames=list(rows[0].keys()))
+            if not self.append:
+                self.writer.writeheader()
+        self.writer.writerows(rows)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class parquet_sink(object):
+    def __init__(self, path, append=False):
+        import pyarrow
+        import pyarrow.parquet
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        if append:
+            raise ValueError('--resume is only supported for csv output')
+        self.path = path
+        self.writer = None
+
+    def write(self, rows):
+        table = self.pa.Table.from_pylist(rows)
+        if self.writer is None:
+            self.writer = self.pq.ParquetWriter(self.path, table.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def scored_patients(path):
+    if not os.path.exists(path):
+        return set()
+    with open(path, newline='') as f:
+        return set(row['patient'] for row in csv.DictReader(f))
+
+
+def check_merge(args):
+    models = [load_model(path, args) for path in args.checkpoints]
+    bags, reordered, err = 0, 0, 0.0
+    for chunk in iter_chunks(iter_graphs(args.graphs), args.chunk):
+        for model in models:
+            b, r, e = check_merge_batch(model, chunk, args.merge_batch or args.chunk)
+            bags, reordered, err = bags + b, reordered + r, max(err, e)
+        print('\rchecked {} bags'.format(bags), end='')
+    print('')
+    print('merge_batch: {} bags, {} with a different order, max abs difference {:.3e}'.format(bags, reordered, err))
+    return reordered == 0 and err <= args.check_tol
+
+
+def bulk_score(args):
+    models = [load_model(path, args) for path in args.checkpoints]
+    skip = scored_patients(args.output) if args.resume else set()
+    append = args.resume and len(skip) > 0
+    sink = parquet_sink(args.output, append) if args.output.endswith('.parquet') else csv_sink(args.output, append)
+    n = 0
+    try:
+        for chunk in iter_chunks(iter_graphs(args.graphs, skip), args.chunk):
+            results = score_graphs(models, chunk, args, embeddings=args.embeddings)
+            sink.write([flatten(res) for res in results])
+            n += len(chunk)
+            print('\rscored {}'.format(n), end='')
+            del chunk, results
+    finally:
+        sink.close()
+    print('')
+    return n
+
+
+def get_params():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checkpoints", type=str, nargs='+', required=True, help="fold state_dict files, risks are averaged")
+    parser.add_argument("--graphs", type=str, required=True, help="directory of <patient_id>.pt graphs or a joblib all_data")
+    parser.add_argument("--output", type=str, default=None, help="csv or parquet output")
+    parser.add_argument("--merge_batch", type=int, default=None, help="run merge_attention for this many patients of a chunk in one padded call")
+    parser.add_argument("--check_merge_batch", action='store_true', default=False, help="compare the batched merge_attention with the per-patient one instead of scoring")
+    parser.add_argument("--check_tol", type=float, default=1e-4, help="largest accepted output difference of --check_merge_batch")
+    parser.add_argument("--chunk", type=int, default=256, help="patients scored and written per chunk")
+    parser.add_argument("--embeddings", action='store_true', default=False, help="also write the pooled per-modality embeddings")
+    parser.add_argument("--resume", action='store_true', default=False, help="skip patients already in the csv output")
+    add_model_args(parser)
+    args, _ = parser.parse_known_args()
+    if args.output is None and not args.check_merge_batch:
+        parser.error('--output is required')
+    if args.resume and args.output is not None and args.output.endswith('.parquet'):
+        # checked before scored_patients reads the output as csv
+        parser.error('--resume is only supported for csv output')
+    return args
+
+
+if __name__ == '__main__':
+    args = get_params()
+    if args.check_merge_batch:
+        sys.exit(0 if check_merge(args) else 1)
+    bulk_score(args)
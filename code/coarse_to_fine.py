@@ -0,0 +1,81 @@
+import hashlib
+import torch
+from patch_dedup import collapse
+
+'''
+Coarse-to-fine processing of the image bag (--c2f_budget).
+
+The patches are binned into square cells of cell x cell patches (from pos_img) and every
+cell is replaced by its mean. merge_attention, img_dynamic_graph, img_gnn_2 and mpool_img
+run on these cell means (weighted by the patch counts, see merge_attention), and the gate
+of mpool_img is mapped back to the cells through the merge order of merge_attention. The
+cells with the highest attention are then refined: their patches are kept at full
+resolution, as many as fit into budget patches, while every other cell stays one weighted
+mean. The regular forward runs on that mixed bag, so its quadratic stages cost about
+(budget + cells)^2 instead of N^2. Slides with at most budget patches are left as they are.
+The refined bag carries c2f_key, a hash of its refined cells, so that stored topologies of
+another selection are not reused (topology_cache.py).
+'''
+
+
+def patch_step(pos):
+    diffs = torch.diff(torch.unique(pos[:, 0]))
+    diffs = diffs[diffs > 0]
+    return diffs.min().item() if len(diffs) > 0 else 1.0
+
+
+def cell_assign(pos, cell):
+    grid = torch.floor(pos.double() / (patch_step(pos) * cell)).long()
+    _, assign = torch.unique(grid, dim=0, return_inverse=True)
+    return assign
+
+
+class coarse_to_fine(object):
+    def __init__(self, budget, cell=8):
+        self.budget = budget
+        self.cell = cell
+
+    def cell_scores(self, model, coarse):
+        # attention of mpool_img on the coarse bag, spread over the cells of every token
+        with torch.no_grad():
+            x, order = model.merge_attention(model.project('img', coarse.x_img), coarse.x_img_weight, return_order=True)
+            x = model.merge_linear(x)
+            k = model.img_keys(x)
+            _, edge, _ = model.img_dynamic_graph(k, k, topology_only=True)
+            x = model.img_relu_2(model.img_gnn_2(x, edge))
+            _, gate = model.mpool_img(x, torch.zeros(len(x), dtype=torch.long, device=x.device))
+        gate = gate.view(-1)
+        merge_factor = model.merge_attention.merge_factor
+        high_size = gate.shape[0] - 1
+        token = torch.full((order.shape[0],), high_size, dtype=torch.long, device=order.device)
+        token[order[:high_size * merge_factor]] = torch.arange(high_size * merge_factor, device=order.device) // merge_factor
+        counts = torch.bincount(token, minlength=gate.shape[0]).float()
+        return (gate / counts.clamp(min=1))[token]
+
+    def __call__(self, model, data):
+        if getattr(data, 'x_img_codes', None) is not None:
+            data = data.clone()
+            data.x_img = model.feature_decoder.decode(data.x_img_codes)
+            data.x_img_codes = None
+        n = data.x_img.shape[0]
+        if n <= self.budget:
+            return data
+        cells = cell_assign(data.pos_img, self.cell).to(data.x_img.device)
+        scores = self.cell_scores(model, collapse(data, cells))
+
+        patches = torch.bincount(cells, minlength=scores.shape[0])
+        order = torch.argsort(scores, descending=True)
+        fits = torch.cumsum(patches[order], dim=0) <= self.budget
+        refine = torch.zeros(scores.shape[0], dtype=torch.bool, device=cells.device)
+        refine[order[fits]] = True
+
+        # refined patches keep their own group, the other cells collapse to one group each
+        fine = refine[cells]
+        num_fine = int(fine.sum())
+        assign = torch.empty(n, dtype=torch.long, device=cells.device)
+        assign[fine] = torch.arange(num_fine, device=cells.device)
+        _, rest = torch.unique(cells[~fine], return_inverse=True)
+        assign[~fine] = num_fine + rest
+        data = collapse(data, assign)
+        data.c2f_key = hashlib.sha1(refine.nonzero().cpu().numpy().tobytes()).hexdigest()[:16]
+        return data
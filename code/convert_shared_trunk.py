@@ -0,0 +1,101 @@
+import argparse
+import joblib
+import torch
+from inference_utils import add_model_args, build_model, device
+
+'''
+Converts a checkpoint of fusion_model_mae_2 to the shared image trunk (--shared_img_trunk).
+
+    python convert_shared_trunk.py --checkpoint fold_0.pt --output fold_0_trunk.pt --all_data lihc_data.pkl --patients 32
+
+The image side q/k projections of the dynamic graphs are 2-layer MLPs of their own; with
+the trunk they share the first layer and keep one linear head each. The image graph is not
+filtered, so its keys are never projected and the trunk model has no img k head. The trunk
+takes the first layer of cli_dynamic_graph.k_linear, whose head is therefore copied
+unchanged. The other two heads (img q, rna k) were trained on a different first layer, so
+they are refitted by ridge regression from the trunk features to the outputs of the old
+MLPs, on the merged image tokens of --patients patients. Without --all_data their old last
+layers are copied, which is only a starting point. Either way the conversion is approximate:
+the relative error of every head is printed, and a few epochs of fine-tuning are advised.
+'''
+
+HEADS = [('img_dynamic_graph', 'q_linear'), ('cli_dynamic_graph', 'k_linear'), ('rna_dynamic_graph', 'k_linear')]
+# the head whose first layer becomes the trunk
+TRUNK = ('cli_dynamic_graph', 'k_linear')
+
+
+def token_samples(model, all_data, patients):
+    # merged image tokens, the input of the image side projections
+    ids = [id for id in all_data.keys() if 'img' in all_data[id].data_type][:patients]
+    xs = []
+    with torch.no_grad():
+        for id in ids:
+            graph = all_data[id].to(device)
+            x = graph.x_img
+            if getattr(graph, 'x_img_codes', None) is not None:
+                x = model.feature_decoder.decode(graph.x_img_codes)
+            xs.append(model.merge_linear(model.merge_attention(model.project('img', x), getattr(graph, 'x_img_weight', None))))
+    return torch.cat(xs, dim=0)
+
+
+def fit_head(h, y, ridge=1e-3):
+    # y ~ h @ W.t() + b
+    h1 = torch.cat((h, torch.ones((h.shape[0], 1), device=h.device, dtype=h.dtype)), dim=1).double()
+    a = h1.t() @ h1 + ridge * torch.eye(h1.shape[1], device=h.device, dtype=torch.float64)
+    wb = torch.linalg.solve(a, h1.t() @ y.double())
+    return wb[:-1].t().float(), wb[-1].float()
+
+
+def convert(old_state, args, all_data=None, patients=32):
+    old = build_model(args).to(device)
+    old.load_state_dict(old_state)
+    old.eval()
+    args.shared_img_trunk = True
+    new = build_model(args).to(device)
+    new_state = new.state_dict()
+    for name, value in old_state.items():
+        if name in new_state and new_state[name].shape == value.shape:
+            new_state[name] = value.clone()
+    new_state['img_trunk.0.weight'] = old_state['{}.{}.0.weight'.format(*TRUNK)].clone()
+    new_state['img_trunk.0.bias'] = old_state['{}.{}.0.bias'.format(*TRUNK)].clone()
+    for graph, side in HEADS:
+        new_state['{}.{}.0.weight'.format(graph, side)] = old_state['{}.{}.2.weight'.format(graph, side)].clone()
+        new_state['{}.{}.0.bias'.format(graph, side)] = old_state['{}.{}.2.bias'.format(graph, side)].clone()
+
+    errors = {}
+    if all_data is not None:
+        x = token_samples(old, all_data, patients)
+        with torch.no_grad():
+            h = torch.relu(x @ new_state['img_trunk.0.weight'].to(device).t() + new_state['img_trunk.0.bias'].to(device))
+            for graph, side in HEADS:
+                y = old.get_submodule(graph + '.' + side)(x)
+                if (graph, side) != TRUNK:
+                    w, b = fit_head(h, y)
+                    new_state['{}.{}.0.weight'.format(graph, side)] = w.cpu()
+                    new_state['{}.{}.0.bias'.format(graph, side)] = b.cpu()
+                w = new_state['{}.{}.0.weight'.format(graph, side)].to(device)
+                b = new_state['{}.{}.0.bias'.format(graph, side)].to(device)
+                errors[graph + '.' + side] = ((h @ w.t() + b - y).norm() / y.norm().clamp(min=1e-12)).item()
+    new.load_state_dict(new_state)
+    return new.state_dict(), errors
+
+
+def get_params():
+    parser = argparse.ArgumentParser()
+    add_model_args(parser)
+    parser.add_argument("--checkpoint", type=str, required=True, help="state_dict without the shared trunk")
+    parser.add_argument("--output", type=str, required=True, help="converted state_dict")
+    parser.add_argument("--all_data", type=str, default=None, help="joblib all_data to refit the heads on")
+    parser.add_argument("--patients", type=int, default=32, help="patients whose merged tokens are used for the refit")
+    args, _ = parser.parse_known_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = get_params()
+    args.shared_img_trunk = False
+    all_data = joblib.load(args.all_data) if args.all_data is not None else None
+    state, errors = convert(torch.load(args.checkpoint, map_location=device), args, all_data, args.patients)
+    for name, error in errors.items():
+        print('{}: relative error {:.3f}'.format(name, error))
+    torch.save(state, args.output)
@@ -0,0 +1,313 @@
+import argparse
+import joblib
+import numpy as np
+
+'''
+Static FLOP and memory estimate of fusion_model_mae_2 for capacity planning.
+
+Stages are named after the submodules of fusion_model_mae_2 so they can be compared one to
+one with a measured run (--measure, FlopCounterMode per module). FLOPs count the dense
+matmuls (2 per multiply-add), which is what FlopCounterMode reports as well; the scatter of
+the SAGEConv mean aggregation is listed separately as 'aggr'. Activations are the fp32
+elements a training forward keeps for backward, so a Cox batch of B patients holds about
+B times the per-patient activations until loss.backward().
+
+The dynamic graphs threshold attention at mean + std * factor, so their edge count is not
+known statically: --density sets the fraction of kept pairs (see --graph_stats of the
+training script for the measured value).
+
+    python cost_model.py --n_img 8000 --n_rna 16 --n_cli 8 --epochs 60 --repeat_num 3
+    python cost_model.py --all_data lihc_data.pkl --measure
+'''
+
+FP32 = 4
+
+
+def linear(n, a, b):
+    # flops, params, saved activations (input of the layer)
+    return 2 * n * a * b, a * b + b, n * a
+
+
+def mlp(n, dims):
+    flops, params, act = 0, 0, 0
+    for a, b in zip(dims[:-1], dims[1:]):
+        f, p, s = linear(n, a, b)
+        flops, params, act = flops + f, params + p, act + s
+    # relu outputs between the layers
+    act += n * sum(dims[1:-1])
+    return flops, params, act
+
+
+class stage(object):
+    def __init__(self, name):
+        self.name = name
+        self.flops = 0
+        self.aggr = 0
+        self.params = 0
+        self.act = 0
+
+    def add(self, cost, times=1):
+        self.flops += cost[0] * times
+        self.params += cost[1] * times
+        self.act += cost[2] * times
+        return self
+
+
+def merge_attention_cost(n, d, merge_factor):
+    s = stage('merge_attention')
+    s.add(mlp(n, [d, d // 2, d // 4]), 2)                 # q_linear, k_linear
+    s.flops += 2 * n * n * d // 4 + 2 * n * n * d           # q k^T, sorted_attn^T @ sorted_x
+    s.act += 3 * n * n + 2 * n * d                         # scores, softmax, sorted rows, sorted_x
+    high = (n // merge_factor) // 2 * merge_factor
+    m = high // merge_factor + 1
+    s.add(mlp(high, [d, d // 4, d // 8]))                  # high_reduce_dim
+    s.add(linear(high // merge_factor, d // 8, d))         # high_linear
+    s.add(mlp(m, [d, d // 4, d]))                          # out_linear
+    s.params += 2 * d
+    s.act += 2 * m * d
+    return s, m
+
+
+def dynamic_graph_cost(name, n_q, n_k, d, filtered, filter_factor, density, topology_only=False, shared_q=False, shared_k=False):
+    # topology_only: only the edges are built, the node update does not run
+    # shared_q / shared_k: that side is a linear head on the shared image trunk (img_trunk)
+    s = stage(name)
+    s.add(linear(n_q, d // 2, d // 4) if shared_q else mlp(n_q, [d, d // 2, d // 4]))
+    if filtered:
+        s.add(linear(n_k, d // 2, d // 4) if shared_k else mlp(n_k, [d, d // 2, d // 4]))
+        s.flops += 2 * n_q * n_k * d // 4
+        nodes = n_q + int(n_k * filter_factor) + 1
+    else:
+        if not shared_k:
+            s.params += mlp(n_k, [d, d // 2, d // 4])[1]  # k_linear, not run
+        nodes = n_q
+    s.add(mlp(nodes, [d // 4, d // 8, d // 8]), 2)         # q_linear2, k_linear2
+    s.params += 2 * d
+    if topology_only:
+        s.flops += 2 * nodes * nodes * d // 8
+        s.act += 2 * nodes * nodes
+        s.params += mlp(nodes, [d // 4, d // 2, d])[1]     # out_linear, not run
+        return s, nodes, int(density * nodes * nodes)
+    s.flops += 2 * nodes * nodes * d // 8 + 2 * nodes * nodes * d // 4
+    s.act += 3 * nodes * nodes + nodes * d // 4
+    s.add(mlp(nodes, [d // 4, d // 2, d]))                 # out_linear
+    s.act += 2 * nodes * d
+    return s, nodes, int(density * nodes * nodes)
+
+
+def gnn_cost(name, n, edges, d, c):
+    s = stage(name)
+    s.add(linear(n, d, c), 2)                              # lin_l, lin_r of SAGEConv
+    s.params -= c                                          # lin_r has no bias
+    s.aggr = edges * d
+    s.act += edges + 3 * n * c                             # gathered messages index, relu, norm, dropout
+    s.params += 2 * c
+    return s
+
+
+def pool_cost(name, n, c):
+    s = stage(name)
+    s.add(mlp(n, [c, c // 4, 1]))
+    s.flops += 2 * n * c
+    s.act += 2 * n + n * c
+    return s
+
+
+def block_cost(t, c):
+    f, p, a = 0, 4 * c, 0
+    for cost in [linear(t, c, 3 * c), linear(t, c, c), linear(t, c, 4 * c), linear(t, 4 * c, c)]:
+        f, p, a = f + cost[0], p + cost[1], a + cost[2]
+    p -= 3 * c                                             # qkv has no bias
+    f += 2 * 2 * t * t * c
+    a += 2 * t * t + 4 * t * c
+    return f, p, a
+
+
+def mae_cost(t, c):
+    s = stage('mae')
+    s.add(linear(t, c, c))                                 # patch_embed
+    s.add(block_cost(t, c), 2)                             # encoder and decoder block
+    s.add(linear(t, c, c))                                 # encoder_to_decoder
+    s.params -= c
+    s.add(linear(t, c, c))                                 # decoder head
+    s.params += 2 * 2 * c + c                              # norms, mask_token
+    return s
+
+
+def estimate(in_feats=1024, out_classes=512, train_type_num=5, merge_factor=4, filter_factor=0.4,
+             n_img=4096, n_rna=16, n_cli=8, rna_edges=None, cli_edges=None, density=0.2, raw_feats=None,
+             shared_img_trunk=False):
+    # raw_feats: width of the data when the model projects it to in_feats (in_proj_dim)
+    # shared_img_trunk: the image side projections share one first layer (--shared_img_trunk)
+    d, c = in_feats, out_classes
+    rna_edges = n_rna * (n_rna - 1) if rna_edges is None else rna_edges
+    cli_edges = n_cli * (n_cli - 1) if cli_edges is None else cli_edges
+    stages = []
+
+    if raw_feats is not None:
+        stages.append(stage('in_proj').add(linear(n_img + n_rna + n_cli, raw_feats, d)).add((0, 2 * (raw_feats * d + d), 0)))
+    s, m = merge_attention_cost(n_img, d, merge_factor)
+    stages.append(s)
+    stages.append(stage('merge_linear').add(linear(m, d, d)))
+    # merge loss head, lin1_img / lin2_img parameters are counted in the readout
+    f, _, a = mlp(min(m, 10), [c, c // 4, 1])
+    stages.append(stage('merge_loss').add(linear(min(m, 10), d, c)).add((f, 0, a)))
+
+    if shared_img_trunk:
+        s = stage('img_trunk').add(linear(m, d, d // 2))
+        s.act += m * d // 2                                # relu output
+        stages.append(s)
+    s, img_nodes, img_edges = dynamic_graph_cost('img_dynamic_graph', m, m, d, False, filter_factor, density, topology_only=True,
+                                                 shared_q=shared_img_trunk, shared_k=shared_img_trunk)
+    stages.append(s)
+    s, rna_nodes, img_rna_edges = dynamic_graph_cost('rna_dynamic_graph', n_rna, m, d, True, filter_factor, density, shared_k=shared_img_trunk)
+    stages.append(s)
+    s, cli_nodes, img_cli_edges = dynamic_graph_cost('cli_dynamic_graph', n_cli, m, d, True, filter_factor, density, shared_k=shared_img_trunk)
+    stages.append(s)
+
+    branches = [('img', img_nodes, img_edges), ('imgb', rna_nodes, img_rna_edges), ('imgc', cli_nodes, img_cli_edges),
+                ('rna', n_rna, rna_edges), ('cli', n_cli, cli_edges)]
+    for name, n, e in branches:
+        stages.append(gnn_cost(name + '_gnn_2', n, e, d, c))
+    pools = {'img': ('mpool_img', 'mpool_img_2'), 'imgb': ('mpool_img_b', 'mpool_img_2_b'), 'imgc': ('mpool_img_c', 'mpool_img_2_c'),
+             'rna': ('mpool_rna', 'mpool_rna_2'), 'cli': ('mpool_cli', 'mpool_cli_2')}
+    for name, n, e in branches:
+        for pool in pools[name]:
+            stages.append(pool_cost(pool, n, c))
+    stages.append(mae_cost(train_type_num, c))
+    stages.append(stage('mix').add(mlp(train_type_num, [c, c, c])))
+    readout = stage('readout')
+    readout.add(mlp(1, [c, c // 4, 1]), 5)
+    readout.params += 5 * 2 * (c // 4)
+    stages.append(readout)
+    # imgb/imgc_gnn_2_linear are only used when the rna/cli graph is missing
+    stages.append(stage('unused').add((0, 2 * (c * d + d), 0)))
+    return stages
+
+
+def totals(stages):
+    return {'flops': sum(s.flops for s in stages), 'aggr': sum(s.aggr for s in stages),
+            'params': sum(s.params for s in stages), 'act': sum(s.act for s in stages)}
+
+
+def run_cost(per_patient, n_patients, epochs, folds=5, seeds=3):
+    # per_patient: list of forward flops of every patient
+    f = float(np.mean(per_patient)) * n_patients
+    # the held-out fold is tested, a quarter of the rest validates (train_test_split of the training script)
+    test = 1.0 / folds
+    train, val = (1 - test) * 0.75, (1 - test) * 0.25
+    # training forward + backward (~2x forward), val and test prediction every epoch,
+    # then the fold-end test loop with 1 + 3 single-modality + 3 pairs forwards per patient
+    per_fold = epochs * (3 * train + val + test) * f + (1 + 7) * test * f
+    return per_fold * folds * seeds, per_fold
+
+
+def fmt(x, unit=''):
+    for scale, name in [(1e15, 'P'), (1e12, 'T'), (1e9, 'G'), (1e6, 'M'), (1e3, 'K')]:
+        if abs(x) >= scale:
+            return '{:.2f}{}{}'.format(x / scale, name, unit)
+    return '{:.0f}{}'.format(x, unit)
+
+
+def measure(args, n_img, n_rna, n_cli):
+    import torch
+    from torch.utils.flop_counter import FlopCounterMode
+    from torch_geometric.data import Data
+    from inference_utils import build_model
+
+    model = build_model(args, in_feats=args.in_feats)
+    model.train()
+    model.collect_graph_stats(True)
+
+    def full_graph(n):
+        idx = torch.arange(n)
+        ei = torch.stack([idx.repeat_interleave(n), idx.repeat(n)])
+        return ei[:, ei[0] != ei[1]]
+
+    data = Data(x_img=torch.randn(n_img, args.in_feats), x_rna=torch.randn(n_rna, args.in_feats),
+                x_cli=torch.randn(n_cli, args.in_feats), edge_index_image=torch.zeros((2, 0), dtype=torch.long),
+                edge_index_rna=full_graph(n_rna), edge_index_cli=full_graph(n_cli))
+    data.data_id = 'synthetic'
+    data.data_type = ['img', 'rna', 'cli']
+    saved = {}
+
+    def pack(t):
+        saved[t.untyped_storage().data_ptr()] = t.untyped_storage().nbytes()
+        return t
+
+    counter = FlopCounterMode(display=False)
+    with counter, torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        model(data, args.train_use_type, args.train_use_type, mix=args.mix)
+    flops = {}
+    for name, ops in counter.get_flop_counts().items():
+        parts = name.split('.')
+        if len(parts) == 2:
+            flops[parts[1]] = sum(ops.values())
+    densities = {name: float(g.stats['density']) for name, g in model.dynamic_graphs().items() if g.stats is not None}
+    params = sum(p.numel() for p in model.parameters())
+    return flops, sum(saved.values()), params, densities
+
+
+def get_params():
+    from inference_utils import add_model_args
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n_img", type=int, default=4096, help="image patches per patient")
+    parser.add_argument("--n_rna", type=int, default=16, help="rna nodes per patient")
+    parser.add_argument("--n_cli", type=int, default=8, help="clinical nodes per patient")
+    parser.add_argument("--all_data", type=str, default=None, help="take the node counts of every patient from this all_data")
+    parser.add_argument("--n_patients", type=int, default=None, help="cohort size, defaults to the patients of --all_data")
+    parser.add_argument("--density", type=float, default=0.2, help="edge density of the dynamic graphs")
+    parser.add_argument("--epochs", type=int, default=60, help="epochs per fold")
+    parser.add_argument("--folds", type=int, default=5, help="folds per seed")
+    parser.add_argument("--repeat_num", type=int, default=3, help="seeds")
+    parser.add_argument("--batch_size", type=int, default=32, help="Cox batch size")
+    parser.add_argument("--measure", action='store_true', default=False, help="compare with a measured forward of a synthetic patient")
+    add_model_args(parser)
+    args, _ = parser.parse_known_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = get_params()
+    ex_size = 2 if 'img' in args.train_use_type else 0
+    config = dict(in_feats=args.in_feats if args.in_proj_dim is None else args.in_proj_dim,
+                  raw_feats=None if args.in_proj_dim is None else args.in_feats, out_classes=args.out_classes, train_type_num=len(args.train_use_type) + ex_size,
+                  merge_factor=args.merge_factor, filter_factor=args.filter_factor, density=args.density,
+                  shared_img_trunk=args.shared_img_trunk)
+
+    counts = [(args.n_img, args.n_rna, args.n_cli)]
+    if args.all_data is not None:
+        all_data = joblib.load(args.all_data)
+        counts = [(d.x_img.shape[0], d.x_rna.shape[0], d.x_cli.shape[0]) for d in all_data.values()]
+    n_patients = args.n_patients if args.n_patients is not None else len(counts)
+
+    # the per-stage table is for the median patient
+    median = counts[int(np.argsort([c[0] for c in counts])[len(counts) // 2])]
+    stages = estimate(n_img=median[0], n_rna=median[1], n_cli=median[2], **config)
+    measured = None
+    if args.measure:
+        measured = measure(args, *median)
+
+    print('patient: {} img / {} rna / {} cli nodes'.format(*median))
+    print('{:<20}{:>12}{:>12}{:>12}{:>12}{:>12}'.format('stage', 'flops', 'aggr', 'params', 'act', 'measured'))
+    for s in stages:
+        m = ''
+        if measured is not None and s.name in measured[0]:
+            m = '{} ({:.2f}x)'.format(fmt(measured[0][s.name]), measured[0][s.name] / max(s.flops, 1))
+        print('{:<20}{:>12}{:>12}{:>12}{:>12}{:>12}'.format(s.name, fmt(s.flops), fmt(s.aggr), fmt(s.params),
+                                                            fmt(s.act * FP32, 'B'), m))
+    t = totals(stages)
+    print('total: {} flops forward, {} parameters ({}), {} activations per training patient, {} per Cox batch of {}'.format(
+        fmt(t['flops']), fmt(t['params']), fmt(t['params'] * FP32, 'B'), fmt(t['act'] * FP32, 'B'),
+        fmt(t['act'] * FP32 * args.batch_size, 'B'), args.batch_size))
+    print('optimizer state: {} (params, grads, two Adam moments)'.format(fmt(4 * t['params'] * FP32, 'B')))
+    if measured is not None:
+        flops, saved, params, densities = measured
+        print('measured: {} flops forward, {} parameters, {} saved for backward, densities {}'.format(
+            fmt(sum(flops.values())), fmt(params), fmt(saved, 'B'),
+            ', '.join('{} {:.3f}'.format(k, v) for k, v in densities.items())))
+
+    per_patient = [totals(estimate(n_img=n[0], n_rna=n[1], n_cli=n[2], **config))['flops'] for n in counts]
+    run, per_fold = run_cost(per_patient, n_patients, args.epochs, args.folds, args.repeat_num)
+    print('cross validation: {} flops per fold, {} flops for {} epochs x {} folds x {} seeds'.format(
+        fmt(per_fold), fmt(run), args.epochs, args.folds, args.repeat_num))
@@ -0,0 +1,81 @@
+import torch
+import numpy as np
+from distributed_utils import gather_lists, gather_risks, all_sum
+
+'''
+Per-head accumulator of one Cox batch in train_a_epoch.
+
+Heads: all (fused risk), img, rna, cli (per-modality risks) and merge (the merge loss rows of
+the image tokens, several per patient). Every head keeps its survival times and events in
+preallocated arrays that grow by doubling, and its risks as a list that is concatenated once
+when the batch is closed (cox_inputs), instead of a torch.cat per patient. Training
+predictions stay on the device and are copied to the host in one go per epoch
+(predictions), so the inner loop has no .cpu() syncs. reset() starts the next batch.
+'''
+
+HEADS = ['all', 'img', 'rna', 'cli', 'merge']
+
+
+class cox_batch(object):
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        self.recorded = {h: ([], []) for h in HEADS}
+        self.reset()
+
+    def reset(self):
+        self.times = {h: np.empty(self.capacity) for h in HEADS}
+        self.events = {h: np.empty(self.capacity) for h in HEADS}
+        self.count = {h: 0 for h in HEADS}
+        self.risks = {h: [] for h in HEADS}
+        self.iter = 0
+        self.mse = 0.0
+
+    def add(self, head, risk, time, event, record_id=None):
+        # risk: [rows] or [rows, 1], every row gets time and event
+        rows = risk.shape[0]
+        n = self.count[head]
+        if n + rows > self.times[head].shape[0]:
+            size = max(2 * self.times[head].shape[0], n + rows)
+            self.times[head] = np.resize(self.times[head], size)
+            self.events[head] = np.resize(self.events[head], size)
+        self.times[head][n:n + rows] = time
+        self.events[head][n:n + rows] = event
+        self.count[head] = n + rows
+        self.risks[head].append(risk)
+        if record_id is not None:
+            self.recorded[head][0].append(record_id)
+            self.recorded[head][1].append(risk.detach())
+
+    def gather(self):
+        # the Cox batch is the union of the shards of all ranks
+        lists = {}
+        for h in HEADS:
+            lists['times_' + h] = self.times[h][:self.count[h]].tolist()
+            lists['events_' + h] = self.events[h][:self.count[h]].tolist()
+        g = gather_lists(**lists)
+        for h in HEADS:
+            risk = torch.cat(self.risks[h], dim=0) if len(self.risks[h]) > 0 else None
+            risk = gather_risks(risk)
+            self.risks[h] = [] if risk is None else [risk]
+            self.times[h] = np.asarray(g['times_' + h], dtype=float)
+            self.events[h] = np.asarray(g['events_' + h], dtype=float)
+            self.count[h] = len(self.times[h])
+        self.iter = int(all_sum(self.iter))
+
+    def has_events(self):
+        return self.count['all'] > 0 and np.max(self.events['all'][:self.count['all']]) > 0
+
+    def cox_inputs(self, head):
+        # (risks, times, events) of the batch, risks None when the head has none
+        if len(self.risks[head]) == 0:
+            return None, None, None
+        n = self.count[head]
+        return torch.cat(self.risks[head], dim=0), self.times[head][:n], self.events[head][:n]
+
+    def predictions(self, head):
+        # {id: risk} of everything recorded this epoch, one host copy
+        ids, risks = self.recorded[head]
+        if len(ids) == 0:
+            return {}
+        values = torch.stack([r.reshape(risks[0].shape) for r in risks]).cpu().numpy()
+        return dict(zip(ids, values))
@@ -0,0 +1,205 @@
+import os
+import sys
+import socket
+import argparse
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+'''
+Data parallel training of one fold over several CPU processes or nodes (gloo backend).
+
+    torchrun --nproc_per_node 4 train_a_dynamic_graph_HGCNplus_mergge_loss.py --distributed
+    torchrun --nnodes 2 --node_rank 0 --nproc_per_node 8 --master_addr host0 --master_port 29500 \
+        train_a_dynamic_graph_HGCNplus_mergge_loss.py --distributed
+
+The patients of every Cox batch are split over the ranks. At the end of a batch the risks
+of all ranks are gathered, so every rank computes the partial likelihood over the global
+risk set and holds the same Cox loss. Its gradient w.r.t. the local risks is therefore the
+slice of that loss's gradient belonging to the rank, and summing the parameter gradients
+over the ranks gives the gradient of the global loss. Local terms (the MAE loss) are
+normalised by the global batch size before the sum.
+
+Check that 2 gloo ranks give the gradients of one process on the same Cox batch:
+
+    python distributed_utils.py --check_grads
+'''
+
+
+def init_distributed(args):
+    if not dist.is_initialized():
+        dist.init_process_group(backend='gloo')
+    if args.dist_threads is not None:
+        torch.set_num_threads(args.dist_threads)
+    return dist.get_rank(), dist.get_world_size()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def is_main():
+    return not is_distributed() or dist.get_rank() == 0
+
+
+def shard_schedule(train_data, batch_size, batches=None):
+    # [(id, last of its Cox batch)], a rank without patients in a batch still closes it
+    # batches: explicit Cox batches (bucket_sampler.py) instead of chunks of train_data
+    rank, world = (dist.get_rank(), dist.get_world_size()) if is_distributed() else (0, 1)
+    if batches is None:
+        batches = [train_data[start:start + batch_size] for start in range(0, len(train_data), batch_size)]
+    schedule = []
+    for batch in batches:
+        local = list(batch)[rank::world]
+        if len(local) == 0:
+            schedule.append((None, True))
+            continue
+        schedule += [(id, i == len(local) - 1) for i, id in enumerate(local)]
+    return schedule
+
+
+def shard(ids):
+    # the patients this rank evaluates, the results are merged with gather_dict
+    if not is_distributed():
+        return list(ids)
+    return list(ids)[dist.get_rank()::dist.get_world_size()]
+
+
+def gather_lists(**lists):
+    # concatenates the python lists of every rank in rank order
+    out = [None] * dist.get_world_size()
+    dist.all_gather_object(out, lists)
+    return {k: [x for part in out for x in part[k]] for k in lists}
+
+
+def gather_dict(d):
+    out = [None] * dist.get_world_size()
+    dist.all_gather_object(out, d)
+    merged = {}
+    for part in out:
+        merged.update(part)
+    return merged
+
+
+def all_sum(x):
+    t = torch.tensor(float(x), dtype=torch.float64)
+    dist.all_reduce(t, op=dist.ReduceOp.SUM)
+    return t.item()
+
+
+class _gather_risks(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, pred, sizes):
+        padded = pred.new_zeros((max(sizes),) + tuple(pred.shape[1:]))
+        padded[:pred.shape[0]] = pred
+        out = [torch.empty_like(padded) for _ in sizes]
+        dist.all_gather(out, padded)
+        ctx.start = sum(sizes[:dist.get_rank()])
+        ctx.size = pred.shape[0]
+        return torch.cat([x[:n] for x, n in zip(out, sizes)], dim=0)
+
+    @staticmethod
+    def backward(ctx, grad):
+        # every rank holds the same loss, so no communication is needed here
+        return grad[ctx.start:ctx.start + ctx.size], None
+
+
+def gather_risks(pred):
+    # risks of all ranks along dim 0; None when no rank has any
+    shapes = [None] * dist.get_world_size()
+    dist.all_gather_object(shapes, None if pred is None else tuple(pred.shape))
+    known = [s for s in shapes if s is not None]
+    if len(known) == 0:
+        return None
+    if pred is None:
+        pred = torch.zeros((0,) + tuple(known[0][1:]), requires_grad=True)
+    sizes = [0 if s is None else s[0] for s in shapes]
+    return _gather_risks.apply(pred, sizes)
+
+
+def all_reduce_gradients(model):
+    # sum over the ranks, in the same parameter order everywhere
+    for p in model.parameters():
+        if not p.requires_grad:
+            continue
+        if p.grad is None:
+            p.grad = torch.zeros_like(p)
+        dist.all_reduce(p.grad, op=dist.ReduceOp.SUM)
+
+
+def broadcast_model(model):
+    with torch.no_grad():
+        for t in list(model.parameters()) + list(model.buffers()):
+            dist.broadcast(t, src=0)
+
+
+
+def _check_step(batch):
+    # one Cox batch of train_a_epoch on a linear risk model, sharded when distributed
+    import train_a_dynamic_graph_HGCNplus_mergge_loss as train
+    from cox_batch import cox_batch
+    train.device = torch.device('cpu')
+    torch.manual_seed(0)
+    model = nn.Linear(batch['x'].shape[1], 1)
+    if is_distributed():
+        broadcast_model(model)
+    args = argparse.Namespace(all_cox_loss_factor=1.0, add_mse_loss_of_mae=True, distributed=is_distributed())
+    acc = cox_batch(capacity=len(batch['time']))
+    for i, _ in shard_schedule(list(range(len(batch['time']))), len(batch['time'])):
+        if i is None:
+            continue
+        acc.iter += 1
+        pred = model(batch['x'][i:i + 1])
+        acc.mse += ((pred - batch['x'][i].mean()) ** 2).mean()
+        acc.add('all', pred, batch['time'][i], batch['event'][i])
+    if is_distributed():
+        acc.gather()
+    loss, value = train.cox_batch_loss(acc, 'one', args)
+    loss.backward()
+    if is_distributed():
+        all_reduce_gradients(model)
+    return value, [p.grad.clone() for p in model.parameters()]
+
+
+def _check_worker(rank, world, port, batch, results):
+    os.environ['MASTER_ADDR'] = '127.0.0.1'
+    os.environ['MASTER_PORT'] = str(port)
+    dist.init_process_group(backend='gloo', rank=rank, world_size=world)
+    value, grads = _check_step(batch)
+    results.put((rank, value, grads))
+    dist.barrier()
+    dist.destroy_process_group()
+
+
+def check_gradients(world=2, patients=16, dim=8, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    batch = {'x': torch.randn(patients, dim, generator=g),
+             'time': torch.randint(1, 100, (patients,), generator=g).float().tolist(),
+             'event': (torch.rand(patients, generator=g) < 0.6).float().tolist()}
+    batch['event'][0] = 1.0
+    ref_value, ref_grads = _check_step(batch)
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    ctx = mp.get_context('spawn')
+    results = ctx.SimpleQueue()
+    mp.start_processes(_check_worker, args=(world, port, batch, results), nprocs=world, join=True, start_method='spawn')
+    ok = True
+    for _ in range(world):
+        rank, value, grads = results.get()
+        err = max((a - b).abs().max().item() for a, b in zip(grads, ref_grads))
+        same = abs(value - ref_value) < 1e-5 and all(torch.allclose(a, b, atol=1e-6, rtol=1e-5) for a, b in zip(grads, ref_grads))
+        print('rank {}: loss {:.6f} (single {:.6f}), max grad error {:.2e} {}'.format(rank, value, ref_value, err, 'ok' if same else 'MISMATCH'))
+        ok = ok and same
+    return ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--check_grads", action='store_true', default=False, help="compare the gradients of 2 gloo ranks with one process")
+    parser.add_argument("--world", type=int, default=2)
+    args, _ = parser.parse_known_args()
+    if args.check_grads:
+        sys.exit(0 if check_gradients(world=args.world) else 1)
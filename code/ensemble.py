@@ -0,0 +1,247 @@
+import copy
+import argparse
+import torch
+import numpy as np
+import torch.nn.functional as F
+from torch.func import functional_call, stack_module_state, vmap
+from inference_utils import add_model_args, load_model, device
+
+'''
+Vectorised evaluation of several fusion_model_mae_2 checkpoints (folds x seeds).
+
+The parameters of all members are stacked (torch.func.stack_module_state) and one patient
+is pushed through every member in a single vmapped pass. vmap needs static shapes, so the
+member forward below is a dense re-expression of fusion_model_mae_2.forward: the dynamic
+graphs stay dense 0/1 adjacency matrices instead of going through dense_to_sparse, and the
+SAGEConv mean aggregation is adj^T @ x / in-degree, which is what the scatter computes for
+the same edges. Everything else calls the submodules of the model with functional_call.
+
+Supported: train_use_type containing img, rna and cli (the default), patients with all
+three modalities and use_type == train_use_type, i.e. what prediction() scores.
+
+    python ensemble.py --checkpoints run_0_1.pth ... run_2_5.pth --graphs out_dir/graphs --output risks.csv
+    python ensemble.py --checkpoints ... --graphs lihc_data.pkl --check 5
+'''
+
+
+def sub(params, prefix):
+    n = len(prefix) + 1
+    return {k[n:]: v for k, v in params.items() if k.startswith(prefix + '.')}
+
+
+def dense_adj(edge_index, num_nodes, dtype=torch.float):
+    adj = torch.zeros((num_nodes, num_nodes), dtype=dtype, device=edge_index.device)
+    ones = torch.ones(edge_index.shape[1], dtype=dtype, device=edge_index.device)
+    return adj.index_put_((edge_index[0], edge_index[1]), ones, accumulate=True)
+
+
+def prepare_inputs(model, graph):
+    graph = graph.to(device)
+    x_img = graph.x_img
+    if getattr(graph, 'x_img_codes', None) is not None:
+        x_img = model.feature_decoder.decode(graph.x_img_codes)
+    return {'x_img': x_img, 'x_img_weight': getattr(graph, 'x_img_weight', None), 'x_rna': graph.x_rna, 'x_cli': graph.x_cli,
+            'adj_rna': dense_adj(graph.edge_index_rna, graph.x_rna.shape[0]),
+            'adj_cli': dense_adj(graph.edge_index_cli, graph.x_cli.shape[0])}
+
+
+class member_forward(object):
+    # dense, vmappable fusion_model_mae_2.forward for one set of parameters
+    def __init__(self, model, train_use_type, mix=True):
+        assert all(x in train_use_type for x in ['img', 'rna', 'cli']), 'the ensemble needs img, rna and cli'
+        assert model.coarse_to_fine is None, 'coarse-to-fine bags differ per member and cannot be vmapped'
+        self.model = model
+        self.mix = mix
+        self.train_use_type = ['img', 'imgb', 'imgc'] + list(train_use_type[1:])
+
+    def call(self, params, name, *args):
+        return functional_call(self.model.get_submodule(name), sub(params, name), args)
+
+    def dynamic_graph(self, params, name, q, k, std_factor, topology_only=False):
+        g = self.model.get_submodule(name)
+        q = self.call(params, name + '.q_linear', q)
+        if g.is_filted:
+            k = self.call(params, name + '.k_linear', k)
+            attn = torch.matmul(q, k.transpose(-2, -1)) / (g.dim ** .5)
+            attn = torch.max(attn.softmax(dim=-1), dim=0).values
+            _, sorted_indices = torch.sort(attn, descending=True)
+            index = sorted_indices[:int(sorted_indices.shape[0] * g.filter_factor) + 1]
+            node = torch.cat((q, g.k_weight * k[index]), dim=0)
+        else:
+            node = q
+        q2 = self.call(params, name + '.q_linear2', node)
+        k2 = self.call(params, name + '.k_linear2', node)
+        attn2 = (torch.matmul(q2, k2.transpose(-2, -1)) / (g.dim ** .5)).softmax(dim=0)
+        thresold = attn2.mean() + std_factor * attn2.std()
+        adj = (attn2 > thresold).to(attn2.dtype)
+        if topology_only:
+            return None, adj
+        node = torch.matmul(attn2, node) + node
+        node = self.call(params, name + '.out_linear', node)
+        node = self.call(params, name + '.norm', node)
+        return node, adj
+
+    def sage(self, params, name, x, adj):
+        # mean over the sources j of the edges j -> i, as SAGEConv(aggr='mean')
+        deg = adj.sum(dim=0).clamp(min=1).unsqueeze(-1)
+        agg = torch.matmul(adj.transpose(0, 1), x) / deg
+        return self.call(params, name + '.lin_l', agg) + self.call(params, name + '.lin_r', x)
+
+    def pool(self, params, name, x):
+        gate = self.call(params, name + '.gate_nn', x).view(-1, 1)
+        gate = gate.softmax(dim=0)
+        return torch.sum(gate * x, dim=0, keepdim=True)
+
+    def readout(self, params, x, lin1, norm, lin2):
+        x = self.call(params, lin1, x)
+        x = self.model.relu(x)
+        x = self.call(params, norm, x)
+        x = self.model.dropout(x)
+        return self.call(params, lin2, x).unsqueeze(0)
+
+    def __call__(self, params, inputs, mask=None):
+        if mask is None:
+            mask = np.array([[[False] * len(self.train_use_type)]])
+        else:
+            mask = np.append((mask[0][0][0], mask[0][0][0], mask[0][0][0]), mask[0][0][1:]).reshape([1, 1, 5])
+        out = {}
+
+        x_img, x_rna, x_cli = inputs['x_img'], inputs['x_rna'], inputs['x_cli']
+        if self.model.in_proj is not None:
+            x_img = self.call(params, 'in_proj.img', x_img)
+            x_rna = self.call(params, 'in_proj.rna', x_rna)
+            x_cli = self.call(params, 'in_proj.cli', x_cli)
+        x_img = self.call(params, 'merge_attention', x_img, inputs['x_img_weight'])
+        x_img = self.call(params, 'merge_linear', x_img)
+        loss_img = self.call(params, 'merge_loss_linear', x_img[:10, :])
+        out['loss_img'] = self.readout(params, loss_img, 'lin1_img', 'norm_img', 'lin2_img').squeeze(0)
+
+        k_img = self.call(params, 'img_trunk', x_img) if self.model.img_trunk is not None else x_img
+        _, adj_img = self.dynamic_graph(params, 'img_dynamic_graph', k_img, k_img, params['img_std_factor'], topology_only=True)
+        x_img_cli, adj_img_cli = self.dynamic_graph(params, 'cli_dynamic_graph', x_cli, k_img, params['cli_std_factor'])
+        x_img_rna, adj_img_rna = self.dynamic_graph(params, 'rna_dynamic_graph', x_rna, k_img, params['rna_std_factor'])
+
+        nodes = {
+            'img': self.call(params, 'img_relu_2', self.sage(params, 'img_gnn_2', x_img, adj_img)),
+            'imgb': self.call(params, 'imgb_relu_2', self.sage(params, 'imgb_gnn_2', x_img_rna, adj_img_rna)),
+            'imgc': self.call(params, 'imgc_relu_2', self.sage(params, 'imgc_gnn_2', x_img_cli, adj_img_cli)),
+            'rna': self.call(params, 'rna_relu_2', self.sage(params, 'rna_gnn_2', x_rna, inputs['adj_rna'])),
+            'cli': self.call(params, 'cli_relu_2', self.sage(params, 'cli_gnn_2', x_cli, inputs['adj_cli'])),
+        }
+        pools = {'img': ('mpool_img', 'mpool_img_2'), 'imgb': ('mpool_img_b', 'mpool_img_2_b'),
+                 'imgc': ('mpool_img_c', 'mpool_img_2_c'), 'rna': ('mpool_rna', 'mpool_rna_2'), 'cli': ('mpool_cli', 'mpool_cli_2')}
+        types = self.train_use_type
+        pool_x = torch.cat([self.pool(params, pools[t][0], nodes[t]) for t in types], dim=0)
+        out['mae_labels'] = pool_x
+
+        mae_x = self.call(params, 'mae', pool_x, mask).squeeze(0)
+        out['mae_out'] = mae_x
+        if self.mix:
+            mae_x = self.call(params, 'mix', mae_x)
+        pool_x = torch.cat([self.pool(params, pools[t][1], nodes[t] + mae_x[i]) for i, t in enumerate(types)], dim=0)
+        x = F.normalize(pool_x + out['mae_labels'], dim=1)
+        out['fea'] = x
+
+        # the readout heads as in fusion_model_mae_2.forward, including its choice of layers
+        heads = {'img': ('lin1_img', 'norm_img', 'lin2_img'), 'imgb': ('lin1_imgb', 'norm_imgb', 'lin2_imgb'),
+                 'imgc': ('lin1_imgc', 'norm_img', 'lin2_img'), 'rna': ('lin1_rna', 'norm_rna', 'lin2_rna'),
+                 'cli': ('lin1_cli', 'norm_cli', 'lin2_rna')}
+        multi_x = torch.cat([self.readout(params, x[i], *heads[t]) for i, t in enumerate(types)], dim=0)
+        d_x = torch.cat((torch.mean(multi_x[:3, :]).reshape([1, -1]), multi_x[3:]), 0)
+        out['one_x'] = torch.mean(d_x, dim=0)
+        out['multi_x'] = torch.cat((torch.mean(multi_x[:3], dim=0).unsqueeze(0), multi_x[3:]), dim=0)
+        out['multi_x_all'] = multi_x
+        return out
+
+
+def check_compatible(models):
+    shapes = [{k: v.shape for k, v in m.state_dict().items()} for m in models]
+    for s in shapes[1:]:
+        if s != shapes[0]:
+            raise ValueError('checkpoints of different model configurations cannot be stacked')
+
+
+class vmap_ensemble(object):
+    def __init__(self, models, args, chunk_size=None):
+        check_compatible(models)
+        params, buffers = stack_module_state(models)
+        self.params = {k: v.detach() for k, v in list(params.items()) + list(buffers.items())}
+        # the parameters of models[0] are swapped out by functional_call, it only provides the structure
+        self.base = copy.deepcopy(models[0]).eval()
+        self.forward = member_forward(self.base, args.train_use_type, mix=args.mix)
+        self.chunk_size = chunk_size
+        self.num_members = len(models)
+
+    def score(self, graph):
+        inputs = prepare_inputs(self.base, graph)
+
+        def risks(p):
+            out = self.forward(p, inputs)
+            return out['one_x'].reshape(-1), out['multi_x'].reshape(-1)
+
+        with torch.no_grad():
+            one_x, multi_x = vmap(risks, chunk_size=self.chunk_size)(self.params)
+        one_x = one_x[:, 0]
+        return {'mean': one_x.mean(), 'var': one_x.var(unbiased=False), 'members': one_x,
+                'modality_mean': multi_x.mean(dim=0), 'modality_var': multi_x.var(dim=0, unbiased=False),
+                'modality_members': multi_x}
+
+
+def check(ensemble, models, graphs, args):
+    # largest difference between the vmapped members and the plain per-model forward
+    worst = 0.0
+    for graph in graphs:
+        res = ensemble.score(graph)
+        with torch.no_grad():
+            ref = torch.stack([m(graph.to(device), args.train_use_type, args.train_use_type, mix=args.mix)[0][0].reshape(-1)[0]
+                               for m in models])
+        diff = (res['members'] - ref).abs().max().item()
+        worst = max(worst, diff)
+        print('{}: max |vmap - model| = {:.2e}'.format(getattr(graph, 'data_id', ''), diff))
+    print('worst difference: {:.2e}'.format(worst))
+    return worst
+
+
+def get_params():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checkpoints", type=str, nargs='+', required=True, help="state_dict files of the members")
+    parser.add_argument("--graphs", type=str, required=True, help="directory of <patient_id>.pt graphs or a joblib all_data")
+    parser.add_argument("--output", type=str, default=None, help="csv output")
+    parser.add_argument("--chunk_members", type=int, default=None, help="members evaluated together, bounds memory")
+    parser.add_argument("--check", type=int, default=0, help="compare the first N patients with the per-model forward")
+    add_model_args(parser)
+    args, _ = parser.parse_known_args()
+    return args
+
+
+if __name__ == '__main__':
+    from bulk_score import iter_graphs, iter_chunks, csv_sink
+    args = get_params()
+    models = [load_model(path, args) for path in args.checkpoints]
+    ensemble = vmap_ensemble(models, args, chunk_size=args.chunk_members)
+    if args.check > 0:
+        graphs = []
+        for graph in iter_graphs(args.graphs):
+            graphs.append(graph)
+            if len(graphs) == args.check:
+                break
+        check(ensemble, models, graphs, args)
+    if args.output is not None:
+        names = [x for x in ['img', 'rna', 'cli'] if x in args.train_use_type]
+        sink = csv_sink(args.output)
+        for chunk in iter_chunks(iter_graphs(args.graphs), 64):
+            rows = []
+            for graph in chunk:
+                res = ensemble.score(graph)
+                members = res['members'].cpu().numpy()
+                row = {'patient': str(graph.data_id), 'mean': float(members.mean()), 'var': float(members.var())}
+                mod_mean = res['modality_mean'].cpu().numpy()
+                mod_var = res['modality_var'].cpu().numpy()
+                for i, name in enumerate(names):
+                    row[name + '_mean'] = float(mod_mean[i])
+                    row[name + '_var'] = float(mod_var[i])
+                for i, v in enumerate(members):
+                    row['member_{}'.format(i)] = float(v)
+                rows.append(row)
+            sink.write(rows)
+        sink.close()
@@ -0,0 +1,302 @@
+import copy
+import joblib
+import torch
+import numpy as np
+import time as sys_time
+from torch.optim import Adam
+from torch.func import stack_module_state, vmap
+from sklearn.model_selection import StratifiedKFold, train_test_split
+from util import get_patients_information, get_val_ci, adjust_learning_rate
+from mae_utils import generate_mask
+from inference_utils import build_model
+from pq_features import load_quantizer, compress_all_data
+from memory_tuner import cap_patches
+from shared_store import load_store
+from ensemble import member_forward, prepare_inputs
+import train_a_dynamic_graph_HGCNplus_mergge_loss as train_script
+
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+'''
+Trains the 5 fold models of a seed together in one process (--vmap_folds).
+
+The fold models are stacked with stack_module_state and advanced in lock step: every
+training patient of any fold is pushed once with vmap (the dense member forward of
+ensemble.py) through the members whose training split holds it (about 3 of 5), and a
+per-fold mask says which members it trains. The Cox losses are computed per fold over its
+own patients of the batch, so the folds stay independent; Adam is elementwise, so one
+optimizer over the stacked parameters behaves like K separate ones.
+
+Differences to the per-fold loop of main(): a Cox batch is a slice of the union of the
+training patients, sized so that every fold sees about --batch_size of its own patients,
+and the Adam step counter is shared, so a fold that skips a batch still advances its bias
+correction. Validation/test prediction runs a patient through the members that validate or
+test on it. The options of main() that have no vmapped counterpart are rejected (see
+UNSUPPORTED).
+'''
+
+# options of the per-fold loop of main() that this mode does not implement
+UNSUPPORTED = {'topology_refresh': None, 'csr_adj': False, 'distributed': False,
+               'freeze_front_epoch': None, 'bucket_batches': False, 'graph_stats': False, 'density_alarm': None,
+               'mem_budget_gb': None}
+
+
+def check_args(args):
+    bad = ['--' + name for name, default in UNSUPPORTED.items() if getattr(args, name, default) != default]
+    if len(bad) > 0:
+        raise ValueError('--vmap_folds does not support {}'.format(', '.join(bad)))
+
+
+def scatter_members(t, members, K):
+    # [len(members), ...] outputs of some members to [K, ...], zero for the others
+    return t.new_zeros((K,) + tuple(t.shape[1:])).index_copy(0, members, t)
+
+
+def masked_cox_loss(pred, T, E, member):
+    # pred [K, B], member [K, B]: _neg_partial_log of every fold over its own patients
+    T = torch.as_tensor(np.asarray(T), dtype=torch.float, device=pred.device)
+    E = torch.as_tensor(np.asarray(E), dtype=torch.float, device=pred.device)
+    R = (T.unsqueeze(0) >= T.unsqueeze(1)).float()
+    risk = torch.sum(torch.exp(pred).unsqueeze(1) * R.unsqueeze(0) * member.unsqueeze(1), dim=2)
+    # the risk set of a patient outside the fold may be empty, its term is masked anyway
+    risk = risk + (1 - member)
+    term = (pred - torch.log(risk)) * E.unsqueeze(0) * member
+    count = member.sum(dim=1)
+    has_event = (member * E.unsqueeze(0)).sum(dim=1) > 0
+    loss = -term.sum(dim=1) / count.clamp(min=1)
+    return torch.where(has_event, loss, torch.zeros_like(loss)), has_event
+
+
+def make_folds(patients, kf_label, patient_sur_type, seed, args, seed_fit_split):
+    folds = []
+    kf = StratifiedKFold(n_splits=5, shuffle=True, random_state=seed)
+    for n_fold, (train_index, test_index) in enumerate(kf.split(patients, kf_label)):
+        if args.if_fit_split:
+            folds.append(tuple(seed_fit_split[n_fold][:3]))
+            continue
+        t_train_data = np.array(patients)[train_index]
+        t_l = [patient_sur_type[x] for x in t_train_data]
+        train_data, val_data, _, _ = train_test_split(t_train_data, t_train_data, test_size=0.25, random_state=1, stratify=t_l)
+        folds.append((train_data, val_data, np.array(patients)[test_index]))
+    return folds
+
+
+class stacked_folds(object):
+    def __init__(self, models, args):
+        self.models = models
+        params, buffers = stack_module_state(models)
+        self.params = dict(params)
+        self.params.update(buffers)
+        self.base = copy.deepcopy(models[0])
+        self.forward = member_forward(self.base, args.train_use_type, mix=args.mix)
+        self.args = args
+
+    def subset(self, members):
+        # stacked parameters of some members, the gradients flow back into self.params
+        if len(members) == len(self.models):
+            return self.params
+        return {name: p[members] for name, p in self.params.items()}
+
+    def run(self, graph, mask=None, training=True, params=None):
+        # params: a subset of the members (subset), all by default
+        self.base.train(training)
+        params = self.params if params is None else params
+        inputs = prepare_inputs(self.base, graph)
+
+        def member(p):
+            out = self.forward(p, inputs, mask)
+            return out['one_x'].reshape(-1), out['multi_x'].reshape(-1), out['loss_img'].reshape(-1), out['mae_out'], out['mae_labels']
+
+        return vmap(member, randomness='different' if training else 'error')(params)
+
+    def step(self, optimizer, skipped):
+        # Adam and weight decay would still move a fold without events in its batch
+        if len(skipped) == 0:
+            optimizer.step()
+            return
+        params = [p for group in optimizer.param_groups for p in group['params']]
+        with torch.no_grad():
+            keep = [(p[skipped].clone(), {k: v[skipped].clone() for k, v in optimizer.state[p].items() if k != 'step'})
+                    for p in params]
+        optimizer.step()
+        with torch.no_grad():
+            for p, (value, state) in zip(params, keep):
+                p[skipped] = value
+                for k, v in state.items():
+                    optimizer.state[p][k][skipped] = v
+
+    def snapshot(self, k):
+        return {name: p[k].detach().clone() for name, p in self.params.items()}
+
+    def export(self, k, snapshot):
+        # writes member k back into its own model, shared parameters are aliased there
+        model = self.models[k]
+        with torch.no_grad():
+            for name, p in list(model.named_parameters()) + list(model.named_buffers()):
+                p.copy_(snapshot[name])
+        return model
+
+
+def train_a_epoch_vmap(folds, train_sets, union, all_data, patient_and_time, patient_sur_type, optimizer, epoch, args):
+    K = len(train_sets)
+    batches = 0
+    members = torch.tensor([[id in s for id in union] for s in train_sets], dtype=torch.float, device=device)
+    # a slice of the union holding about batch_size training patients of every fold
+    step = max(1, int(round(args.batch_size * len(union) / np.mean([len(s) for s in train_sets]))))
+    all_loss = torch.zeros(K)
+    train_pre_time = [{} for _ in range(K)]
+
+    for start in range(0, len(union), step):
+        ids = union[start:start + step]
+        member = members[:, start:start + step]
+        one_x, multi_x, merge_x, merge_t, merge_e, mse_terms = [], [], [], [], [], []
+        T = [patient_and_time[id] for id in ids]
+        E = [patient_sur_type[id] for id in ids]
+        # one parameter subset per membership pattern of the batch
+        subsets = {}
+        for j, id in enumerate(ids):
+            mask = generate_mask(num=len(args.train_use_type))
+            # only the folds training on this patient
+            idx = torch.nonzero(member[:, j]).reshape(-1)
+            key = tuple(idx.tolist())
+            if key not in subsets:
+                subsets[key] = folds.subset(idx)
+            outs = folds.run(all_data[id], mask, training=True, params=subsets[key])
+            o, m, merge, mae_out, mae_labels = [scatter_members(t, idx, K) for t in outs]
+            one_x.append(o[:, 0])
+            multi_x.append(m)
+            merge_x.append(merge)
+            merge_t += [patient_and_time[id]] * merge.shape[1]
+            merge_e += [patient_sur_type[id]] * merge.shape[1]
+            if args.add_mse_loss_of_mae:
+                # the masked tokens, with img expanded to img/imgb/imgc as in the model
+                sel = torch.as_tensor(np.append((mask[0][0][0],) * 3, mask[0][0][1:]), device=device)
+                mse_terms.append(((mae_out[:, sel] - mae_labels[:, sel]) ** 2).mean(dim=(1, 2)))
+        one_x = torch.stack(one_x, dim=1)
+        multi_x = torch.stack(multi_x, dim=1)
+        for k in range(K):
+            for j, id in enumerate(ids):
+                if member[k, j] > 0:
+                    train_pre_time[k][id] = one_x[k, j].detach().cpu().numpy()
+
+        if args.format_of_coxloss == 'one':
+            loss, has_event = masked_cox_loss(one_x, T, E, member)
+            loss = args.all_cox_loss_factor * loss
+        else:
+            factors = {'img': args.img_cox_loss_factor, 'rna': args.rna_cox_loss_factor, 'cli': args.cli_cox_loss_factor}
+            loss = 0
+            for i, name in enumerate(args.train_use_type):
+                l, has_event = masked_cox_loss(multi_x[:, :, i], T, E, member)
+                loss = loss + factors[name] * l
+            merge_member = torch.cat([member[:, j:j + 1].expand(-1, x.shape[1]) for j, x in enumerate(merge_x)], dim=1)
+            l, _ = masked_cox_loss(torch.cat(merge_x, dim=1), merge_t, merge_e, merge_member)
+            loss = loss + args.img_cox_loss_factor * l
+        if args.add_mse_loss_of_mae:
+            mse_terms = torch.stack(mse_terms, dim=1)
+            loss = loss + args.mse_loss_of_mae_factor * (mse_terms * member).sum(dim=1) / member.sum(dim=1).clamp(min=1)
+        # batches without events of a fold are skipped for that fold, as in train_a_epoch
+        if not bool(has_event.any()):
+            continue
+        loss = torch.where(has_event, loss, torch.zeros_like(loss))
+
+        optimizer.zero_grad()
+        loss.sum().backward()
+        if epoch == 0:
+            print('*', end='')
+        else:
+            folds.step(optimizer, torch.nonzero(~has_event).reshape(-1))
+        all_loss += loss.detach().cpu()
+        batches += 1
+
+    t_train_ci = [get_val_ci(train_pre_time[k], patient_and_time, patient_sur_type) for k in range(K)]
+    return (all_loss / max(batches, 1)).tolist(), t_train_ci
+
+
+def predict_all(folds, ids, all_data, fold_split):
+    # pred[id][k] for the folds k that validate or test on id, nan for the others
+    pred = {}
+    K = len(fold_split)
+    with torch.no_grad():
+        for id in ids:
+            ks = [k for k, (_, val_data, test_data) in enumerate(fold_split) if id in val_data or id in test_data]
+            idx = torch.tensor(ks, device=device)
+            o, _, _, _, _ = folds.run(all_data[id], training=False, params=folds.subset(idx))
+            pred[id] = np.full(K, np.nan, dtype=np.float32)
+            pred[id][ks] = o[:, 0].cpu().numpy()
+    return pred
+
+
+def main_vmap(args):
+    check_args(args)
+    cancer_type = args.cancer_type
+    prefix = train_script.root_path + cancer_type + '/' + cancer_type
+    patients = joblib.load(prefix + train_script.patients_path_end)
+    sur_and_time = joblib.load(prefix + train_script.sur_and_time_path_end)
+    all_data = load_store(args.shared_store) if args.shared_store is not None else joblib.load(prefix + train_script.all_data_path_end)
+    seed_fit_split = joblib.load(prefix + train_script.seed_fit_splite_path_end)
+    pq = None
+    if args.pq_codebook is not None:
+        pq = load_quantizer(args.pq_codebook).to(device)
+        if args.shared_store is None:
+            all_data = compress_all_data(all_data, pq)
+    if args.max_patches is not None:
+        all_data = {id: cap_patches(data, args.max_patches) for id, data in all_data.items()}
+    patient_sur_type, patient_and_time, kf_label = get_patients_information(patients, sur_and_time)
+    label = "{}_{}_lr_{}_{}_coxloss_vmap_folds".format(cancer_type, args.details, args.lr, args.format_of_coxloss)
+
+    all_fold_test_ci = []
+    for seed in range(args.start_seed, args.start_seed + args.repeat_num):
+        train_script.setup_seed(0)
+        fold_split = make_folds(patients, kf_label, patient_sur_type, seed, args, seed_fit_split)
+        models = [build_model(args).to(device) for _ in fold_split]
+        for model in models:
+            if pq is not None:
+                model.set_feature_decoder(pq)
+        folds = stacked_folds(models, args)
+        optimizer = Adam([p for p in folds.params.values() if p.requires_grad], lr=args.lr, weight_decay=5e-4)
+
+        train_sets = [set(f[0]) for f in fold_split]
+        union = [id for id in patients if any(id in s for s in train_sets)]
+        eval_ids = [id for id in patients if any(id in f[1] or id in f[2] for f in fold_split)]
+        best_val_ci = [0] * len(fold_split)
+        best = [None] * len(fold_split)
+
+        for epoch in range(args.epochs):
+            if args.if_adjust_lr:
+                adjust_learning_rate(optimizer, args.lr, epoch, lr_step=20, lr_gamma=args.adjust_lr_ratio)
+            all_loss, t_train_ci = train_a_epoch_vmap(folds, train_sets, union, all_data,
+                                                      patient_and_time, patient_sur_type, optimizer, epoch, args)
+            pred = predict_all(folds, eval_ids, all_data, fold_split)
+            for k, (_, val_data, test_data) in enumerate(fold_split):
+                val_ci = get_val_ci({id: pred[id][k] for id in val_data}, patient_and_time, patient_sur_type)
+                test_ci = get_val_ci({id: pred[id][k] for id in test_data}, patient_and_time, patient_sur_type)
+                if val_ci >= best_val_ci[k] and epoch > 1:
+                    best_val_ci[k] = val_ci
+                    best[k] = folds.snapshot(k)
+                print("epoch：{:2d}，fold：{}，train_loos：{:.4f},train_ci：{:.4f},val_ci：{:.4f},test_ci：{:.5f}".format(
+                    epoch, k + 1, all_loss[k], t_train_ci[k], val_ci, test_ci))
+
+        test_fold_ci = []
+        gnn_time = {}
+        each_model_time = {'img': {}, 'rna': {}, 'cli': {}, 'imgrna': {}, 'imgcli': {}, 'rnacli': {}}
+        test_each_model_ci = {'img': [], 'rna': [], 'cli': [], 'imgrna': [], 'imgcli': [], 'rnacli': []}
+        for k, (_, _, test_data) in enumerate(fold_split):
+            t_model = folds.export(k, best[k] if best[k] is not None else folds.snapshot(k))
+            t_model.eval()
+            test_ci = train_script.test_each_model(t_model, test_data, all_data, patient_and_time, patient_sur_type, args,
+                                                   gnn_time, each_model_time, test_each_model_ci)
+            test_fold_ci.append(test_ci)
+            torch.save(t_model.state_dict(), train_script.save_path + sys_time.strftime('%Y-%m-%d') + label + '_' + str(seed) + '_' + str(k + 1) + '.pth')
+        print('seed: ', seed)
+        print('test fold ci:')
+        for x in test_fold_ci:
+            print(x)
+        for type_name, cis in test_each_model_ci.items():
+            print(type_name, ' ci:', cis)
+        all_fold_test_ci.append(test_fold_ci)
+
+    test_ci_ = np.array(all_fold_test_ci).reshape(-1)
+    print('summary :')
+    print(label)
+    print('total means + std: ', np.mean(test_ci_), '+', np.std(test_ci_))
+    return all_fold_test_ci
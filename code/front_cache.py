@@ -0,0 +1,109 @@
+import os
+import hashlib
+import torch
+
+'''
+Staged training: after a warm-up the front half of fusion_model_mae_2 (merge_attention, the
+dynamic graphs, the SAGEConv branches and the first pooling, see forward_front) is frozen
+and its per-patient outputs are cached, so later epochs only run mae, mix, the second
+pooling and the readout heads.
+
+    python train_a_dynamic_graph_HGCNplus_mergge_loss.py --freeze_front_epoch 20 [--front_cache_dir /scratch/front]
+
+The node features of every branch are cached as well as the pooled embeddings (mae_labels),
+because the second pooling runs over the nodes. Cached outputs are computed in eval mode, so
+the dropout of the front half is off once it is frozen. Entries are keyed by a hash of the
+frozen weights: when they change the cache is dropped (and a new directory is used on disk).
+With --c2f_budget the refined bag is selected once per entry, so the coarse pass does not
+run again on a cache hit.
+'''
+
+
+def _map(obj, fn):
+    if torch.is_tensor(obj):
+        return fn(obj)
+    if isinstance(obj, dict):
+        return {k: _map(v, fn) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_map(v, fn) for v in obj)
+    return obj
+
+
+class frozen_front_cache(object):
+    def __init__(self, cache_dir=None, in_memory=True, storage='cpu'):
+        self.cache_dir = cache_dir
+        self.in_memory = in_memory
+        self.storage = storage
+        self.entries = {}
+        self.key = None
+        self.hits = 0
+        self.misses = 0
+
+    def __deepcopy__(self, memo):
+        # copies of the model (best epoch snapshots) share the cache, the key guards it
+        return self
+
+    def fingerprint(self, model):
+        h = hashlib.sha1()
+        for name, module in model.front_modules().items():
+            for pname, p in module.state_dict().items():
+                h.update((name + '.' + pname).encode())
+                h.update(p.detach().cpu().contiguous().numpy().tobytes())
+        return h.hexdigest()[:16]
+
+    def validate(self, model):
+        # call once per epoch: drops the entries when the frozen weights have changed
+        for module in model.front_modules().values():
+            if any(p.requires_grad for p in module.parameters()):
+                raise ValueError('the front half must be frozen (freeze_front) to be cached')
+        key = self.fingerprint(model)
+        if key == self.key:
+            return True
+        self.key = key
+        self.entries = {}
+        if self.cache_dir is not None:
+            os.makedirs(os.path.join(self.cache_dir, key), exist_ok=True)
+        return False
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, self.key, '{}_{}.pt'.format(key[0], '-'.join(key[1])))
+
+    def compute(self, model, data, data_type):
+        training = model.training
+        model.eval()
+        with torch.no_grad():
+            # the coarse-to-fine selection only depends on the frozen modules
+            if model.coarse_to_fine is not None and 'img' in data_type and getattr(data, 'pos_img', None) is not None:
+                data = model.coarse_to_fine(model, data)
+            front = model.forward_front(data, data_type)
+        model.train(training)
+        return _map(front, lambda t: t.to(self.storage))
+
+    def fetch(self, model, data, data_type):
+        if self.key is None:
+            self.validate(model)
+        key = (str(data.data_id), tuple(data_type))
+        front = self.entries.get(key)
+        if front is None and self.cache_dir is not None and os.path.exists(self.path(key)):
+            front = torch.load(self.path(key), map_location=self.storage)
+        if front is None:
+            self.misses += 1
+            front = self.compute(model, data, data_type)
+            if self.cache_dir is not None:
+                torch.save(front, self.path(key))
+        else:
+            self.hits += 1
+        if self.in_memory:
+            self.entries[key] = front
+        device = next(model.parameters()).device
+        return _map(front, lambda t: t.to(device))
+
+    def precompute(self, model, all_data, ids, use_type):
+        if 'img' in use_type:
+            use_type = ['img', 'imgb', 'imgc'] + list(use_type[1:])
+        for id in ids:
+            self.fetch(model, all_data[id], use_type)
+
+    def summary(self):
+        return 'front cache: {} entries, {} hits, {} misses'.format(len(self.entries), self.hits, self.misses)
+
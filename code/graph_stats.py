@@ -0,0 +1,123 @@
+import torch
+import numpy as np
+
+STAT_NAMES = ['nodes', 'edges', 'density', 'deg_mean', 'deg_std', 'deg_min', 'deg_max', 'isolated', 'threshold']
+
+
+class graph_density_monitor(object):
+    """Per-patient and per-epoch statistics of the img/cli/rna dynamic graphs.
+
+    The dynamic_graph modules keep the stats of the graph they built last (see
+    dynamic_graph.graph_stats); record() moves them to the host with one sync per
+    graph and epoch_summary() aggregates everything recorded since start_epoch().
+    Graphs taken from the topology or front cache build nothing, so the hits of
+    both caches are counted as well.
+    """
+    def __init__(self, model, density_alarm=None, on_alarm=None):
+        self.model = model
+        self.graphs = model.dynamic_graphs()
+        self.density_alarm = density_alarm
+        self.on_alarm = on_alarm
+        self.records = {name: {} for name in self.graphs}
+        self.alarms = []
+        self.history = []
+        self.epoch = 0
+        self.cache_start = {}
+        model.collect_graph_stats(True)
+
+    def cache_counts(self):
+        # (hits, misses) of the caches so far; all dynamic graphs share one topology cache
+        counts = {}
+        topology = self.graphs['img'].topology
+        if topology is not None:
+            counts['topology'] = (topology.hits, topology.misses)
+        if self.model.front_cache is not None:
+            counts['front'] = (self.model.front_cache.hits, self.model.front_cache.misses)
+        return counts
+
+    def start_epoch(self):
+        # the stats left by the last evaluation forward are not part of this epoch
+        for graph in self.graphs.values():
+            graph.stats = None
+        self.cache_start = self.cache_counts()
+
+    def record(self, patient_id):
+        for name, graph in self.graphs.items():
+            if graph.stats is None:
+                continue
+            values = torch.stack([graph.stats[x] for x in STAT_NAMES]).cpu().tolist()
+            graph.stats = None
+            stats = dict(zip(STAT_NAMES, values))
+            self.records[name][patient_id] = stats
+            if self.density_alarm is not None and stats['density'] > self.density_alarm:
+                self.alarm(name, patient_id, stats)
+
+    def alarm(self, name, patient_id, stats):
+        self.alarms.append((self.epoch, name, patient_id, stats['density']))
+        if self.on_alarm is not None:
+            self.on_alarm(name, patient_id, stats)
+        else:
+            print('[graph_stats] epoch {} {} graph of {}: density {:.4f} > {} ({} nodes, {} edges, threshold {:.5f})'.format(
+                self.epoch, name, patient_id, stats['density'], self.density_alarm,
+                int(stats['nodes']), int(stats['edges']), stats['threshold']))
+
+    def epoch_summary(self):
+        summary = {'epoch': self.epoch}
+        for name, records in self.records.items():
+            if len(records) == 0:
+                continue
+            table = np.array([[r[x] for x in STAT_NAMES] for r in records.values()])
+            col = {x: table[:, i] for i, x in enumerate(STAT_NAMES)}
+            summary[name] = {
+                'patients': len(records),
+                'nodes_mean': col['nodes'].mean(),
+                'nodes_max': col['nodes'].max(),
+                'edges_mean': col['edges'].mean(),
+                'edges_max': col['edges'].max(),
+                'edges_total': col['edges'].sum(),
+                'density_mean': col['density'].mean(),
+                'density_p50': np.percentile(col['density'], 50),
+                'density_p95': np.percentile(col['density'], 95),
+                'density_max': col['density'].max(),
+                'deg_mean': col['deg_mean'].mean(),
+                'deg_std': col['deg_std'].mean(),
+                'deg_max': col['deg_max'].max(),
+                'isolated_frac': (col['isolated'] / col['nodes']).mean(),
+                'threshold_mean': col['threshold'].mean(),
+                'threshold_min': col['threshold'].min(),
+                'threshold_max': col['threshold'].max(),
+                'alarms': sum(1 for a in self.alarms if a[0] == self.epoch and a[1] == name),
+            }
+        caches = {}
+        for name, (hits, misses) in self.cache_counts().items():
+            start = self.cache_start.get(name, (0, 0))
+            caches[name] = {'hits': hits - start[0], 'misses': misses - start[1]}
+        if len(caches) > 0:
+            summary['caches'] = caches
+        return summary
+
+    def end_epoch(self):
+        summary = self.epoch_summary()
+        self.history.append(summary)
+        self.records = {name: {} for name in self.graphs}
+        self.epoch += 1
+        return summary
+
+
+def format_summary(summary):
+    lines = []
+    for name in ['img', 'cli', 'rna']:
+        if name not in summary:
+            continue
+        s = summary[name]
+        lines.append('[graph_stats] epoch {} {}: nodes {:.1f} (max {:.0f}), edges {:.1f} (max {:.0f}), '
+                     'density {:.4f} (p95 {:.4f}, max {:.4f}), degree {:.2f}+-{:.2f} (max {:.0f}), '
+                     'isolated {:.3f}, threshold {:.5f} [{:.5f}, {:.5f}], alarms {}'.format(
+                         summary['epoch'], name, s['nodes_mean'], s['nodes_max'], s['edges_mean'], s['edges_max'],
+                         s['density_mean'], s['density_p95'], s['density_max'], s['deg_mean'], s['deg_std'],
+                         s['deg_max'], s['isolated_frac'], s['threshold_mean'], s['threshold_min'],
+                         s['threshold_max'], s['alarms']))
+    if 'caches' in summary:
+        lines.append('[graph_stats] epoch {} caches: '.format(summary['epoch']) + ', '.join(
+            '{} {} hits / {} misses'.format(name, c['hits'], c['misses']) for name, c in summary['caches'].items()))
+    return '\n'.join(lines)
@@ -0,0 +1,130 @@
+import torch
+from a_dynamic_graph_model_HGCNplus_merge_loss import fusion_model_mae_2
+from coarse_to_fine import coarse_to_fine
+from memory_tuner import num_patches
+from partitioned_gnn import partitioned_runner
+
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+
+def add_model_args(parser):
+    # the model arguments of the training script, needed to rebuild a saved model
+    parser.add_argument("--train_use_type", type=list, default=['img','rna','cli'], help='train_use_type,Please keep the relative order of img, rna, cli')
+    parser.add_argument("--drop_out_ratio", type=float, default=0.5, help="Drop_out_ratio")
+    parser.add_argument("--n_hidden", type=int, default=512, help="Model middle dimension")
+    parser.add_argument("--out_classes", type=int, default=512, help="Model out dimension")
+    parser.add_argument("--mix", action='store_true', default=True, help="mix mae")
+    parser.add_argument("--k_weight_rna",type=float, default=1.0, help="k_weight_rna")
+    parser.add_argument("--k_weight_cli",type=float, default=1.0, help="k_weight_cli")
+    parser.add_argument("--img_std_factor",type=float, default=.4, help="img_std_factor")
+    parser.add_argument("--rna_std_factor",type=float, default=.4, help="rna_std_factor")
+    parser.add_argument("--cli_std_factor",type=float, default=.4, help="cli_std_factor")
+    parser.add_argument("--merge_factor",type=int, default=4, help="patches merged per token by merge_attention")
+    parser.add_argument("--filter_factor",type=float, default=.4, help="share of image tokens kept by the rna/cli dynamic graphs")
+    parser.add_argument("--in_feats", type=int, default=1024, help="input feature width (lower after input_reduction.py)")
+    parser.add_argument("--in_proj_dim", type=int, default=None, help="learned per-modality projection of the inputs to this width")
+    parser.add_argument("--shared_img_trunk", action='store_true', default=False, help="one shared first layer for the image side q/k projections of the dynamic graphs")
+    parser.add_argument("--c2f_budget",type=int, default=None, help="coarse-to-fine: full resolution patches per slide (coarse_to_fine.py)")
+    parser.add_argument("--c2f_cell",type=int, default=8, help="coarse-to-fine: cell side in patches")
+    parser.add_argument("--partition_parts",type=int, default=None, help="run the image branch in this many partitions at inference (partitioned_gnn.py)")
+    parser.add_argument("--partition_min_nodes",type=int, default=0, help="image nodes from which the branch is partitioned")
+    parser.add_argument("--partition_store_dir",type=str, default=None, help="memory map the partitioned node outputs here")
+    return parser
+
+
+def build_model(args, in_feats=None):
+    if in_feats is None:
+        in_feats = getattr(args, 'in_feats', 1024)
+    ex_size = 0
+    if 'img' in args.train_use_type:
+        ex_size += 2
+    model = fusion_model_mae_2(in_feats=in_feats,
+                               n_hidden=args.n_hidden,
+                               out_classes=args.out_classes,
+                               k_weight_rna=args.k_weight_rna,
+                               k_weight_cli=args.k_weight_cli,
+                               img_std_factor=args.img_std_factor,
+                               rna_std_factor=args.rna_std_factor,
+                               cli_std_factor=args.cli_std_factor,
+                               dropout=args.drop_out_ratio,
+                               train_type_num = len(args.train_use_type) + ex_size,
+                               merge_factor=args.merge_factor,
+                               filter_factor=args.filter_factor,
+                               shared_img_trunk=getattr(args, 'shared_img_trunk', False),
+                               in_proj_dim=getattr(args, 'in_proj_dim', None)
+                               )
+    if getattr(args, 'c2f_budget', None) is not None:
+        model.set_coarse_to_fine(coarse_to_fine(args.c2f_budget, args.c2f_cell))
+    if getattr(args, 'partition_parts', None) is not None:
+        model.set_partitioned(partitioned_runner(args.partition_parts, min_nodes=args.partition_min_nodes, store_dir=args.partition_store_dir))
+    return model
+
+
+def load_model(path, args, in_feats=None):
+    model = build_model(args, in_feats=in_feats)
+    model.load_state_dict(torch.load(path, map_location='cpu'))
+    model = model.to(device)
+    model.eval()
+    return model
+
+
+def check_merge_batch(model, graphs, merge_batch):
+    # merge_bags against the per-patient merge_attention on real bags:
+    # (number of bags, bags whose order differs, largest absolute output difference)
+    graphs = [graph.to(device) for graph in graphs if 'img' in graph.data_type and num_patches(graph) > 0]
+    bags, reordered, err = 0, 0, 0.0
+    with torch.no_grad():
+        for start in range(0, len(graphs), merge_batch):
+            part = graphs[start:start + merge_batch]
+            xs = [model.feature_decoder.decode(g.x_img_codes) if getattr(g, 'x_img_codes', None) is not None else g.x_img for g in part]
+            xs = [model.project('img', x) for x in xs]
+            weights = [getattr(g, 'x_img_weight', None) for g in part]
+            if all(w is None for w in weights):
+                weights = None
+            outs, orders = model.merge_attention.forward_batch(xs, weights, return_order=True)
+            for i, x in enumerate(xs):
+                ref, order = model.merge_attention(x, None if weights is None else weights[i], return_order=True)
+                bags += 1
+                if not torch.equal(order, orders[i]):
+                    reordered += 1
+                    continue
+                err = max(err, (outs[i] - ref).abs().max().item())
+    return bags, reordered, err
+
+
+def score_graphs(models, graphs, args, embeddings=False):
+    # fused and per-modality risks of every graph, averaged over the fold models
+    use_type = args.train_use_type
+    names = [x for x in ['img', 'rna', 'cli'] if x in use_type]
+    fused = [[] for _ in graphs]
+    modal = [[] for _ in graphs]
+    emb = [[] for _ in graphs]
+    merge_batch = getattr(args, 'merge_batch', None)
+    with torch.no_grad():
+        for model in models:
+            inputs = [graph.to(device) for graph in graphs]
+            if merge_batch is not None and 'img' in use_type and model.coarse_to_fine is None:
+                # merge_attention over merge_batch patients per call
+                inputs = [graph.clone() for graph in inputs]
+                for start in range(0, len(inputs), merge_batch):
+                    part = [graph for graph in inputs[start:start + merge_batch] if num_patches(graph) > 0]
+                    for graph, merged in zip(part, model.merge_bags(part)):
+                        graph.x_img_merged = merged
+            for i, graph in enumerate(inputs):
+                (one_x, multi_x), _, _, fea_dict = model(graph, use_type, use_type, mix=args.mix)
+                fused[i].append(one_x.reshape(-1)[0])
+                modal[i].append(multi_x.reshape(-1)[:len(names)])
+                if embeddings:
+                    emb[i].append(fea_dict['mae_labels'])
+    results = []
+    for i, graph in enumerate(graphs):
+        # one host sync per patient
+        f = torch.stack(fused[i]).cpu().numpy()
+        m = torch.stack(modal[i]).cpu().numpy()
+        res = {'patient': str(getattr(graph, 'data_id', i)), 'fused': float(f.mean()), 'fused_per_model': f.tolist()}
+        for j, name in enumerate(names):
+            res[name] = float(m[:, j].mean())
+        if embeddings:
+            res['embedding'] = torch.stack(emb[i]).mean(dim=0).cpu().numpy()
+        results.append(res)
+    return results
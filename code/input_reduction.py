@@ -0,0 +1,160 @@
+import copy
+import argparse
+import joblib
+import torch
+import numpy as np
+from inference_utils import add_model_args, build_model, device
+from memory_tuner import profile_patient
+from cost_model import estimate, totals, fmt, FP32
+
+'''
+Narrower input features: an offline transform of the patient store, and the width trade-off.
+
+    python input_reduction.py --all_data lihc_data.pkl --method pca --dim 256 --output lihc_data_256.pkl --transform pca_256.pt
+    python train_a_dynamic_graph_HGCNplus_mergge_loss.py --in_feats 256 ...      # on lihc_data_256.pkl
+    python train_a_dynamic_graph_HGCNplus_mergge_loss.py --in_proj_dim 256 ...   # learned, on the original store
+    python input_reduction.py --all_data lihc_data.pkl --tradeoff 256 512 1024 --patients 8
+
+pca       per-modality principal components of a sample of --sample rows of every modality
+random    per-modality gaussian random projection (Johnson-Lindenstrauss), no fit needed
+
+x_img, x_rna and x_cli are centred and projected to --dim columns, one transform per
+modality, saved with --transform so new patients can be mapped the same way (apply).
+--in_proj_dim is the learned alternative: the model keeps the raw store and projects every
+modality once before the graph stages.
+
+--tradeoff prints for every width the estimated forward FLOPs, parameters and activations of
+the median patient (cost_model.py) for both options, the measured forward + backward time
+and retained memory on the largest --patients patients, and the variance of every modality
+the PCA keeps. The C-index at a width comes from training at that width; the retained
+variance is the data side of the trade-off.
+'''
+
+MODALITIES = ['img', 'rna', 'cli']
+
+
+def rows_of(all_data, t, sample, seed=0):
+    key = 'x_' + t
+    xs = [getattr(d, key) for d in all_data.values() if getattr(d, key, None) is not None and getattr(d, key).shape[0] > 0]
+    if t == 'img' and any(getattr(d, 'x_img_codes', None) is not None for d in all_data.values()):
+        raise ValueError('input reduction needs x_img, reduce before compressing with pq_features.py')
+    x = torch.cat(xs, dim=0).float()
+    if x.shape[0] > sample:
+        g = torch.Generator().manual_seed(seed)
+        x = x[torch.randperm(x.shape[0], generator=g)[:sample]]
+    return x
+
+
+def fit(all_data, method='pca', dim=256, sample=200000, seed=0):
+    # {modality: {'mean': [C], 'matrix': [C, dim]}}, plus the retained variance for pca
+    transform = {}
+    for t in MODALITIES:
+        x = rows_of(all_data, t, sample, seed)
+        mean = x.mean(dim=0)
+        if method == 'pca':
+            _, s, v = torch.linalg.svd(x - mean, full_matrices=False)
+            var = s ** 2
+            transform[t] = {'mean': mean, 'matrix': v[:dim].t().contiguous(),
+                            'retained': (var[:dim].sum() / var.sum().clamp(min=1e-12)).item()}
+        elif method == 'random':
+            g = torch.Generator().manual_seed(seed)
+            transform[t] = {'mean': mean, 'matrix': torch.randn((x.shape[1], dim), generator=g) / dim ** 0.5}
+        else:
+            raise ValueError('unknown reduction method: {}'.format(method))
+    return transform
+
+
+def apply(data, transform):
+    data = data.clone()
+    for t in MODALITIES:
+        x = getattr(data, 'x_' + t)
+        setattr(data, 'x_' + t, ((x.float() - transform[t]['mean']) @ transform[t]['matrix']).to(x.dtype))
+    return data
+
+
+def retained_variance(all_data, dims, sample=200000, seed=0):
+    # share of the variance of every modality kept by the first d principal components
+    out = {}
+    for t in MODALITIES:
+        x = rows_of(all_data, t, sample, seed)
+        var = torch.linalg.svdvals(x - x.mean(dim=0)) ** 2
+        out[t] = {d: (var[:d].sum() / var.sum().clamp(min=1e-12)).item() for d in dims}
+    return out
+
+
+def measure(args, all_data, ids, dim, learned):
+    # mean forward + backward time and retained bytes of random init models at width dim
+    args = copy.copy(args)
+    if learned:
+        args.in_proj_dim = dim if dim != args.in_feats else None
+        transform = None
+    else:
+        args.in_proj_dim = None
+        # the timing only depends on the width, any fitted transform will do
+        transform = fit({id: all_data[id] for id in ids}, 'random', dim) if dim != args.in_feats else None
+        args.in_feats = dim
+    model = build_model(args).to(device)
+    model.train()
+    times, retained = [], []
+    for id in ids:
+        data = all_data[id] if transform is None else apply(all_data[id], transform)
+        saved, _, elapsed = profile_patient(model, data, args.train_use_type, mix=args.mix)
+        times.append(elapsed)
+        retained.append(saved)
+    return float(np.mean(times)), float(np.mean(retained))
+
+
+def tradeoff(args, all_data):
+    dims = sorted(args.tradeoff)
+    counts = sorted((d.x_img.shape[0], d.x_rna.shape[0], d.x_cli.shape[0]) for d in all_data.values())
+    median = counts[len(counts) // 2]
+    ids = sorted(all_data.keys(), key=lambda id: -all_data[id].x_img.shape[0])[:args.patients]
+    ex_size = 2 if 'img' in args.train_use_type else 0
+    config = dict(out_classes=args.out_classes, train_type_num=len(args.train_use_type) + ex_size,
+                  merge_factor=args.merge_factor, filter_factor=args.filter_factor,
+                  n_img=median[0], n_rna=median[1], n_cli=median[2])
+    variance = retained_variance(all_data, dims, args.sample) if args.pca else None
+    print('median patient: {} img / {} rna / {} cli nodes, timing on the {} largest'.format(*(median + (len(ids),))))
+    print('{:<8}{:<9}{:>10}{:>10}{:>10}{:>11}{:>11}  {}'.format('width', 'option', 'flops', 'params', 'act', 'time', 'retained', 'pca variance (img/rna/cli)'))
+    for dim in dims:
+        for option, learned in [('offline', False), ('learned', True)]:
+            if dim == args.in_feats and learned:
+                continue
+            raw = args.in_feats if learned else None
+            t = totals(estimate(in_feats=dim, raw_feats=raw, **config))
+            elapsed, saved = measure(args, all_data, ids, dim, learned)
+            var = '' if variance is None or learned else '/'.join('{:.1%}'.format(variance[m][dim]) for m in MODALITIES)
+            print('{:<8}{:<9}{:>10}{:>10}{:>10}{:>10.3f}s{:>11}  {}'.format(
+                dim, option if dim != args.in_feats else 'raw', fmt(t['flops']), fmt(t['params']),
+                fmt(t['act'] * FP32, 'B'), elapsed, fmt(saved, 'B'), var))
+
+
+def get_params():
+    parser = argparse.ArgumentParser()
+    add_model_args(parser)
+    parser.add_argument("--all_data", type=str, required=True, help="joblib all_data with raw features")
+    parser.add_argument("--method", type=str, default='pca', help="pca or random")
+    parser.add_argument("--dim", type=int, default=256, help="reduced width")
+    parser.add_argument("--sample", type=int, default=200000, help="rows per modality used to fit the pca")
+    parser.add_argument("--output", type=str, default=None, help="reduced all_data file")
+    parser.add_argument("--transform", type=str, default=None, help="save the fitted transform here")
+    parser.add_argument("--tradeoff", type=int, nargs='+', default=None, help="widths to compare")
+    parser.add_argument("--patients", type=int, default=8, help="patients timed by --tradeoff")
+    parser.add_argument("--pca", action='store_true', default=False, help="--tradeoff also reports the pca retained variance")
+    args, _ = parser.parse_known_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = get_params()
+    all_data = joblib.load(args.all_data)
+    if args.tradeoff is not None:
+        tradeoff(args, all_data)
+    if args.output is not None:
+        transform = fit(all_data, args.method, args.dim, args.sample)
+        for t in MODALITIES:
+            if 'retained' in transform[t]:
+                print('{}: {:.1%} of the variance kept'.format(t, transform[t]['retained']))
+        if args.transform is not None:
+            torch.save(transform, args.transform)
+        joblib.dump({id: apply(data, transform) for id, data in all_data.items()}, args.output)
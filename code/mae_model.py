@@ -447,6 +447,11 @@ class fusion_model_mae_2(nn.Module):
         self.norm_cli = LayerNorm(out_classes//4)
         self.relu = torch.nn.ReLU() 
         self.dropout=nn.Dropout(p=dropout)
+        # runs the image branch partition by partition, see partitioned_gnn.py
+        self.partitioned = None
+
+    def set_partitioned(self,runner):
+        self.__dict__['partitioned'] = runner
 
 
     def forward(self,all_thing,train_use_type=None,use_type=None,in_mask=[],mix=False):
@@ -457,6 +462,8 @@ class fusion_model_mae_2(nn.Module):
             mask = in_mask
 
         data_type = use_type
+        # x_img may be a memory mapped node_store (partitioned_gnn.open_features), only read
+        # partition by partition when set_partitioned applies
         x_img = all_thing.x_img
         x_rna = all_thing.x_rna
         x_cli = all_thing.x_cli
@@ -476,7 +483,15 @@ class fusion_model_mae_2(nn.Module):
             
         att_2 = []
         pool_x = torch.empty((0)).to(device)
-        if 'img' in data_type:
+        img_shift = None
+        partitioned = 'img' in data_type and self.partitioned is not None and self.partitioned.applies(self,x_img)
+        if partitioned:
+            x_img,pool_x_img,att_img_2 = self.partitioned.branch(self.img_gnn_2,self.img_relu_2,self.mpool_img,x_img,edge_index_img)
+            att_2.append(att_img_2)
+            pool_x = torch.cat((pool_x,pool_x_img),0)
+        elif 'img' in data_type:
+            if not torch.is_tensor(x_img):
+                x_img = x_img.tensor().to(device)
             x_img = self.img_gnn_2(x_img,edge_index_img) 
             x_img = self.img_relu_2(x_img)   
             batch = torch.zeros(len(x_img),dtype=torch.long).to(device)
@@ -528,7 +543,10 @@ class fusion_model_mae_2(nn.Module):
                 save_fea['after_mix'] = mae_x.cpu().detach().numpy() 
 
             k=0
-            if 'img' in train_use_type and 'img' in use_type:
+            if 'img' in train_use_type and 'img' in use_type and partitioned:
+                img_shift = mae_x[train_use_type.index('img')]
+                k+=1
+            elif 'img' in train_use_type and 'img' in use_type:
                 x_img = x_img + mae_x[train_use_type.index('img')] 
                 k+=1
             if 'rna' in train_use_type and 'rna' in use_type:
@@ -543,7 +561,11 @@ class fusion_model_mae_2(nn.Module):
         pool_x = torch.empty((0)).to(device)
 
         
-        if 'img' in data_type:
+        if partitioned:
+            pool_x_img,att_img_3 = self.partitioned.pool(self.mpool_img_2,x_img,shift=img_shift)
+            att_3.append(att_img_3)
+            pool_x = torch.cat((pool_x,pool_x_img),0)
+        elif 'img' in data_type:
             batch = torch.zeros(len(x_img),dtype=torch.long).to(device)
             pool_x_img,att_img_3 = self.mpool_img_2(x_img,batch)
             att_3.append(att_img_3)
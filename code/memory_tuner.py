@@ -0,0 +1,207 @@
+import gc
+import time
+import resource
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import torch
+import numpy as np
+from torch_geometric.utils import subgraph
+from mae_utils import generate_mask
+
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+'''
+Picks the Cox batch size and the per-patient patch cap from a memory budget.
+
+A few of the largest patients are pushed through forward + backward at increasing patch
+caps. For every run we measure
+    retained  bytes saved for backward (saved_tensors_hooks), this is what a Cox batch
+              keeps alive per patient until loss.backward()
+    peak      transient peak of the forward/backward itself (cuda allocator peak after a
+              reset, or on cpu the growth of the peak RSS of a fresh subprocess that runs
+              only this measurement, since ru_maxrss never goes down), dominated by the
+              N x N attentions
+    time      wall time of forward + backward
+and fit quadratic models in the number of patches. The working set of a batch of B
+patients capped at n patches is then
+    fixed + B * retained(n) + peak(n)
+with fixed = parameters, gradients and the two Adam moments. The cap is doubled only while
+the measured and the predicted working set of a single patient fit the budget, so the
+profiling itself does not run out of memory; a cpu measurement killed by the OOM killer
+counts as over the budget.
+'''
+
+
+def cap_patches(data, cap, seed=0):
+    # keeps a fixed random subset of cap patches and remaps edge_index_image to it
+    n = num_patches(data)
+    if cap is None or n <= cap:
+        return data
+    g = torch.Generator().manual_seed(seed)
+    keep = torch.randperm(n, generator=g)[:cap].sort().values
+    data = data.clone()
+    data.edge_index_image, _ = subgraph(keep.to(data.edge_index_image.device), data.edge_index_image, relabel_nodes=True, num_nodes=n)
+    for key in ['x_img', 'x_img_codes', 'x_img_weight', 'pos_img', 'img_perm']:
+        if getattr(data, key, None) is not None:
+            setattr(data, key, getattr(data, key)[keep.to(getattr(data, key).device)])
+    return data
+
+
+def num_patches(data):
+    x = getattr(data, 'x_img', None)
+    if x is None:
+        x = getattr(data, 'x_img_codes', None)
+    return 0 if x is None else x.shape[0]
+
+
+def _peak_rss():
+    # ru_maxrss is in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def profile_patient(model, data, use_type, mix=True):
+    saved = {}
+
+    def pack(t):
+        saved[t.untyped_storage().data_ptr()] = t.untyped_storage().nbytes()
+        return t
+
+    gc.collect()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+    else:
+        base = _peak_rss()
+    start = time.time()
+
+    graph = data.to(device)
+    mask = generate_mask(num=len(use_type))
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        out_pre, _, _, fea_dict = model(graph, use_type, use_type, mask, mix=mix)
+    loss = out_pre[0].sum() + out_pre[1].sum()
+    if 'loss_img' in fea_dict:
+        loss = loss + fea_dict['loss_img'].sum()
+    if 'mae_out' in fea_dict:
+        loss = loss + fea_dict['mae_out'].sum()
+    loss.backward()
+
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        peak = torch.cuda.max_memory_allocated() - base
+    else:
+        peak = max(_peak_rss() - base, 0)
+    elapsed = time.time() - start
+    model.zero_grad(set_to_none=True)
+    return sum(saved.values()), peak, elapsed
+
+
+class memory_cost_model(object):
+    def __init__(self, sizes, retained, peak, elapsed, fixed):
+        self.sizes = np.asarray(sizes, dtype=float)
+        self.fixed = fixed
+        deg = min(2, len(set(sizes)) - 1)
+        self.retained_fit = np.polyfit(self.sizes, retained, deg)
+        self.peak_fit = np.polyfit(self.sizes, peak, deg)
+        self.time_fit = np.polyfit(self.sizes, elapsed, deg)
+
+    def retained(self, n):
+        return max(float(np.polyval(self.retained_fit, n)), 0.0)
+
+    def peak(self, n):
+        return max(float(np.polyval(self.peak_fit, n)), 0.0)
+
+    def time(self, n):
+        return max(float(np.polyval(self.time_fit, n)), 0.0)
+
+    def working_set(self, batch_size, n):
+        return self.fixed + batch_size * self.retained(n) + self.peak(n)
+
+
+def _profile_fresh(model, data, use_type, mix):
+    # one cpu measurement in a new process, so its peak RSS starts from the loaded inputs
+    with ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context('spawn')) as pool:
+        return pool.submit(profile_patient, model, data, use_type, mix).result()
+
+
+def fit_cost_model(model, all_data, use_type, num_patients=4, min_cap=256, mix=True, budget_bytes=None):
+    ids = sorted(all_data.keys(), key=lambda id: num_patches(all_data[id]), reverse=True)[:num_patients]
+    largest = max(num_patches(all_data[id]) for id in ids)
+    caps = []
+    cap = min_cap
+    while cap < largest:
+        caps.append(cap)
+        cap *= 2
+    caps.append(largest)
+
+    model.train()
+    param_bytes = sum(p.numel() * p.element_size() for p in model.parameters())
+    fixed = 4 * param_bytes
+    sizes, retained, peak, elapsed = [], [], [], []
+    for i, cap in enumerate(caps):
+        if budget_bytes is not None and i > 0:
+            if max(fixed + r + p for r, p in zip(retained, peak)) > budget_bytes:
+                break
+            if len(set(sizes)) > 1 and memory_cost_model(sizes, retained, peak, elapsed, fixed).working_set(1, cap) > budget_bytes:
+                break
+        over = False
+        for id in ids:
+            data = cap_patches(all_data[id], cap)
+            try:
+                if device.type == 'cuda':
+                    r, p, t = profile_patient(model, data, use_type, mix)
+                else:
+                    r, p, t = _profile_fresh(model, data, use_type, mix)
+            except (BrokenProcessPool, torch.cuda.OutOfMemoryError):
+                over = True
+                break
+            sizes.append(num_patches(data))
+            retained.append(r)
+            peak.append(p)
+            elapsed.append(t)
+        if over:
+            if device.type == 'cuda':
+                model.zero_grad(set_to_none=True)
+                torch.cuda.empty_cache()
+            print('memory tuner: {} patches ran out of memory, profiling stopped'.format(cap))
+            break
+    if len(sizes) == 0:
+        raise ValueError('memory tuner: not even {} patches could be profiled, raise --mem_budget_gb'.format(min_cap))
+    return memory_cost_model(sizes, retained, peak, elapsed, fixed=fixed)
+
+
+def choose_batch_and_cap(cost, budget_bytes, max_batch, max_patches, min_cap=256, min_batch=2):
+    # the requested batch at the largest cap that fits it, then the largest batch at that cap
+    candidates = sorted(set([max_patches] + [c for c in 2 ** np.arange(8, 20) if min_cap <= c < max_patches]), reverse=True)
+    cap = None
+    for batch_size in [max_batch, min_batch]:
+        for c in candidates:
+            if cost.working_set(batch_size, c) <= budget_bytes:
+                cap = c
+                break
+        if cap is not None:
+            break
+    if cap is None:
+        return min_batch, min(min_cap, max_patches)
+    batch_size = min_batch
+    while cost.working_set(batch_size + 1, cap) <= budget_bytes and batch_size < max_batch:
+        batch_size += 1
+    return batch_size, (None if cap >= max_patches else int(cap))
+
+
+def tune(model, all_data, train_patients, args):
+    budget = args.mem_budget_gb * 2**30
+    use_type = args.train_use_type
+    cost = fit_cost_model(model, all_data, use_type, num_patients=args.tune_patients, mix=args.mix, budget_bytes=budget)
+    max_patches = max(num_patches(all_data[id]) for id in all_data)
+    batch_size, cap = choose_batch_and_cap(cost, budget, max_batch=min(args.batch_size, train_patients),
+                                           max_patches=max_patches)
+    n = max_patches if cap is None else cap
+    epoch_time = sum(cost.time(min(num_patches(all_data[id]), n)) for id in all_data) * train_patients / len(all_data)
+    print('memory tuner: budget {:.1f} GB, fixed {:.2f} GB, retained/patient {:.1f} MB, peak {:.1f} MB at {} patches'.format(
+        args.mem_budget_gb, cost.fixed / 2**30, cost.retained(n) / 2**20, cost.peak(n) / 2**20, n))
+    print('memory tuner: batch_size {} (requested {}), max_patches {}, working set {:.2f} GB, ~{:.0f}s per epoch'.format(
+        batch_size, args.batch_size, cap, cost.working_set(batch_size, n) / 2**30, epoch_time))
+    return batch_size, cap
@@ -0,0 +1,167 @@
+import time
+import argparse
+import joblib
+import torch
+import numpy as np
+from coarse_to_fine import patch_step
+
+'''
+Locality-preserving order of the patch nodes (x_img) of every patient.
+
+    python node_reorder.py --all_data lihc_data.pkl --output lihc_data_hilbert.pkl --method hilbert
+    python node_reorder.py --all_data lihc_data.pkl --method rcm --benchmark --patients 20
+
+hilbert   patches sorted along a Hilbert curve over the patch grid (pos_img), neighbouring
+          patches of the slide end up close in memory
+rcm       reverse Cuthill-McKee on edge_index_image, for graphs without coordinates
+
+x_img (or x_img_codes), x_img_weight and pos_img are permuted, edge_index_image is
+relabelled and sorted by target, and data.img_perm keeps the original index of every row
+(img_perm[new] = old), so patch level attention maps can be put back with to_original.
+This is meant for the graphs of mae_model.py, which runs its SAGEConv over edge_index_image,
+and for partitioned_gnn.py, whose contiguous partitions become compact regions. There the
+row order only changes where the gathers land in memory, not the output. It is not for the
+all_data of the training script: fusion_model_mae_2 replaces edge_index_image by the
+image dynamic graph, and merge_attention adds a sort-ordered term to a key-ordered one
+(sorted_attn.transpose(0,1) @ sorted_x + sorted_x), so its output depends on the row order.
+--benchmark times the SAGE aggregation before and after the reorder and reports the edge span.
+'''
+
+
+def hilbert_index(x, y, order):
+    # position of the grid cells (x, y) on a Hilbert curve of side 2 ** order
+    n = 1 << order
+    x, y = x.copy(), y.copy()
+    d = np.zeros_like(x)
+    s = n >> 1
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx.astype(np.int64)) ^ ry.astype(np.int64))
+        flip = rx & ~ry
+        x = np.where(flip, n - 1 - x, x)
+        y = np.where(flip, n - 1 - y, y)
+        x, y = np.where(ry, x, y), np.where(ry, y, x)
+        s >>= 1
+    return d
+
+
+def hilbert_order(pos):
+    grid = np.floor(pos.double().numpy() / patch_step(pos)).astype(np.int64)
+    grid -= grid.min(axis=0, keepdims=True)
+    order = max(1, int(np.ceil(np.log2(grid.max() + 1))))
+    return torch.as_tensor(np.argsort(hilbert_index(grid[:, 0], grid[:, 1], order), kind='stable'))
+
+
+def rcm_order(edge_index, n):
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import reverse_cuthill_mckee
+    edge = edge_index.cpu().numpy()
+    adj = coo_matrix((np.ones(edge.shape[1]), (edge[0], edge[1])), shape=(n, n)).tocsr()
+    return torch.as_tensor(reverse_cuthill_mckee(adj + adj.T, symmetric_mode=True).astype(np.int64))
+
+
+def num_nodes(data):
+    x = getattr(data, 'x_img', None)
+    if x is None:
+        x = getattr(data, 'x_img_codes', None)
+    return 0 if x is None else x.shape[0]
+
+
+def permute(data, perm):
+    # perm[new] = old
+    n = perm.shape[0]
+    inv = torch.empty_like(perm)
+    inv[perm] = torch.arange(n)
+    data = data.clone()
+    for key in ['x_img', 'x_img_codes', 'x_img_weight', 'pos_img']:
+        value = getattr(data, key, None)
+        if value is not None:
+            setattr(data, key, value[perm.to(value.device)])
+    edge = inv.to(data.edge_index_image.device)[data.edge_index_image]
+    data.edge_index_image = edge[:, torch.argsort(edge[1] * n + edge[0])]
+    previous = getattr(data, 'img_perm', None)
+    data.img_perm = perm if previous is None else previous[perm]
+    return data
+
+
+def reorder_graph(data, method='hilbert'):
+    n = num_nodes(data)
+    if n <= 1:
+        return data
+    if method == 'hilbert' and getattr(data, 'pos_img', None) is not None:
+        perm = hilbert_order(data.pos_img.cpu())
+    elif method in ['hilbert', 'rcm']:
+        perm = rcm_order(data.edge_index_image, n)
+    else:
+        raise ValueError('unknown reorder method: {}'.format(method))
+    return permute(data, perm)
+
+
+def to_original(values, data):
+    # rows of a patch level map (attention, scores) in the order of the original x_img
+    perm = getattr(data, 'img_perm', None)
+    if perm is None:
+        return values
+    out = values.new_empty((int(perm.max()) + 1,) + tuple(values.shape[1:]))
+    out[perm.to(values.device)] = values
+    return out
+
+
+def edge_span(data):
+    edge = data.edge_index_image
+    if edge.shape[1] == 0:
+        return 0.0
+    return (edge[0] - edge[1]).abs().double().mean().item()
+
+
+def aggregate_time(data, repeat=20):
+    # the gather / scatter of a mean aggregating SAGEConv over edge_index_image
+    x = data.x_img.float()
+    src, dst = data.edge_index_image
+    start = time.time()
+    for _ in range(repeat):
+        torch.zeros_like(x).index_add_(0, dst, x.index_select(0, src))
+    return (time.time() - start) / repeat
+
+
+def benchmark(all_data, ids, method, repeat=20):
+    rows = []
+    for id in ids:
+        data = all_data[id]
+        if getattr(data, 'x_img', None) is None or data.edge_index_image.shape[1] == 0:
+            continue
+        reordered = reorder_graph(data, method)
+        rows.append((data.x_img.shape[0], edge_span(data), edge_span(reordered),
+                     aggregate_time(data, repeat), aggregate_time(reordered, repeat)))
+    if len(rows) == 0:
+        print('no patients with image edges')
+        return
+    rows = np.array(rows)
+    print('{} patients, {:.0f} patches on average'.format(len(rows), rows[:, 0].mean()))
+    print('mean edge span |i - j|: {:.1f} -> {:.1f}'.format(rows[:, 1].mean(), rows[:, 2].mean()))
+    print('aggregation over edge_index_image: {:.2f} ms -> {:.2f} ms ({:.2f}x)'.format(
+        rows[:, 3].mean() * 1000, rows[:, 4].mean() * 1000, rows[:, 3].sum() / max(rows[:, 4].sum(), 1e-12)))
+
+
+def get_params():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--all_data", type=str, required=True, help="joblib all_data")
+    parser.add_argument("--output", type=str, default=None, help="reordered all_data file")
+    parser.add_argument("--method", type=str, default='hilbert', help="hilbert (rcm without pos_img) or rcm")
+    parser.add_argument("--benchmark", action='store_true', default=False, help="time the aggregation before and after")
+    parser.add_argument("--patients", type=int, default=20, help="largest patients used by --benchmark")
+    parser.add_argument("--repeat", type=int, default=20, help="timed repetitions per patient")
+    args, _ = parser.parse_known_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = get_params()
+    all_data = joblib.load(args.all_data)
+    if args.benchmark:
+        ids = sorted(all_data.keys(), key=lambda id: -num_nodes(all_data[id]))[:args.patients]
+        benchmark(all_data, ids, args.method, args.repeat)
+    if args.output is not None:
+        all_data = {id: reorder_graph(data, args.method) for id, data in all_data.items()}
+        joblib.dump(all_data, args.output)
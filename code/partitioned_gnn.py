@@ -0,0 +1,271 @@
+import os
+import argparse
+import joblib
+import torch
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from torch_geometric.nn import LayerNorm
+
+'''
+Partitioned (out-of-core) execution of the image branch, img_gnn_2 -> img_relu_2 -> mpool_img,
+for slides whose patch graph does not fit through it in one piece.
+
+    python partitioned_gnn.py --all_data lihc_data.pkl --patient TCGA-XX-XXXX --parts 16 --store_dir /scratch/nodes
+    python partitioned_gnn.py --all_data lihc_data.pkl --patient TCGA-XX-XXXX --features /scratch/x_img.npy
+
+The nodes are split into contiguous ranges (after node_reorder.py these are compact regions
+of the slide). Every partition reads its own rows plus the halo, the sources of its in-edges
+that belong to other partitions, so SAGEConv gives exactly the monolithic output for the
+owned nodes. Input rows can come from a memory mapped .npy (open_features): mae_model.py
+accepts such a node_store as data.x_img and, with set_partitioned, reads it one partition at
+a time; --features runs the check that way. Outputs go to a node_store, in memory or memory
+mapped under store_dir, and only one partition per worker is ever materialised.
+
+The training and scoring model (a_dynamic_graph_model_HGCNplus_merge_loss.py) has the same
+set_partitioned: there the image branch runs over the merged tokens of merge_attention and
+the edges of img_dynamic_graph, and mpool_img_2 pools the stored nodes after the mae shift.
+Its input is in memory, only the branch outputs are partitioned. bulk_score.py and
+scoring_service.py turn it on with --partition_parts.
+
+The graph-mode LayerNorm of GNN_relu_Block needs the mean and std over the whole graph: the
+first pass accumulates the sums, the second normalises. my_GlobalAttention is combined with
+an online softmax, running max, rescaled denominator and rescaled weighted sum, and the
+gate logits are normalised at the end, which is the softmax + scatter_add of the monolithic
+pooling. Dropout makes training non-deterministic anyway, so this is an inference path
+(eval mode, no autograd); compare() checks it against the monolithic one.
+'''
+
+
+class node_store(object):
+    # [N, C] float32 rows, in memory or in a memory mapped .npy
+    def __init__(self, array):
+        self.array = array
+
+    @classmethod
+    def create(cls, n, dim, path=None):
+        if path is None:
+            return cls(np.zeros((n, dim), dtype=np.float32))
+        return cls(np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=(n, dim)))
+
+    @classmethod
+    def wrap(cls, x):
+        if isinstance(x, node_store):
+            return x
+        return cls(x.detach().cpu().numpy() if torch.is_tensor(x) else x)
+
+    def __len__(self):
+        return self.array.shape[0]
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    def rows(self, index, device):
+        return torch.from_numpy(np.ascontiguousarray(self.array[index.numpy()], dtype=np.float32)).to(device)
+
+    def slice(self, start, end, device):
+        return torch.from_numpy(np.ascontiguousarray(self.array[start:end], dtype=np.float32)).to(device)
+
+    def write(self, start, values):
+        self.array[start:start + values.shape[0]] = values.detach().cpu().numpy()
+
+    def tensor(self):
+        return torch.from_numpy(np.asarray(self.array, dtype=np.float32))
+
+
+def open_features(path):
+    # x_img saved with np.save, read lazily
+    return node_store(np.load(path, mmap_mode='r'))
+
+
+class graph_partition(object):
+    def __init__(self, edge_index, n, parts):
+        edge_index = edge_index.cpu()
+        order = torch.argsort(edge_index[1])
+        src, dst = edge_index[0][order], edge_index[1][order]
+        self.bounds = np.linspace(0, n, max(1, min(parts, n)) + 1).astype(np.int64)
+        self.parts = []
+        for start, end in zip(self.bounds[:-1].tolist(), self.bounds[1:].tolist()):
+            lo, hi = torch.searchsorted(dst, torch.tensor([start, end])).tolist()
+            s, d = src[lo:hi], dst[lo:hi] - start
+            outside = (s < start) | (s >= end)
+            halo = torch.unique(s[outside])
+            local = s - start
+            local[outside] = (end - start) + torch.searchsorted(halo, s[outside])
+            nodes = torch.cat((torch.arange(start, end), halo))
+            self.parts.append((start, end, nodes, torch.stack((local, d), dim=0)))
+
+    def halo_ratio(self):
+        owned = sum(end - start for start, end, _, _ in self.parts)
+        return sum(len(nodes) for _, _, nodes, _ in self.parts) / float(max(owned, 1)) - 1
+
+
+def split_block(block):
+    # layers before / after the graph-mode LayerNorm of GNN_relu_Block
+    layers = list(block) if isinstance(block, torch.nn.Sequential) else [block]
+    for i, layer in enumerate(layers):
+        if isinstance(layer, LayerNorm) and getattr(layer, 'mode', 'graph') == 'graph':
+            return layers[:i], layer, layers[i + 1:]
+    return layers, None, []
+
+
+def run_layers(layers, x):
+    for layer in layers:
+        x = layer(x)
+    return x
+
+
+class partitioned_runner(object):
+    def __init__(self, parts=8, min_nodes=0, workers=1, store_dir=None, device=None):
+        self.parts = parts
+        self.min_nodes = min_nodes
+        self.workers = workers
+        self.store_dir = store_dir
+        self.device = None if device is None else torch.device(device)
+        self.calls = 0
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def device_of(self, module):
+        # the device of the module unless one was given
+        return self.device if self.device is not None else next(module.parameters()).device
+
+    def applies(self, model, x):
+        return not model.training and not torch.is_grad_enabled() and len(x) >= self.min_nodes
+
+    def store(self, n, dim, name):
+        path = None
+        if self.store_dir is not None:
+            path = '{}/{}_{}.npy'.format(self.store_dir, name, self.calls)
+        return node_store.create(n, dim, path)
+
+    def branch(self, gnn, block, pool, x, edge_index):
+        # (nodes, pooled, gate) of pool(block(gnn(x, edge_index)), batch of zeros)
+        if gnn.training or torch.is_grad_enabled():
+            raise ValueError('partitioned execution runs in eval mode without autograd')
+        self.calls += 1
+        device = self.device_of(gnn)
+        x = node_store.wrap(x)
+        partition = graph_partition(edge_index, len(x), self.parts)
+        pre, norm, post = split_block(block)
+        nodes = self.store(len(x), gnn.out_channels, 'nodes')
+
+        def first_pass(part):
+            start, end, index, edge = part
+            h = gnn(x.rows(index, device), edge.to(device))[:end - start]
+            h = run_layers(pre, h)
+            nodes.write(start, h)
+            h = h.double()
+            return h.sum().item(), (h * h).sum().item(), h.numel()
+
+        if self.workers > 1:
+            with ThreadPoolExecutor(self.workers) as executor:
+                sums = list(executor.map(first_pass, partition.parts))
+        else:
+            sums = [first_pass(part) for part in partition.parts]
+
+        transform = None
+        if norm is not None:
+            total, total_sq, count = [sum(s[i] for s in sums) for i in range(3)]
+            mean = total / count
+            std = max(total_sq / count - mean * mean, 0.0) ** 0.5
+
+            def transform(h):
+                h = (h - mean) / (std + norm.eps)
+                if norm.weight is not None:
+                    h = h * norm.weight + norm.bias
+                return run_layers(post, h)
+        elif len(post) > 0:
+            transform = lambda h: run_layers(post, h)
+        pooled, gate = self.pool(pool, nodes, transform=transform, bounds=partition.bounds)
+        return nodes, pooled, gate
+
+    def pool(self, pool, nodes, shift=None, transform=None, bounds=None):
+        # my_GlobalAttention over the rows of nodes (+ shift) with an online softmax;
+        # transform is applied once and written back to nodes
+        nodes = node_store.wrap(nodes)
+        device = self.device_of(pool)
+        if bounds is None:
+            bounds = np.linspace(0, len(nodes), max(1, min(self.parts, len(nodes))) + 1).astype(np.int64)
+        logits = torch.empty((len(nodes), 1), device=device)
+        running_max, denom, acc = None, None, None
+        for start, end in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+            h = nodes.slice(start, end, device)
+            if transform is not None:
+                h = transform(h)
+                nodes.write(start, h)
+            if shift is not None:
+                h = h + shift
+            g = pool.gate_nn(h).view(-1, 1)
+            v = pool.nn(h) if pool.nn is not None else h
+            logits[start:end] = g
+            new_max = g.max() if running_max is None else torch.maximum(running_max, g.max())
+            e = torch.exp(g - new_max)
+            if running_max is None:
+                denom, acc = e.sum(), (e * v).sum(dim=0)
+            else:
+                scale = torch.exp(running_max - new_max)
+                denom, acc = denom * scale + e.sum(), acc * scale + (e * v).sum(dim=0)
+            running_max = new_max
+        denom = denom + 1e-16
+        return (acc / denom).unsqueeze(0), torch.exp(logits - running_max) / denom
+
+
+def save_features(data, path):
+    # x_img of a patient as a .npy for open_features
+    np.save(path, data.x_img.detach().cpu().numpy().astype(np.float32))
+    return open_features(path)
+
+
+def compare(model, data, runner, atol=1e-4, features=None):
+    # partitioned vs monolithic image branch of model (eval mode); features: a node_store the
+    # partitioned path streams x_img from instead of data.x_img
+    model.eval()
+    device = runner.device_of(model)
+    with torch.no_grad():
+        x = data.x_img.to(device) if features is None else features.tensor().to(device)
+        edge = data.edge_index_image.to(device)
+        h = model.img_relu_2(model.img_gnn_2(x, edge))
+        pooled, gate = model.mpool_img(h, torch.zeros(len(h), dtype=torch.long, device=device))
+        source = x if features is None else features
+        nodes, p_pooled, p_gate = runner.branch(model.img_gnn_2, model.img_relu_2, model.mpool_img, source, edge)
+    diffs = {'nodes': (nodes.tensor().to(device) - h).abs().max().item(),
+             'pooled': (p_pooled - pooled).abs().max().item(),
+             'gate': (p_gate - gate).abs().max().item()}
+    return diffs, all(d <= atol for d in diffs.values())
+
+
+def get_params():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--all_data", type=str, required=True, help="joblib all_data")
+    parser.add_argument("--patient", type=str, default=None, help="patient to check, default the largest")
+    parser.add_argument("--model", type=str, default=None, help="fusion_model_mae_2 state_dict, random weights otherwise")
+    parser.add_argument("--in_feats", type=int, default=1024)
+    parser.add_argument("--out_classes", type=int, default=512)
+    parser.add_argument("--parts", type=int, default=8, help="number of partitions")
+    parser.add_argument("--workers", type=int, default=1, help="partitions run concurrently")
+    parser.add_argument("--store_dir", type=str, default=None, help="memory map the node outputs here")
+    parser.add_argument("--features", type=str, default=None, help="stream x_img from this .npy memmap, written from all_data if missing")
+    args, _ = parser.parse_known_args()
+    return args
+
+
+if __name__ == '__main__':
+    from mae_model import fusion_model_mae_2
+    args = get_params()
+    all_data = joblib.load(args.all_data)
+    id = args.patient if args.patient is not None else max(all_data.keys(), key=lambda k: all_data[k].x_img.shape[0])
+    model = fusion_model_mae_2(in_feats=args.in_feats, n_hidden=args.out_classes, out_classes=args.out_classes)
+    if args.model is not None:
+        model.load_state_dict(torch.load(args.model, map_location='cpu'))
+    runner = partitioned_runner(args.parts, workers=args.workers, store_dir=args.store_dir)
+    partition = graph_partition(all_data[id].edge_index_image, all_data[id].x_img.shape[0], args.parts)
+    print('{}: {} patches, {} partitions, halo {:.1%} of the owned nodes'.format(
+        id, all_data[id].x_img.shape[0], len(partition.parts), partition.halo_ratio()))
+    features = None
+    if args.features is not None:
+        features = open_features(args.features) if os.path.exists(args.features) else save_features(all_data[id], args.features)
+    diffs, ok = compare(model, all_data[id], runner, features=features)
+    print('max abs difference to the monolithic path: ' + ', '.join('{} {:.2e}'.format(k, v) for k, v in diffs.items()))
+    print('match' if ok else 'MISMATCH')
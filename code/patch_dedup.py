@@ -0,0 +1,128 @@
+import csv
+import math
+import argparse
+import joblib
+import torch
+import numpy as np
+
+'''
+Collapses near-identical patches of x_img into weighted representatives before the O(N^2)
+stages of the model.
+
+    python patch_dedup.py --all_data lihc_data.pkl --output lihc_data_dedup.pkl --method simhash --bits 16
+    python patch_dedup.py --all_data lihc_data.pkl --output lihc_data_dedup.pkl --method kmeans --ratio 0.25 --report n.csv
+
+simhash   rows whose signs against --bits random hyperplanes (through the mean patch) agree
+          fall into one group; more bits, finer groups
+kmeans    mini-batch k-means with ceil(ratio * N) clusters per patient
+
+Every group is replaced by its mean and x_img_weight keeps how many patches it stands for.
+merge_attention uses the weights (a representative counts w times as a key and in the
+pooled sums), edge_index_image is mapped onto the groups and pos_img becomes the weighted
+mean position. build_patient_graphs.py applies the same step with --dedup.
+'''
+
+
+def simhash_groups(x, bits=16, seed=0):
+    g = torch.Generator().manual_seed(seed)
+    planes = torch.randn((x.shape[1], bits), generator=g)
+    signs = ((x - x.mean(dim=0, keepdim=True)) @ planes > 0).long()
+    codes = (signs * (2 ** torch.arange(bits))).sum(dim=1)
+    _, assign = torch.unique(codes, return_inverse=True)
+    return assign
+
+
+def kmeans_groups(x, ratio=0.25, seed=0, batch_size=4096):
+    from sklearn.cluster import MiniBatchKMeans
+    n_clusters = max(1, min(x.shape[0], int(math.ceil(x.shape[0] * ratio))))
+    km = MiniBatchKMeans(n_clusters=n_clusters, random_state=seed, batch_size=batch_size, n_init=3)
+    labels = torch.as_tensor(km.fit_predict(x.numpy()), dtype=torch.long)
+    # empty clusters are dropped
+    _, assign = torch.unique(labels, return_inverse=True)
+    return assign
+
+
+def collapse(data, assign):
+    n = int(assign.max().item()) + 1
+    device = data.x_img.device
+    weight = getattr(data, 'x_img_weight', None)
+    if weight is None:
+        weight = torch.ones(data.x_img.shape[0], device=device)
+    group_weight = torch.zeros(n, device=device).index_add_(0, assign, weight)
+    data = data.clone()
+    for key in ['x_img', 'pos_img']:
+        value = getattr(data, key, None)
+        if value is None:
+            continue
+        total = torch.zeros((n, value.shape[1]), device=device).index_add_(0, assign, value.float() * weight.unsqueeze(-1))
+        setattr(data, key, (total / group_weight.unsqueeze(-1)).to(value.dtype))
+    edge = assign[data.edge_index_image]
+    # edges inside a group become self loops, only the original ones are kept
+    keep = (edge[0] != edge[1]) | (data.edge_index_image[0] == data.edge_index_image[1])
+    data.edge_index_image = torch.unique(edge[:, keep], dim=1)
+    data.x_img_weight = group_weight
+    # rows are groups now, no longer single patches of the original order
+    data.img_perm = None
+    return data
+
+
+def dedup_graph(data, method='simhash', bits=16, ratio=0.25, seed=0):
+    x = getattr(data, 'x_img', None)
+    if x is None:
+        raise ValueError('patch deduplication needs x_img, dedup before compressing with pq_features.py')
+    if x.shape[0] <= 1:
+        return data
+    if method == 'simhash':
+        assign = simhash_groups(x.float(), bits, seed)
+    elif method == 'kmeans':
+        assign = kmeans_groups(x.float(), ratio, seed)
+    else:
+        raise ValueError('unknown dedup method: {}'.format(method))
+    return collapse(data, assign)
+
+
+def dedup_all_data(all_data, method='simhash', bits=16, ratio=0.25, seed=0):
+    report = []
+    for id in list(all_data.keys()):
+        data = all_data[id]
+        n = data.x_img.shape[0]
+        all_data[id] = dedup_graph(data, method, bits, ratio, seed)
+        m = all_data[id].x_img.shape[0]
+        report.append({'patient': str(id), 'patches': n, 'groups': m, 'ratio': m / max(n, 1),
+                       'attention_cost_ratio': (m / max(n, 1)) ** 2})
+    return all_data, report
+
+
+def print_report(report):
+    before = np.array([r['patches'] for r in report], dtype=float)
+    after = np.array([r['groups'] for r in report], dtype=float)
+    ratio = after / np.maximum(before, 1)
+    print('patients: {}, patches: {:.0f} -> {:.0f} ({:.1%})'.format(len(report), before.sum(), after.sum(), after.sum() / max(before.sum(), 1)))
+    print('per patient N ratio: mean {:.3f}, min {:.3f}, median {:.3f}, max {:.3f}'.format(
+        ratio.mean(), ratio.min(), np.median(ratio), ratio.max()))
+    print('merge_attention cost (sum N^2): {:.1%} of the original'.format((after ** 2).sum() / max((before ** 2).sum(), 1)))
+
+
+def get_params():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--all_data", type=str, required=True, help="joblib all_data with x_img")
+    parser.add_argument("--output", type=str, required=True, help="deduplicated all_data file")
+    parser.add_argument("--method", type=str, default='simhash', help="simhash or kmeans")
+    parser.add_argument("--bits", type=int, default=16, help="simhash hyperplanes")
+    parser.add_argument("--ratio", type=float, default=0.25, help="kmeans clusters per patch")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the hyperplanes / k-means")
+    parser.add_argument("--report", type=str, default=None, help="csv with the per-patient N before and after")
+    args, _ = parser.parse_known_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = get_params()
+    all_data, report = dedup_all_data(joblib.load(args.all_data), args.method, args.bits, args.ratio, args.seed)
+    print_report(report)
+    if args.report is not None:
+        with open(args.report, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(report[0].keys()))
+            writer.writeheader()
+            writer.writerows(report)
+    joblib.dump(all_data, args.output)
@@ -0,0 +1,188 @@
+import copy
+import argparse
+import joblib
+import torch
+import numpy as np
+import torch.nn as nn
+
+device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+'''
+Product quantisation of the patch features (x_img).
+
+Every 1024-d patch is split into num_sub sub-vectors and each of them is replaced by the
+index of its nearest centroid in a per-subspace codebook, so with num_sub=64 and 256
+centroids a patch takes 64 bytes instead of 4 KB. The compressed graphs keep x_img_codes
+(uint8) instead of x_img; fusion_model_mae_2 decodes them in chunks right before
+merge_attention once a decoder is attached with set_feature_decoder().
+
+    python pq_features.py fit      --all_data lihc_data.pkl --codebook pq.pt
+    python pq_features.py compress --all_data lihc_data.pkl --codebook pq.pt --output lihc_data_pq.pkl
+    python pq_features.py evaluate --all_data lihc_data.pkl --codebook pq.pt --checkpoint fold.pth \\
+                                   --patients lihc_patients.pkl --sur_and_time lihc_sur_and_time.pkl
+'''
+
+
+class product_quantizer(nn.Module):
+    def __init__(self, dim=1024, num_sub=64, num_centroids=256):
+        super(product_quantizer, self).__init__()
+        assert dim % num_sub == 0 and num_centroids <= 256
+        self.dim = dim
+        self.num_sub = num_sub
+        self.num_centroids = num_centroids
+        self.sub_dim = dim // num_sub
+        self.register_buffer('codebooks', torch.zeros(num_sub, num_centroids, self.sub_dim))
+
+    @torch.no_grad()
+    def fit(self, x, iters=20, chunk=65536):
+        x = x.to(self.codebooks.device).float().reshape(-1, self.num_sub, self.sub_dim)
+        n = x.shape[0]
+        for m in range(self.num_sub):
+            x_m = x[:, m]
+            centroids = x_m[torch.randperm(n, device=x.device)[:self.num_centroids]].clone()
+            if centroids.shape[0] < self.num_centroids:
+                centroids = torch.cat([centroids, centroids[torch.randint(0, centroids.shape[0], (self.num_centroids - centroids.shape[0],), device=x.device)]])
+            for _ in range(iters):
+                assign = torch.cat([torch.cdist(x_m[i:i+chunk], centroids).argmin(dim=1) for i in range(0, n, chunk)])
+                sums = torch.zeros_like(centroids).index_add_(0, assign, x_m)
+                counts = torch.bincount(assign, minlength=self.num_centroids).float().unsqueeze(1)
+                # empty clusters keep their previous centroid
+                centroids = torch.where(counts > 0, sums / counts.clamp(min=1), centroids)
+            self.codebooks[m] = centroids
+        return self
+
+    @torch.no_grad()
+    def encode(self, x, chunk=65536):
+        x = x.to(self.codebooks.device).float().reshape(-1, self.num_sub, self.sub_dim)
+        codes = torch.empty((x.shape[0], self.num_sub), dtype=torch.uint8, device=x.device)
+        for i in range(0, x.shape[0], chunk):
+            for m in range(self.num_sub):
+                codes[i:i+chunk, m] = torch.cdist(x[i:i+chunk, m], self.codebooks[m]).argmin(dim=1).to(torch.uint8)
+        return codes
+
+    def decode(self, codes, chunk=16384):
+        codes = codes.to(self.codebooks.device).long()
+        sub = torch.arange(self.num_sub, device=codes.device)
+        out = [self.codebooks[sub, codes[i:i+chunk]].reshape(-1, self.dim) for i in range(0, codes.shape[0], chunk)]
+        return torch.cat(out, dim=0) if len(out) > 0 else self.codebooks.new_zeros((0, self.dim))
+
+
+def save_quantizer(pq, path):
+    torch.save({'dim': pq.dim, 'num_sub': pq.num_sub, 'num_centroids': pq.num_centroids,
+                'state_dict': pq.state_dict()}, path)
+
+
+def load_quantizer(path):
+    state = torch.load(path, map_location='cpu')
+    pq = product_quantizer(state['dim'], state['num_sub'], state['num_centroids'])
+    pq.load_state_dict(state['state_dict'])
+    return pq
+
+
+def sample_patches(all_data, max_samples=200000, seed=0):
+    rng = np.random.RandomState(seed)
+    xs = [data.x_img for data in all_data.values() if getattr(data, 'x_img', None) is not None and data.x_img.shape[0] > 0]
+    total = sum(x.shape[0] for x in xs)
+    rate = min(1.0, max_samples / max(total, 1))
+    out = []
+    for x in xs:
+        n = max(1, int(round(x.shape[0] * rate)))
+        out.append(x[rng.choice(x.shape[0], min(n, x.shape[0]), replace=False)])
+    return torch.cat(out, dim=0)
+
+
+def compress_graph(data, pq):
+    if getattr(data, 'x_img', None) is None:
+        return data
+    data = copy.copy(data)
+    data.x_img_codes = pq.encode(data.x_img).cpu()
+    data.x_img = None
+    return data
+
+
+def compress_all_data(all_data, pq):
+    return {id: compress_graph(data, pq) for id, data in all_data.items()}
+
+
+def decode_graph(data, pq):
+    if getattr(data, 'x_img_codes', None) is None:
+        return data
+    data = copy.copy(data)
+    data.x_img = pq.decode(data.x_img_codes).cpu()
+    data.x_img_codes = None
+    return data
+
+
+def evaluate(args):
+    from util import get_patients_information, get_val_ci
+    from inference_utils import load_model
+
+    all_data = joblib.load(args.all_data)
+    pq = load_quantizer(args.codebook).to(device)
+    patients = joblib.load(args.patients)
+    sur_and_time = joblib.load(args.sur_and_time)
+    patient_sur_type, patient_and_time, _ = get_patients_information(patients, sur_and_time)
+
+    model = load_model(args.checkpoint, args)
+    model.set_feature_decoder(pq)
+    risk_raw, risk_pq, mse = {}, {}, []
+    with torch.no_grad():
+        for id in patients:
+            if id not in all_data:
+                continue
+            graph = all_data[id].to(device)
+            use_type = args.train_use_type
+            (one_x, _), _, _, _ = model(graph, args.train_use_type, use_type, mix=args.mix)
+            risk_raw[id] = one_x.cpu().numpy()[0]
+            compressed = compress_graph(graph, pq).to(device)
+            (one_x, _), _, _, _ = model(compressed, args.train_use_type, use_type, mix=args.mix)
+            risk_pq[id] = one_x.cpu().numpy()[0]
+            mse.append(torch.mean((pq.decode(compressed.x_img_codes) - graph.x_img) ** 2).item())
+
+    ci_raw = get_val_ci(risk_raw, patient_and_time, patient_sur_type)
+    ci_pq = get_val_ci(risk_pq, patient_and_time, patient_sur_type)
+    ids = list(risk_raw.keys())
+    corr = np.corrcoef([risk_raw[i] for i in ids], [risk_pq[i] for i in ids])[0, 1]
+    raw_bytes = sum(all_data[i].x_img.numel() * 4 for i in ids)
+    pq_bytes = sum(all_data[i].x_img.shape[0] * pq.num_sub for i in ids)
+    print('patients: {}'.format(len(ids)))
+    print('x_img size: {:.1f} MB -> {:.1f} MB ({:.1f}x)'.format(raw_bytes / 2**20, pq_bytes / 2**20, raw_bytes / max(pq_bytes, 1)))
+    print('reconstruction mse: {:.6f}'.format(np.mean(mse)))
+    print('risk correlation: {:.4f}'.format(corr))
+    print('c-index raw: {:.4f}, pq: {:.4f}, delta: {:+.4f}'.format(ci_raw, ci_pq, ci_pq - ci_raw))
+    return ci_raw, ci_pq
+
+
+def get_params():
+    from inference_utils import add_model_args
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", type=str, help="fit, compress or evaluate")
+    parser.add_argument("--all_data", type=str, required=True, help="joblib all_data with uncompressed x_img")
+    parser.add_argument("--codebook", type=str, required=True, help="quantizer file")
+    parser.add_argument("--output", type=str, default=None, help="compressed all_data file")
+    parser.add_argument("--num_sub", type=int, default=64, help="number of sub-vectors per patch")
+    parser.add_argument("--num_centroids", type=int, default=256, help="centroids per sub-vector codebook (<=256)")
+    parser.add_argument("--iters", type=int, default=20, help="k-means iterations")
+    parser.add_argument("--train_samples", type=int, default=200000, help="patches sampled to fit the codebooks")
+    parser.add_argument("--checkpoint", type=str, default=None, help="model state_dict for evaluate")
+    parser.add_argument("--patients", type=str, default=None, help="joblib patient list for evaluate")
+    parser.add_argument("--sur_and_time", type=str, default=None, help="joblib sur_and_time for evaluate")
+    add_model_args(parser)
+    args, _ = parser.parse_known_args()
+    return args
+
+
+if __name__ == '__main__':
+    args = get_params()
+    if args.command == 'fit':
+        all_data = joblib.load(args.all_data)
+        x = sample_patches(all_data, args.train_samples)
+        pq = product_quantizer(x.shape[1], args.num_sub, args.num_centroids).to(device).fit(x, iters=args.iters)
+        save_quantizer(pq.cpu(), args.codebook)
+    elif args.command == 'compress':
+        pq = load_quantizer(args.codebook).to(device)
+        joblib.dump(compress_all_data(joblib.load(args.all_data), pq), args.output)
+    elif args.command == 'evaluate':
+        evaluate(args)
+    else:
+        raise ValueError('unknown command ' + args.command)
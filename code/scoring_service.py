@@ -0,0 +1,265 @@
+import io
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+import collections
+import torch
+import numpy as np
+from torch_geometric.data import Data
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingUnixStreamServer
+from inference_utils import add_model_args, load_model, score_graphs
+
+'''
+Local scoring service: loads the fold checkpoints once and scores patient graphs.
+
+    python scoring_service.py --checkpoints fold1.pth fold2.pth ... --port 8600
+    python scoring_service.py --checkpoints fold*.pth --unix_socket /tmp/hgcn.sock
+
+    POST /score     body: encode_graph(all_data[id]), a torch.save'd dict of the tensors of the
+                    graph plus data_id and data_type
+                    returns {"patient", "fused", "fused_per_model", "img", "rna", "cli"}
+    GET  /metrics   queue depth, batch sizes and latency percentiles
+    GET  /health
+
+The body is read with torch.load(weights_only=True), which only accepts tensors and plain
+containers, and the Data object is rebuilt on the server; no client code is unpickled. The
+tensors the model reads are checked against --in_feats and the node counts, so a malformed
+graph gets a 400 instead of failing its micro-batch.
+Concurrent requests are grouped into micro-batches of up to --max_batch graphs; a batch is
+closed when it is full or when its oldest request has waited --max_wait_ms. The
+merge_attention of a micro-batch runs in one padded call (merge_bags), the rest of the model
+per patient.
+'''
+
+
+def encode_graph(data):
+    # client side: the request body of a graph
+    payload = {key: value for key, value in data.to_dict().items() if torch.is_tensor(value)}
+    payload['data_id'] = str(data.data_id)
+    payload['data_type'] = [str(t) for t in data.data_type]
+    buf = io.BytesIO()
+    torch.save(payload, buf)
+    return buf.getvalue()
+
+
+# node features and edges of every modality, all read by forward_front
+GRAPH_KEYS = [('img', 'x_img', 'edge_index_image'), ('rna', 'x_rna', 'edge_index_rna'), ('cli', 'x_cli', 'edge_index_cli')]
+
+
+def check_graph(graph, use_type, in_feats=None):
+    for t, x_key, edge_key in GRAPH_KEYS:
+        x = getattr(graph, x_key, None)
+        edge = getattr(graph, edge_key, None)
+        if x is None or edge is None:
+            raise ValueError('{} and {} are required'.format(x_key, edge_key))
+        if x.dim() != 2 or not x.is_floating_point():
+            raise ValueError('{} must be a 2-d float tensor'.format(x_key))
+        if in_feats is not None and x.shape[1] != in_feats:
+            raise ValueError('{} has {} features, the model takes {}'.format(x_key, x.shape[1], in_feats))
+        if t in use_type and x.shape[0] == 0:
+            raise ValueError('{} has no nodes'.format(x_key))
+        if edge.dim() != 2 or edge.shape[0] != 2 or edge.dtype != torch.long:
+            raise ValueError('{} must be a 2 x E long tensor'.format(edge_key))
+        if edge.numel() > 0 and (edge.min() < 0 or edge.max() >= x.shape[0]):
+            raise ValueError('{} refers to nodes outside {}'.format(edge_key, x_key))
+    n_img = graph.x_img.shape[0]
+    weight = getattr(graph, 'x_img_weight', None)
+    if weight is not None and (weight.dim() != 1 or weight.shape[0] != n_img):
+        raise ValueError('x_img_weight must have one weight per patch')
+    pos = getattr(graph, 'pos_img', None)
+    if pos is not None and (pos.dim() != 2 or pos.shape[0] != n_img):
+        raise ValueError('pos_img must have one row per patch')
+
+
+def decode_graph(body, use_type=('img', 'rna', 'cli'), in_feats=None):
+    payload = torch.load(io.BytesIO(body), map_location='cpu', weights_only=True)
+    if not isinstance(payload, dict):
+        raise ValueError('the body must be a dict of tensors')
+    data_id = payload.pop('data_id', None)
+    data_type = payload.pop('data_type', None)
+    if not isinstance(data_type, list) or not all(t in ['img', 'rna', 'cli'] for t in data_type):
+        raise ValueError('data_type must be a list of img, rna and cli')
+    for key, value in payload.items():
+        if not torch.is_tensor(value):
+            raise ValueError('{} is not a tensor'.format(key))
+    graph = Data(**payload)
+    graph.data_id = str(data_id)
+    graph.data_type = data_type
+    check_graph(graph, use_type, in_feats)
+    return graph
+
+
+class service_metrics(object):
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.latency = collections.deque(maxlen=window)
+        self.batch_sizes = collections.deque(maxlen=window)
+        self.requests = 0
+        self.errors = 0
+        self.batches = 0
+
+    def add_batch(self, size, latencies):
+        with self.lock:
+            self.batches += 1
+            self.requests += size
+            self.batch_sizes.append(size)
+            self.latency.extend(latencies)
+
+    def summary(self, queue_depth):
+        with self.lock:
+            lat = np.array(self.latency) * 1000 if len(self.latency) > 0 else np.zeros(1)
+            sizes = np.array(self.batch_sizes) if len(self.batch_sizes) > 0 else np.zeros(1)
+            return {'queue_depth': queue_depth, 'requests': self.requests, 'errors': self.errors,
+                    'batches': self.batches, 'batch_size_mean': float(sizes.mean()), 'batch_size_max': int(sizes.max()),
+                    'latency_ms_p50': float(np.percentile(lat, 50)), 'latency_ms_p90': float(np.percentile(lat, 90)),
+                    'latency_ms_p99': float(np.percentile(lat, 99)), 'latency_ms_max': float(lat.max())}
+
+
+class micro_batcher(object):
+    def __init__(self, models, args, max_batch=8, max_wait=0.02):
+        self.models = models
+        self.args = args
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = queue.Queue()
+        self.metrics = service_metrics()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def submit(self, graph):
+        item = {'graph': graph, 'time': time.time(), 'done': threading.Event(), 'result': None, 'error': None}
+        self.queue.put(item)
+        item['done'].wait()
+        if item['error'] is not None:
+            raise item['error']
+        return item['result']
+
+    def next_batch(self):
+        batch = [self.queue.get()]
+        deadline = batch[0]['time'] + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def fail(self, item, error):
+        with self.metrics.lock:
+            self.metrics.errors += 1
+        item['error'] = error
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            try:
+                results = score_graphs(self.models, [x['graph'] for x in batch], self.args)
+                for item, res in zip(batch, results):
+                    item['result'] = res
+            except Exception as e:
+                if len(batch) == 1:
+                    self.fail(batch[0], e)
+                else:
+                    # score the graphs one by one, so only the requests that fail on their own fail
+                    for item in batch:
+                        try:
+                            item['result'] = score_graphs(self.models, [item['graph']], self.args)[0]
+                        except Exception as e_item:
+                            self.fail(item, e_item)
+            now = time.time()
+            self.metrics.add_batch(len(batch), [now - x['time'] for x in batch])
+            for item in batch:
+                item['done'].set()
+
+
+def make_handler(batcher):
+    class score_handler(BaseHTTPRequestHandler):
+        def reply(self, code, obj):
+            body = json.dumps(obj).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/metrics':
+                self.reply(200, batcher.metrics.summary(batcher.queue.qsize()))
+            elif self.path == '/health':
+                self.reply(200, {'status': 'ok', 'models': len(batcher.models)})
+            else:
+                self.reply(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path != '/score':
+                self.reply(404, {'error': 'not found'})
+                return
+            try:
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                graph = decode_graph(body, batcher.args.train_use_type, getattr(batcher.args, 'in_feats', None))
+            except Exception as e:
+                self.reply(400, {'error': 'cannot read graph: {}'.format(e)})
+                return
+            try:
+                self.reply(200, batcher.submit(graph))
+            except Exception as e:
+                self.reply(500, {'error': str(e)})
+
+        def log_message(self, format, *args):
+            pass
+
+    return score_handler
+
+
+class unix_http_server(ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        request, _ = super(unix_http_server, self).get_request()
+        return request, ('unix', 0)
+
+
+def serve(args):
+    models = [load_model(path, args) for path in args.checkpoints]
+    # merge_attention of a whole micro-batch per call, see score_graphs
+    args.merge_batch = args.max_batch
+    batcher = micro_batcher(models, args, max_batch=args.max_batch, max_wait=args.max_wait_ms / 1000.)
+    handler = make_handler(batcher)
+    if args.unix_socket is not None:
+        if os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+        server = unix_http_server(args.unix_socket, handler)
+        print('scoring {} models on {}'.format(len(models), args.unix_socket))
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), handler)
+        print('scoring {} models on http://{}:{}'.format(len(models), args.host, args.port))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+    return server
+
+
+def get_params():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checkpoints", type=str, nargs='+', required=True, help="fold state_dict files, risks are averaged")
+    parser.add_argument("--host", type=str, default='127.0.0.1', help="http host")
+    parser.add_argument("--port", type=int, default=8600, help="http port")
+    parser.add_argument("--unix_socket", type=str, default=None, help="serve on this unix socket instead of tcp")
+    parser.add_argument("--max_batch", type=int, default=8, help="largest micro-batch")
+    parser.add_argument("--max_wait_ms", type=float, default=20, help="longest wait of a request for its micro-batch")
+    add_model_args(parser)
+    args, _ = parser.parse_known_args()
+    return args
+
+
+if __name__ == '__main__':
+    serve(get_params())
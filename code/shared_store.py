@@ -0,0 +1,171 @@
+import time
+import argparse
+import joblib
+import torch
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+from torch_geometric.data import Data
+
+'''
+Shared memory backend for all_data: the tensors of every patient are copied once into one
+shared memory segment per dtype, and every process reading the store gets zero-copy views
+with the same all_data[id] interface (a torch_geometric Data per patient).
+
+    python shared_store.py --all_data lihc_data.pkl --descriptor /dev/shm/lihc_store.pkl
+    python train_a_dynamic_graph_HGCNplus_mergge_loss.py --shared_store /dev/shm/lihc_store.pkl ...
+
+The first command owns the segments and keeps them alive until it is stopped; any number of
+training processes attach through the (small) descriptor file. A store can also be handed
+to multiprocessing workers directly, pickling it only sends the segment names and the index.
+The views are shared by all readers, so they must not be written to. Per-patient transforms
+that replace tensors (--max_patches, --pq_codebook) are therefore applied here, when the
+store is built. With --shared_store the training script refuses --max_patches, --mem_budget_gb
+and --csr_adj, and uses --pq_codebook only to decode.
+'''
+
+
+def numpy_dtype(dtype):
+    return torch.empty(0, dtype=dtype).numpy().dtype
+
+
+def attach_segment(name):
+    # readers must not unlink the segment at exit, only its owner does
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+class shared_graph_store(object):
+    def __init__(self, index, segments, owner=False):
+        # index: id -> {key: ('tensor', dtype, offset, shape) or ('value', obj)}
+        self.index = index
+        self.segments = segments
+        self.owner = owner
+        self.buffers = {}
+        for dtype, (shm, numel) in segments.items():
+            array = np.ndarray((numel,), dtype=numpy_dtype(getattr(torch, dtype)), buffer=shm.buf)
+            self.buffers[dtype] = torch.from_numpy(array)
+
+    @classmethod
+    def create(cls, all_data):
+        index, sizes = {}, {}
+        for id, data in all_data.items():
+            entry = {}
+            for key, value in data:
+                if torch.is_tensor(value):
+                    dtype = str(value.dtype).split('.')[-1]
+                    entry[key] = ('tensor', dtype, sizes.get(dtype, 0), tuple(value.shape))
+                    sizes[dtype] = sizes.get(dtype, 0) + value.numel()
+                else:
+                    entry[key] = ('value', value)
+            index[id] = entry
+        segments = {}
+        for dtype, numel in sizes.items():
+            nbytes = max(1, numel * numpy_dtype(getattr(torch, dtype)).itemsize)
+            segments[dtype] = (shared_memory.SharedMemory(create=True, size=nbytes), numel)
+        store = cls(index, segments, owner=True)
+        for id, data in all_data.items():
+            for key, value in data:
+                spec = index[id][key]
+                if spec[0] == 'tensor':
+                    store.view(spec).copy_(value.detach().cpu())
+        return store
+
+    @classmethod
+    def attach(cls, state):
+        segments = {dtype: (attach_segment(name), numel) for dtype, (name, numel) in state['segments'].items()}
+        return cls(state['index'], segments)
+
+    def state(self):
+        return {'index': self.index, 'segments': {dtype: (shm.name, numel) for dtype, (shm, numel) in self.segments.items()}}
+
+    def __getstate__(self):
+        return self.state()
+
+    def __setstate__(self, state):
+        other = shared_graph_store.attach(state)
+        self.__dict__.update(other.__dict__)
+
+    def save(self, path):
+        joblib.dump(self.state(), path)
+
+    def view(self, spec):
+        _, dtype, offset, shape = spec
+        numel = int(np.prod(shape)) if len(shape) > 0 else 1
+        return self.buffers[dtype][offset:offset + numel].view(shape)
+
+    def __getitem__(self, id):
+        data = Data()
+        for key, spec in self.index[id].items():
+            setattr(data, key, self.view(spec) if spec[0] == 'tensor' else spec[1])
+        return data
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, id):
+        return id in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def keys(self):
+        return self.index.keys()
+
+    def values(self):
+        return (self[id] for id in self.index)
+
+    def items(self):
+        return ((id, self[id]) for id in self.index)
+
+    def nbytes(self):
+        return sum(shm.size for shm, _ in self.segments.values())
+
+    def close(self):
+        self.buffers = {}
+        for shm, _ in self.segments.values():
+            shm.close()
+            if self.owner:
+                shm.unlink()
+
+
+def load_store(path):
+    return shared_graph_store.attach(joblib.load(path))
+
+
+def serve(args):
+    all_data = joblib.load(args.all_data)
+    if args.max_patches is not None:
+        from memory_tuner import cap_patches
+        all_data = {id: cap_patches(data, args.max_patches) for id, data in all_data.items()}
+    if args.pq_codebook is not None:
+        from pq_features import load_quantizer, compress_all_data
+        all_data = compress_all_data(all_data, load_quantizer(args.pq_codebook))
+    store = shared_graph_store.create(all_data)
+    del all_data
+    store.save(args.descriptor)
+    print('{} patients, {:.2f} GB in shared memory, descriptor {}'.format(len(store), store.nbytes() / 1024 ** 3, args.descriptor))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        store.close()
+
+
+def get_params():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--all_data", type=str, required=True, help="joblib all_data to place in shared memory")
+    parser.add_argument("--descriptor", type=str, required=True, help="where to write the descriptor the readers attach with")
+    parser.add_argument("--max_patches", type=int, default=None, help="per-patient cap of image patches applied before sharing")
+    parser.add_argument("--pq_codebook", type=str, default=None, help="store the product quantised codes of x_img (pq_features.py)")
+    args, _ = parser.parse_known_args()
+    return args
+
+
+if __name__ == '__main__':
+    serve(get_params())
@@ -0,0 +1,51 @@
+import torch
+
+try:
+    from torch_sparse import SparseTensor
+except ImportError:
+    SparseTensor = None
+
+'''
+Sorted CSR adjacencies (torch_sparse.SparseTensor) for the SAGEConv layers.
+
+SAGEConv takes the transposed adjacency adj_t (one row per target node, the sources of its
+messages in the columns) and then aggregates with one sparse matmul instead of gathering
+and scattering through a COO edge_index. The static rna/cli graphs are converted once per
+patient (add_adj_t, --csr_adj in the training script) with their row counts cached, and
+the dynamic graphs emit adj_t straight from their dense 0/1 matrix. Without torch_sparse
+everything stays on edge_index.
+'''
+
+
+def available():
+    return SparseTensor is not None
+
+
+def to_adj_t(edge_index, num_nodes):
+    # edge_index[0] are the sources and edge_index[1] the targets, as in SAGEConv
+    adj_t = SparseTensor(row=edge_index[1], col=edge_index[0], sparse_sizes=(num_nodes, num_nodes))
+    return adj_t.fill_cache_()
+
+
+def dense_to_adj_t(adj_matrix):
+    # adj_matrix[i, j] = 1 is the edge i -> j of dense_to_sparse, so adj_t is its transpose
+    return SparseTensor.from_dense(adj_matrix.t(), has_value=False)
+
+
+def num_edges(edge):
+    return edge.nnz() if SparseTensor is not None and isinstance(edge, SparseTensor) else edge.shape[1]
+
+
+def to_edge_index(edge):
+    if SparseTensor is not None and isinstance(edge, SparseTensor):
+        row, col, _ = edge.coo()
+        return torch.stack((col, row), dim=0)
+    return edge
+
+
+def add_adj_t(data):
+    if not available():
+        return data
+    data.adj_t_rna = to_adj_t(data.edge_index_rna, data.x_rna.shape[0])
+    data.adj_t_cli = to_adj_t(data.edge_index_cli, data.x_cli.shape[0])
+    return data
@@ -0,0 +1,62 @@
+import torch
+
+'''
+Reuse of the dynamic graph topologies across epochs (--topology_refresh K).
+
+In training, the edges built by every dynamic_graph (and, for the rna/cli graphs, the image
+tokens kept by the filter) are stored per patient. Until the next refresh the graphs only
+run their projections and the node update restricted to the stored edges (attention
+softmax over the sources of every target, as attn2), so gradients still reach the node
+features while the N x N attention and threshold are skipped. Note that this restricts the
+attn2 aggregation to the stored edges between refreshes.
+
+The cache is dropped every K epochs and as soon as one of the learned *_std_factor moved by
+more than --topology_std_tol from its value at the last refresh. A stored graph is only
+reused for the same bag: its size and, with --c2f_budget, the coarse-to-fine selection (the
+third item of the key) must match. Evaluation always builds the graphs from scratch.
+'''
+
+
+class topology_cache(object):
+    def __init__(self, refresh_every=5, std_tol=0.05):
+        self.refresh_every = refresh_every
+        self.std_tol = std_tol
+        self.entries = {}
+        self.std_factors = None
+        self.hits = 0
+        self.misses = 0
+
+    def __deepcopy__(self, memo):
+        # best epoch snapshots share the cache, they only evaluate
+        return self
+
+    def std_factors_of(self, model):
+        return {name: graph.std_factor.detach().reshape(-1)[0].item() for name, graph in model.dynamic_graphs().items()}
+
+    def start_epoch(self, model, epoch):
+        # drops the stored graphs at a refresh epoch or when a threshold factor drifted
+        current = self.std_factors_of(model)
+        drift = 0.0 if self.std_factors is None else max(abs(current[k] - self.std_factors[k]) for k in current)
+        if epoch % self.refresh_every == 0 or drift > self.std_tol:
+            self.entries = {}
+            self.std_factors = current
+            return True
+        return False
+
+    def get(self, key, num_q, num_k):
+        entry = self.entries.get((str(key[0]), key[1]))
+        # bags whose size or coarse-to-fine selection changed are rebuilt
+        bag = key[2] if len(key) > 2 else None
+        if entry is None or entry['num_q'] != num_q or entry['num_k'] != num_k or entry['bag'] != bag:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def put(self, key, edge, index, num_q, num_k):
+        self.entries[(str(key[0]), key[1])] = {'edge': edge.detach(), 'index': None if index is None else index.detach(),
+                                               'num_q': num_q, 'num_k': num_k, 'bag': key[2] if len(key) > 2 else None}
+
+    def summary(self):
+        total = max(self.hits + self.misses, 1)
+        return 'topology cache: {} graphs, {:.1%} reused'.format(len(self.entries), self.hits / total)
@@ -24,6 +24,17 @@ from sklearn.model_selection import StratifiedKFold
 from a_dynamic_graph_model_HGCNplus_merge_loss import fusion_model_mae_2
 from util import Logger, get_patients_information,get_all_ci,get_val_ci,adjust_learning_rate
 from mae_utils import generate_mask
+from graph_stats import graph_density_monitor, format_summary
+from inference_utils import build_model
+from pq_features import load_quantizer, compress_all_data
+from memory_tuner import tune, cap_patches
+from shared_store import load_store
+from front_cache import frozen_front_cache
+from topology_cache import topology_cache
+import sparse_adj
+from bucket_sampler import bucket_sampler, fixed_batches, format_report, node_count
+from cox_batch import cox_batch
+from distributed_utils import init_distributed, is_main, shard, shard_schedule, gather_dict, all_sum, all_reduce_gradients, broadcast_model
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
 '''
@@ -54,7 +65,8 @@ def prediction(all_data,v_model,val_id,patient_and_time,patient_sur_type,args):
     iter = 0
     
     with torch.no_grad():
-        for i_batch, id in enumerate(val_id):
+        # with --distributed every rank scores its share of val_id
+        for i_batch, id in enumerate(shard(val_id)):
 
             graph = all_data[id].to(device)
             if args.train_use_type != None:
@@ -83,6 +95,14 @@ def prediction(all_data,v_model,val_id,patient_and_time,patient_sur_type,args):
             if 'cli' in use_type_eopch:
                 val_pre_time_cli[id] = out_pre[1][use_type_eopch.index('cli')].cpu().detach().numpy()            
             
+    if args.distributed:
+        val_pre_time = gather_dict(val_pre_time)
+        val_pre_time_img = gather_dict(val_pre_time_img)
+        val_pre_time_rna = gather_dict(val_pre_time_rna)
+        val_pre_time_cli = gather_dict(val_pre_time_cli)
+        lbl_pred_all = torch.from_numpy(np.stack([val_pre_time[id] for id in val_id])).to(device)
+        survtime_all = [patient_and_time[id] for id in val_id]
+        status_all = [patient_sur_type[id] for id in val_id]
     survtime_all = np.asarray(survtime_all)
     status_all = np.asarray(status_all)
 #     print(lbl_pred_all,survtime_all,status_all)
@@ -112,7 +132,7 @@ def _neg_partial_log(prediction, T, E):
             R_matrix_train[i, j] = T[j] >= T[i]
 
     train_R = torch.FloatTensor(R_matrix_train)
-    train_R = train_R.cuda()
+    train_R = train_R.to(device)
 
     train_ystatus = torch.tensor(np.array(E),dtype=torch.float).to(device)
 
@@ -125,6 +145,36 @@ def _neg_partial_log(prediction, T, E):
 
 
 
+def cox_batch_loss(acc,format_of_coxloss,args):
+    # loss of a closed Cox batch and its value for the epoch loss.
+    # In distributed mode every rank holds the same Cox loss over the gathered batch and gets its own
+    # slice of the gradient (distributed_utils.gather_risks), so it is not divided by the world size:
+    # summing the gradients over the ranks gives the gradient of the global loss. The MAE term is
+    # local and normalised by the global iter, so it is summed over the ranks.
+    loss_surv = 0.0
+    if format_of_coxloss == 'one':
+        all_loss_surv = _neg_partial_log(*acc.cox_inputs('all'))
+        loss_surv = args.all_cox_loss_factor * all_loss_surv
+    elif format_of_coxloss == 'multi':
+        factors = {'img': args.img_cox_loss_factor, 'rna': args.rna_cox_loss_factor,
+                   'cli': args.cli_cox_loss_factor, 'merge': args.img_cox_loss_factor}
+        for head in ['img','rna','cli','merge']:
+            risks,times,events = acc.cox_inputs(head)
+            if risks is not None:
+                loss_surv += factors[head] * _neg_partial_log(risks,times,events)
+    else:
+        raise("Wrong format_of_coxloss")
+
+    loss = loss_surv
+    value = loss_surv.item()
+    if args.add_mse_loss_of_mae:
+        mse = acc.mse / acc.iter
+        loss = loss + mse
+        mse = float(mse)
+        value += all_sum(mse) if args.distributed else mse
+    return loss, value
+
+
 def setup_seed(seed):
     torch.manual_seed(seed)
     os.environ['PYTHONHASHSEED'] = str(seed)
@@ -136,226 +186,103 @@ def setup_seed(seed):
     torch.backends.cudnn.deterministic = True
     torch.backends.cudnn.enabled = True
 
-def train_a_epoch(model,train_data,all_data,patient_and_time,patient_sur_type,batch_size,optimizer,epoch,format_of_coxloss,args):
+def train_a_epoch(model,train_data,all_data,patient_and_time,patient_sur_type,batch_size,optimizer,epoch,format_of_coxloss,args,graph_monitor=None,sampler=None):
     model.train() 
+    if graph_monitor is not None:
+        graph_monitor.start_epoch()
 
-
-    lbl_pred_each = None
-    lbl_pred_img_each = None
-    lbl_pred_rna_each = None
-    lbl_pred_cli_each = None
-    lbl_pred_merge_each = None
-    batch_feature = None
-
-    survtime_all = []
-    status_all = []
-    survtime_img = []
-    status_img = []    
-    survtime_rna = []
-    status_rna = []      
-    survtime_cli = []
-    status_cli = []
-    survtime_merge = []
-    status_merge = []
-    
-    iter = 0
+    # risks, times and events of the current Cox batch per head, see cox_batch.py
+    acc = cox_batch(capacity=batch_size)
     loss_nn_all = [] 
-    train_pre_time = {}
-    train_pre_time_img = {}
-    train_pre_time_rna = {}
-    train_pre_time_cli = {}
     
     all_loss = 0.0 
     mes_loss_of_mae = nn.MSELoss()
 
-    mse_loss_of_mae = 0.0
-    loss_surv = 0.0
-    all_loss_surv = 0.0
-    img_loss_surv = 0.0
-    rna_loss_surv = 0.0
-    cli_loss_surv = 0.0
-    for i_batch,id in enumerate(train_data):
+    discarded = 0
+    batches = sampler.batches(epoch) if sampler is not None else None
+    for i_batch,(id,batch_end) in enumerate(shard_schedule(train_data,batch_size,batches)):
+        if id is not None:
         
-        iter += 1 
-        num_of_model = len(all_data[id].data_type)
-        mask = generate_mask(num=len(args.train_use_type))
+            acc.iter += 1 
+            num_of_model = len(all_data[id].data_type)
+            mask = generate_mask(num=len(args.train_use_type))
         
-        if len(args.train_use_type) == 1:
-            assert args.format_of_coxloss == 'one' and args.add_mse_loss_of_mae == False
-            if args.train_use_type[0] in all_data[id].data_type:
+            if len(args.train_use_type) == 1:
+                assert args.format_of_coxloss == 'one' and args.add_mse_loss_of_mae == False
+                if args.train_use_type[0] in all_data[id].data_type:
+                    graph = all_data[id].to(device)
+                    out_pre,out_fea,out_att,fea_dict = model(graph,args.train_use_type,args.train_use_type,mix=args.mix) 
+                    lbl_pred = out_pre[0]
+                    use_type_eopch = args.train_use_type
+                    num_of_model = 1
+            else:
+                if args.train_use_type!=None:
+                    use_type_eopch = args.train_use_type
+                    num_of_model = len(use_type_eopch)                
+                else:
+                    use_type_eopch = all_data[id].data_type
                 graph = all_data[id].to(device)
-                out_pre,out_fea,out_att,fea_dict = model(graph,args.train_use_type,args.train_use_type,mix=args.mix) 
+                out_pre,out_fea,out_att,fea_dict = model(graph,use_type_eopch,use_type_eopch,mask,mix=args.mix)
                 lbl_pred = out_pre[0]
-                use_type_eopch = args.train_use_type
-                num_of_model = 1
-        else:
-            if args.train_use_type!=None:
-                use_type_eopch = args.train_use_type
-                num_of_model = len(use_type_eopch)                
-            else:
-                use_type_eopch = all_data[id].data_type
-            graph = all_data[id].to(device)
-            out_pre,out_fea,out_att,fea_dict = model(graph,use_type_eopch,use_type_eopch,mask,mix=args.mix)
-            lbl_pred = out_pre[0]
 
-        if len(args.train_use_type) == 1 and args.train_use_type[0] not in all_data[id].data_type:
-            pass
-        else:
-            train_pre_time[id] = lbl_pred.cpu().detach().numpy()
+            if len(args.train_use_type) == 1 and args.train_use_type[0] not in all_data[id].data_type:
+                pass
+            else:
+                if graph_monitor is not None:
+                    graph_monitor.record(id)
 
+                if args.add_mse_loss_of_mae:
+                    acc.mse += args.mse_loss_of_mae_factor * mes_loss_of_mae(input=fea_dict['mae_out'][fea_dict['mask'][0][0]], target=fea_dict['mae_labels'][fea_dict['mask'][0][0]])
 
+                acc.add('all',lbl_pred,patient_and_time[id],patient_sur_type[id],record_id=id)
+                if 'img' in use_type_eopch:
+                    acc.add('merge',fea_dict['loss_img'],patient_and_time[id],patient_sur_type[id])
+                if len(args.train_use_type) != 1:
+                    for type_ in ['img','rna','cli']:
+                        if type_ in use_type_eopch:
+                            acc.add(type_,out_pre[1][use_type_eopch.index(type_)],patient_and_time[id],patient_sur_type[id],record_id=id)
 
 
-            if args.add_mse_loss_of_mae:
-                mse_loss_of_mae += args.mse_loss_of_mae_factor * mes_loss_of_mae(input=fea_dict['mae_out'][fea_dict['mask'][0][0]], target=fea_dict['mae_labels'][fea_dict['mask'][0][0]])
+        if batch_end:
+            if args.distributed:
+                acc.gather()
 
-            survtime_all.append(patient_and_time[id])
-            status_all.append(patient_sur_type[id])
-            if iter == 0 or lbl_pred_each == None:
-                lbl_pred_each = lbl_pred
-            else:
-                lbl_pred_each = torch.cat([lbl_pred_each, lbl_pred])
-            if 'img' in use_type_eopch:
-                loss_risk = fea_dict['loss_img']
-                for i in range(loss_risk.shape[0]):
-                    survtime_merge.append(patient_and_time[id])
-                    status_merge.append(patient_sur_type[id])
-                if lbl_pred_merge_each == None :
-                    lbl_pred_merge_each = loss_risk
-                else:
-                    lbl_pred_merge_each = torch.cat([lbl_pred_merge_each, loss_risk],dim=0)
-            if 'img' in use_type_eopch and len(args.train_use_type) != 1:
-                train_pre_time_img[id] = out_pre[1][use_type_eopch.index('img')].cpu().detach().numpy()
-                survtime_img.append(patient_and_time[id])
-                status_img.append(patient_sur_type[id])            
-                if lbl_pred_img_each == None :
-                    lbl_pred_img_each = out_pre[1][use_type_eopch.index('img')]
-                else:
-                    lbl_pred_img_each = torch.cat([lbl_pred_img_each, out_pre[1][use_type_eopch.index('img')]])
-            if 'rna' in use_type_eopch and len(args.train_use_type) != 1:
-                train_pre_time_rna[id] = out_pre[1][use_type_eopch.index('rna')].cpu().detach().numpy()
-                survtime_rna.append(patient_and_time[id])
-                status_rna.append(patient_sur_type[id])            
-                if lbl_pred_rna_each == None :
-                    lbl_pred_rna_each = out_pre[1][use_type_eopch.index('rna')]
-                else:
-                    lbl_pred_rna_each = torch.cat([lbl_pred_rna_each, out_pre[1][use_type_eopch.index('rna')]])            
-            if 'cli' in use_type_eopch and len(args.train_use_type) != 1:
-                train_pre_time_cli[id] = out_pre[1][use_type_eopch.index('cli')].cpu().detach().numpy()
-                survtime_cli.append(patient_and_time[id])
-                status_cli.append(patient_sur_type[id])            
-                if lbl_pred_cli_each == None :
-                    lbl_pred_cli_each = out_pre[1][use_type_eopch.index('cli')]
-                else:
-                    lbl_pred_cli_each = torch.cat([lbl_pred_cli_each, out_pre[1][use_type_eopch.index('cli')]])
-
-
-        if iter % batch_size == 0 or i_batch == len(train_data)-1:
-
-            survtime_all = np.asarray(survtime_all)
-            status_all = np.asarray(status_all)
-
-            if np.max(status_all) == 0:
-                lbl_pred_each = None
-                lbl_pred_img_each = None
-                lbl_pred_rna_each = None
-                lbl_pred_cli_each = None
-                lbl_pred_merge_each = None
-                batch_feature = None
-                con_loss_label = None
-                con_time_label = None
-                survtime_all = []
-                status_all = []
-                survtime_img = []
-                status_img = []    
-                survtime_rna = []
-                status_rna = []      
-                survtime_cli = []
-                status_cli = []
-                survtime_merge = []
-                status_merge = []
-                iter = 0
-                mse_loss_of_mae = 0.0
-                loss_surv = 0.0
-                all_loss_surv = 0.0
-                img_loss_surv = 0.0
-                rna_loss_surv = 0.0
-                cli_loss_surv = 0.0
+            if not acc.has_events():
+                discarded += 1
+                acc.reset()
                 continue
 
             optimizer.zero_grad() 
 
-
-            if format_of_coxloss == 'one':
-                all_loss_surv = _neg_partial_log(lbl_pred_each, survtime_all, status_all)
-                loss_surv = args.all_cox_loss_factor * all_loss_surv
-            elif format_of_coxloss == 'multi':
-                if lbl_pred_img_each != None:
-                    img_loss_surv = args.img_cox_loss_factor * _neg_partial_log(lbl_pred_img_each, survtime_img, status_img)
-                    loss_surv += img_loss_surv  
-
-                if lbl_pred_rna_each != None:
-                    rna_loss_surv = args.rna_cox_loss_factor * _neg_partial_log(lbl_pred_rna_each, survtime_rna, status_rna)
-                    loss_surv += rna_loss_surv
-
-                if lbl_pred_cli_each != None:    
-                    cli_loss_surv = args.cli_cox_loss_factor * _neg_partial_log(lbl_pred_cli_each, survtime_cli, status_cli)
-                    loss_surv += cli_loss_surv
-
-                if lbl_pred_merge_each != None:
-                    merge_loss_surv = args.img_cox_loss_factor * _neg_partial_log(lbl_pred_merge_each, survtime_merge, status_merge)
-                    loss_surv += merge_loss_surv
-            else:
-                raise("Wrong format_of_coxloss")
-
-            loss = loss_surv   
-                
-            if args.add_mse_loss_of_mae: 
-                mse_loss_of_mae/=iter
-                loss += mse_loss_of_mae
-
-            all_loss += loss.item()
+            loss, batch_loss_value = cox_batch_loss(acc,format_of_coxloss,args)
+            all_loss += batch_loss_value
             loss.backward()
+            if args.distributed:
+                all_reduce_gradients(model)
             if epoch == 0:
                 print('*',end='')
             else:  
                 optimizer.step()
 
             torch.cuda.empty_cache()
-            lbl_pred_each = None
-            lbl_pred_img_each = None
-            lbl_pred_rna_each = None
-            lbl_pred_cli_each = None
-            lbl_pred_merge_each = None
-            batch_feature = None
-            con_loss_label = None
-            con_time_label = None
-            survtime_all = []
-            status_all = []
-            survtime_img = []
-            status_img = []    
-            survtime_rna = []
-            status_rna = []      
-            survtime_cli = []
-            status_cli = []
-            survtime_merge = []
-            status_merge = []
             loss_nn_all.append(loss.data.item())
-            con_loss = 0.0
-            mse_loss = 0.0
-            mse_loss_of_mae = 0.0
-            kl_loss = 0.0 
-            loss_surv = 0.0
-            all_loss_surv = 0.0
-            img_loss_surv = 0.0
-            rna_loss_surv = 0.0
-            cli_loss_surv = 0.0
-            iter = 0            
+            acc.reset()
 
+    if discarded > 0 and is_main():
+        print('{} Cox batches without events were discarded'.format(discarded))
     t_train_ci_img = 0
     t_train_ci_rna = 0
     t_train_ci_cli = 0
     all_loss = all_loss/len(train_data)*batch_size
+    train_pre_time = acc.predictions('all')
+    train_pre_time_img = acc.predictions('img')
+    train_pre_time_rna = acc.predictions('rna')
+    train_pre_time_cli = acc.predictions('cli')
+    if args.distributed:
+        train_pre_time = gather_dict(train_pre_time)
+        train_pre_time_img = gather_dict(train_pre_time_img)
+        train_pre_time_rna = gather_dict(train_pre_time_rna)
+        train_pre_time_cli = gather_dict(train_pre_time_cli)
     t_train_ci = get_val_ci(train_pre_time,patient_and_time,patient_sur_type)
     if len(args.train_use_type) != 1:
         if 'img' in args.train_use_type :
@@ -368,6 +295,55 @@ def train_a_epoch(model,train_data,all_data,patient_and_time,patient_sur_type,ba
     return all_loss,t_train_ci,t_train_ci_img,t_train_ci_rna,t_train_ci_cli
 
 
+def test_each_model(t_model,test_data,all_data,patient_and_time,patient_sur_type,args,gnn_time,each_model_time,test_each_model_ci):
+    # fused, single and two modality risks of the best model of a fold on its test patients
+    one_model_res = [{},{},{}]
+    two_model_res = [{},{},{}]
+    fold_fusion_test_ci = {}
+    with torch.no_grad():
+        # with --distributed every rank runs its share of test_data
+        for id in shard(test_data):  
+            data = all_data[id]
+            data.to(device)
+            (one_x,multi_x),fea,(att_1,att_2),_ = t_model(data,args.train_use_type,args.train_use_type,mix=args.mix)
+            fold_fusion_test_ci[id] = one_x.cpu().detach().numpy()[0]
+            print(data.sur_type.cpu().detach().numpy()[0],one_x.cpu().detach().numpy()[0],patient_and_time[id])
+            for i,type_name in enumerate(['img','rna','cli']):
+                if type_name in data.data_type:
+                    (one_,_),one_fea,(_,_),_ = t_model(data,args.train_use_type,use_type=[type_name],mix=args.mix)
+                    one_model_res[i][id] = one_.cpu().detach().numpy()[0]
+
+            for i,two_type_name in enumerate([['img','rna'],['img','cli'],['rna','cli']]):
+                (one_,two_),one_fea,(_,_),_ = t_model(data,args.train_use_type,use_type=two_type_name,mix=args.mix)
+                two_model_res[i][id] = one_.cpu().detach().numpy()[0]
+
+            del data        
+    if args.distributed:
+        fold_fusion_test_ci = gather_dict(fold_fusion_test_ci)
+        one_model_res = [gather_dict(res) for res in one_model_res]
+        two_model_res = [gather_dict(res) for res in two_model_res]
+    gnn_time.update(fold_fusion_test_ci)
+    for i,type_name in enumerate(['img','rna','cli']): 
+        each_model_time[type_name].update(one_model_res[i])
+        t_ci = get_val_ci(one_model_res[i],patient_and_time,patient_sur_type)
+        test_each_model_ci[type_name].append(t_ci)
+        if is_main():
+            print(len(one_model_res[i]),' ',type_name,' ci:',t_ci)
+        
+    for i,type_name in enumerate([['img','rna'],['img','cli'],['rna','cli']]): 
+        cat_name = type_name[0]+type_name[1]
+        each_model_time[cat_name].update(two_model_res[i])
+        t_ci = get_val_ci(two_model_res[i],patient_and_time,patient_sur_type)
+        test_each_model_ci[cat_name].append(t_ci)
+        if is_main():
+            print(len(two_model_res[i]),' ',cat_name,' ci:',t_ci)                
+        
+    test_ci = get_val_ci(fold_fusion_test_ci,patient_and_time,patient_sur_type)
+    if is_main():
+        print('all ci:',test_ci)
+    return test_ci
+
+
 def main(args): 
     start_seed = args.start_seed
     cancer_type = args.cancer_type
@@ -406,9 +382,39 @@ def main(args):
 
     patients = joblib.load(root_path + cancer_type + '/' + cancer_type + patients_path_end)
     sur_and_time = joblib.load(root_path + cancer_type + '/' + cancer_type + sur_and_time_path_end)
-    all_data=joblib.load(root_path + cancer_type + '/' + cancer_type + all_data_path_end)
+    if args.shared_store is not None:
+        # zero-copy views of the segments created by shared_store.py
+        all_data = load_store(args.shared_store)
+    else:
+        all_data=joblib.load(root_path + cancer_type + '/' + cancer_type + all_data_path_end)
     seed_fit_split = joblib.load(root_path + cancer_type + '/' + cancer_type + seed_fit_splite_path_end)
 
+    pq = None
+    if args.pq_codebook is not None:
+        # keep only the product quantised codes of x_img resident, decoded in the model
+        pq = load_quantizer(args.pq_codebook).to(device)
+        if args.shared_store is None:
+            # a shared store is compressed when it is built, see shared_store.py
+            all_data = compress_all_data(all_data, pq)
+
+    if args.mem_budget_gb is not None:
+        setup_seed(0)
+        tune_model = build_model(args).to(device)
+        if pq is not None:
+            tune_model.set_feature_decoder(pq)
+        # 4/5 of the patients go to train+val, 3/4 of those to train
+        args.batch_size, args.max_patches = tune(tune_model, all_data, int(len(patients) * 0.6), args)
+        batch_size = args.batch_size
+        del tune_model
+    if args.max_patches is not None:
+        all_data = {id: cap_patches(data, args.max_patches) for id, data in all_data.items()}
+    if args.csr_adj:
+        if sparse_adj.available():
+            all_data = {id: sparse_adj.add_adj_t(data) for id, data in all_data.items()}
+        else:
+            print('torch_sparse is not installed, --csr_adj falls back to edge_index')
+            args.csr_adj = False
+
     patient_sur_type, patient_and_time, kf_label = get_patients_information(patients,sur_and_time)
 
 
@@ -471,24 +477,23 @@ def main(args):
         for train_index, test_index in kf.split(patients,kf_label):
             fold_patients = []
             n_fold+=1
-            print('fold: ',n_fold)
-            ex_size = 0
-            if 'img' in args.train_use_type:
-                ex_size += 2
+            if is_main():
+                print('fold: ',n_fold)
             if fusion_model == 'fusion_model_mae_2':
-                model = fusion_model_mae_2(in_feats=1024,
-                                           n_hidden=args.n_hidden,
-                                           out_classes=args.out_classes,
-                                           k_weight_rna=args.k_weight_rna,
-                                           k_weight_cli=args.k_weight_cli,
-                                           img_std_factor=args.img_std_factor,
-                                           rna_std_factor=args.rna_std_factor,
-                                           cli_std_factor=args.cli_std_factor,
-                                           dropout=drop_out_ratio,
-                                           train_type_num = len(args.train_use_type) + ex_size
-                                      ).to(device)
+                model = build_model(args).to(device)
+            if pq is not None:
+                model.set_feature_decoder(pq)
+            if args.distributed:
+                broadcast_model(model)
+            if args.csr_adj:
+                model.set_sparse_adj(True)
+            if args.topology_refresh is not None:
+                model.set_topology_cache(topology_cache(args.topology_refresh, args.topology_std_tol))
 
             optimizer=Adam(model.parameters(),lr=lr,weight_decay=5e-4)
+            graph_monitor = None
+            if args.graph_stats:
+                graph_monitor = graph_density_monitor(model, density_alarm=args.density_alarm)
 
             
             if args.if_fit_split:
@@ -503,11 +508,19 @@ def main(args):
                 train_data, val_data ,_ , _ = train_test_split(t_train_data,t_train_data,test_size=0.25,random_state=1,stratify=t_l)         
                 test_data = np.array(patients)[test_index]
 
-            print(len(train_data),len(val_data),len(test_data))
+            if is_main():
+                print(len(train_data),len(val_data),len(test_data))
             fold_patients.append(train_data)
             fold_patients.append(val_data)
             fold_patients.append(test_data)
             seed_patients.append(fold_patients)
+
+            sampler = None
+            if args.bucket_batches:
+                sizes = {id: node_count(all_data[id]) for id in train_data}
+                sampler = bucket_sampler(train_data, sizes, patient_sur_type, batch_size, args.num_buckets, seed)
+                if is_main():
+                    print(format_report(sampler.report(sampler.batches(), fixed_batches(train_data, batch_size))))
    
             
             best_loss = 9999
@@ -518,24 +531,40 @@ def main(args):
                 
                 if if_adjust_lr:
                     adjust_learning_rate(optimizer, lr, epoch, lr_step=20, lr_gamma=args.adjust_lr_ratio)
+                if args.freeze_front_epoch is not None and epoch == args.freeze_front_epoch:
+                    # staged training: only mae, mix, the second pooling and the heads keep training
+                    model.freeze_front()
+                    model.set_front_cache(frozen_front_cache(args.front_cache_dir))
+                    model.front_cache.precompute(model,all_data,list(train_data)+list(val_data)+list(test_data),args.train_use_type)
+                if model.front_cache is not None:
+                    model.front_cache.validate(model)
+                if model.img_dynamic_graph.topology is not None:
+                    model.img_dynamic_graph.topology.start_epoch(model,epoch)
                 
                 
                 
                 
-                all_loss,t_train_ci,t_train_ci_img,t_train_ci_rna,t_train_ci_cli = train_a_epoch(model,train_data,all_data,patient_and_time,patient_sur_type,batch_size,optimizer,epoch, format_of_coxloss, args)
+                all_loss,t_train_ci,t_train_ci_img,t_train_ci_rna,t_train_ci_cli = train_a_epoch(model,train_data,all_data,patient_and_time,patient_sur_type,batch_size,optimizer,epoch, format_of_coxloss, args, graph_monitor=graph_monitor, sampler=sampler)
+                if graph_monitor is not None:
+                    summary = graph_monitor.end_epoch()
+                    if is_main():
+                        print(format_summary(summary))
                 
                 t_test_loss,test_ci,test_img_ci,test_rna_ci,test_cli_ci = prediction(all_data,model,test_data,patient_and_time,patient_sur_type,args)  
                 v_loss,val_ci,val_img_ci,val_rna_ci,val_cli_ci = prediction(all_data,model,val_data,patient_and_time,patient_sur_type,args)
               
                 
                 
+                # the predictions are gathered, so every rank picks the same best epoch
                 if val_ci >= best_val_ci and epoch>1 :
                     best_val_ci = val_ci
                     tmp_train_ci = t_train_ci
-                    print(val_ci)
+                    if is_main():
+                        print(val_ci)
                     t_model = copy.deepcopy(model)
 
-                print("epoch：{:2d}，train_loos：{:.4f},train_ci：{:.4f},val_loos：{:.4f},val_ci：{:.4f},test_loos：{:.4f},test_ci：{:.5f}".format(epoch,all_loss,t_train_ci,v_loss,val_ci,t_test_loss,test_ci)) 
+                if is_main():
+                    print("epoch：{:2d}，train_loos：{:.4f},train_ci：{:.4f},val_loos：{:.4f},val_ci：{:.4f},test_loos：{:.4f},test_ci：{:.5f}".format(epoch,all_loss,t_train_ci,v_loss,val_ci,t_test_loss,test_ci)) 
 
     
 
@@ -549,61 +578,26 @@ def main(args):
             val_fold_ci.append(best_val_ci)
             train_fold_ci.append(tmp_train_ci)
 
-            one_model_res = [{},{},{}]
-            two_model_res = [{},{},{}]
-            fold_fusion_test_ci = {}
-            with torch.no_grad():
-                for id in test_data:  
-                    data = all_data[id]
-                    data.to(device)
-                    (one_x,multi_x),fea,(att_1,att_2),_ = t_model(data,args.train_use_type,args.train_use_type,mix=args.mix)
-                    gnn_time[id] = one_x.cpu().detach().numpy()[0]
-                    fold_fusion_test_ci[id] = one_x.cpu().detach().numpy()[0]
-                    print(data.sur_type.cpu().detach().numpy()[0],one_x.cpu().detach().numpy()[0],patient_and_time[id])
-                    one_test_feature[id] = {}
-                    for i,type_name in enumerate(['img','rna','cli']):
-                        if type_name in data.data_type:
-                            (one_,_),one_fea,(_,_),_ = t_model(data,args.train_use_type,use_type=[type_name],mix=args.mix)
-                            one_model_res[i][id] = one_.cpu().detach().numpy()[0]
-                            each_model_time[type_name][id] = one_.cpu().detach().numpy()[0]
-
-                    for i,two_type_name in enumerate([['img','rna'],['img','cli'],['rna','cli']]):
-                        (one_,two_),one_fea,(_,_),_ = t_model(data,args.train_use_type,use_type=two_type_name,mix=args.mix)
-                        two_model_res[i][id] = one_.cpu().detach().numpy()[0]
-                        cat_name = two_type_name[0]+two_type_name[1]
-                        each_model_time[cat_name][id] = one_.cpu().detach().numpy()[0]     
-
-                    del data        
-            for i,type_name in enumerate(['img','rna','cli']): 
-                t_ci = get_val_ci(one_model_res[i],patient_and_time,patient_sur_type)
-                test_each_model_ci[type_name].append(t_ci)
-                print(len(one_model_res[i]),' ',type_name,' ci:',t_ci)
-                
-            for i,type_name in enumerate([['img','rna'],['img','cli'],['rna','cli']]): 
-                t_ci = get_val_ci(two_model_res[i],patient_and_time,patient_sur_type)
-                cat_name = type_name[0]+type_name[1]
-                test_each_model_ci[cat_name].append(t_ci)
-                print(len(two_model_res[i]),' ',cat_name,' ci:',t_ci)                
-                
-            test_ci = get_val_ci(fold_fusion_test_ci,patient_and_time,patient_sur_type)
-            print('all ci:',test_ci)
+            test_ci = test_each_model(t_model,test_data,all_data,patient_and_time,patient_sur_type,args,gnn_time,each_model_time,test_each_model_ci)
 
 
-            torch.save(t_model.state_dict(), save_path+sys_time.strftime('%Y-%m-%d')+label+'_'+str(seed)+'_'+str(n_fold)+'.pth')
+            if is_main():
+                torch.save(t_model.state_dict(), save_path+sys_time.strftime('%Y-%m-%d')+label+'_'+str(seed)+'_'+str(n_fold)+'.pth')
             del model, train_data, test_data, t_model
             
 
-        print('seed: ',seed)
-        print('test fold ci:')
-        for x in test_fold_ci:
-            print(x)
-          
-        print('all ci:')
-        print(get_all_ci(gnn_time,patient_and_time,patient_sur_type))
-        
-        print('val fold ci:')
-        for x in val_fold_ci:
-            print(x)
+        if is_main():
+            print('seed: ',seed)
+            print('test fold ci:')
+            for x in test_fold_ci:
+                print(x)
+
+            print('all ci:')
+            print(get_all_ci(gnn_time,patient_and_time,patient_sur_type))
+
+            print('val fold ci:')
+            for x in val_fold_ci:
+                print(x)
 
     
         all_fold_test_ci.append(test_fold_ci) 
@@ -613,6 +607,8 @@ def main(args):
         all_each_model_time.append(each_model_time)
 
     
+    if not is_main():
+        return
     print('summary :')
     print(label)  
     
@@ -669,16 +665,52 @@ def get_params():
     parser.add_argument("--img_std_factor",type=float, default=.4, help="img_std_factor")
     parser.add_argument("--rna_std_factor",type=float, default=.4, help="rna_std_factor")
     parser.add_argument("--cli_std_factor",type=float, default=.4, help="cli_std_factor")
+    parser.add_argument("--merge_factor",type=int, default=4, help="patches merged per token by merge_attention")
+    parser.add_argument("--filter_factor",type=float, default=.4, help="share of image tokens kept by the rna/cli dynamic graphs")
+    parser.add_argument("--in_feats", type=int, default=1024, help="input feature width (lower after input_reduction.py)")
+    parser.add_argument("--in_proj_dim", type=int, default=None, help="learned per-modality projection of the inputs to this width")
+    parser.add_argument("--shared_img_trunk", action='store_true', default=False, help="one shared first layer for the image side q/k projections of the dynamic graphs")
+    parser.add_argument("--c2f_budget",type=int, default=None, help="coarse-to-fine: full resolution patches per slide (coarse_to_fine.py)")
+    parser.add_argument("--c2f_cell",type=int, default=8, help="coarse-to-fine: cell side in patches")
+    parser.add_argument("--pq_codebook", type=str, default=None, help="product quantiser of x_img (pq_features.py), keeps the patches compressed in memory")
+    parser.add_argument("--mem_budget_gb", type=float, default=None, help="pick batch_size and max_patches that fit this memory budget")
+    parser.add_argument("--max_patches", type=int, default=None, help="per-patient cap of image patches")
+    parser.add_argument("--tune_patients", type=int, default=4, help="patients profiled by the memory tuner")
+    parser.add_argument("--graph_stats", action='store_true', default=False, help="print per-epoch density statistics of the dynamic graphs")
+    parser.add_argument("--density_alarm",type=float, default=None, help="warn when a dynamic graph density exceeds this value")
+    parser.add_argument("--freeze_front_epoch", type=int, default=None, help="freeze and cache the front half of the model (front_cache.py) from this epoch on")
+    parser.add_argument("--front_cache_dir", type=str, default=None, help="also keep the cached front outputs on disk")
+    parser.add_argument("--bucket_batches", action='store_true', default=False, help="Cox batches of patients of similar size, each with an event (bucket_sampler.py)")
+    parser.add_argument("--num_buckets", type=int, default=4, help="size buckets of --bucket_batches")
+    parser.add_argument("--csr_adj", action='store_true', default=False, help="sorted CSR adjacencies for the SAGEConv layers (sparse_adj.py, needs torch_sparse)")
+    parser.add_argument("--topology_refresh", type=int, default=None, help="reuse the dynamic graph edges in training and rebuild them every K epochs (topology_cache.py)")
+    parser.add_argument("--topology_std_tol", type=float, default=0.05, help="also rebuild when a *_std_factor moved by more than this")
+    parser.add_argument("--shared_store", type=str, default=None, help="descriptor of a shared memory all_data (shared_store.py), used instead of loading the pkl")
+    parser.add_argument("--distributed", action='store_true', default=False, help="data parallel training over the ranks of torchrun, gloo backend")
+    parser.add_argument("--dist_threads", type=int, default=None, help="torch threads per rank in distributed mode")
+    parser.add_argument("--vmap_folds", action='store_true', default=False, help="train the 5 folds of a seed together with vmap (fold_vmap_train.py)")
 
 
     args, _ = parser.parse_known_args()
+    if args.shared_store is not None:
+        # these replace the tensors of every patient, i.e. private copies of the whole store
+        if args.max_patches is not None or args.mem_budget_gb is not None:
+            parser.error('--max_patches and --mem_budget_gb copy all_data out of the shared store, build it with shared_store.py --max_patches instead')
+        if args.csr_adj:
+            parser.error('--csr_adj copies all_data out of the shared store, drop one of the two')
     return args
 
 
 if __name__ == '__main__':
     try:
         args=get_params()
-        main(args)
+        if args.distributed:
+            init_distributed(args)
+        if args.vmap_folds:
+            from fold_vmap_train import main_vmap
+            main_vmap(args)
+        else:
+            main(args)
     except Exception as exception:
         raise
     